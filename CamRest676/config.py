@@ -62,6 +62,7 @@ class _Config:
         self.teacher_force = 100
         self.beam_search = False
         self.beam_size = 10
+        self.bspan_beam_search = False
         self.sampling = False
         self.use_positional_embedding = False
         self.unfrz_attn_epoch = 0
@@ -72,6 +73,16 @@ class _Config:
         self.bleu_threshold = 0.2
         self.start_epoch = -1
         self.para_start_epoch = -1
+        self.resume = False
+        self.resume_interval = 0
+        self.async_checkpoint = True
+        self.keep_checkpoint_num = 0
+        self.infer_threads = 0   # torch intra-op threads at test time on CPU, 0 for the default
+        self.infer_interop_threads = 0
+        self.infer_cpus = ''   # comma separated cpu ids to pin test-time decoding to, empty for no pinning
+        self.quantize = False   # int8 dynamic quantization of the GRU and Linear layers for CPU inference (torch>=1.3)
+        self.quantize_guard = False   # with quantize, evaluate in fp32 too and log the metric deltas and decoding times
+        self.bf16 = False   # bf16 CPU autocast for the GRUs and projections (torch>=1.10), falls back to fp32 if unsupported
 
     def _multiwoz_tsdf_init(self):
         self.beam_len_bonus = 0.5
@@ -112,6 +123,7 @@ class _Config:
         self.teacher_force = 100
         self.beam_search = False
         self.beam_size = 10
+        self.bspan_beam_search = False
         self.sampling = False
         self.use_positional_embedding = False
         self.unfrz_attn_epoch = 0
@@ -122,6 +134,16 @@ class _Config:
         self.bleu_threshold = 0.2
         self.start_epoch = -1
         self.para_start_epoch = -1
+        self.resume = False
+        self.resume_interval = 0
+        self.async_checkpoint = True
+        self.keep_checkpoint_num = 0
+        self.infer_threads = 0   # torch intra-op threads at test time on CPU, 0 for the default
+        self.infer_interop_threads = 0
+        self.infer_cpus = ''   # comma separated cpu ids to pin test-time decoding to, empty for no pinning
+        self.quantize = False   # int8 dynamic quantization of the GRU and Linear layers for CPU inference (torch>=1.3)
+        self.quantize_guard = False   # with quantize, evaluate in fp32 too and log the metric deltas and decoding times
+        self.bf16 = False   # bf16 CPU autocast for the GRUs and projections (torch>=1.10), falls back to fp32 if unsupported
 
     def __str__(self):
         s = ''
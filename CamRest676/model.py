@@ -8,7 +8,7 @@ from tsd_net import TSD, cuda_, nan, Paraphrase
 from torch.optim import Adam, RMSprop
 from torch.autograd import Variable
 from reader import pad_sequences
-import argparse, time
+import argparse, time, os, copy, queue, threading, atexit
 from nltk.tokenize import word_tokenize
 
 from metric import CamRestEvaluator, MultiWOZEvaluator
@@ -52,6 +52,7 @@ class Model:
                                    max_ts=cfg.max_ts,
                                    beam_search=cfg.beam_search,
                                    beam_size=cfg.beam_size,
+                                   bspan_beam_search=cfg.bspan_beam_search,
                                    eos_token_idx=self.reader.vocab.encode('EOS_M'),
                                    vocab=self.reader.vocab,
                                    teacher_force=cfg.teacher_force,
@@ -69,6 +70,10 @@ class Model:
         # self.optim_para = Adam(lr=cfg.lr_para, params=filter(lambda x: x.requires_grad, self.m_para.parameters()),
         # weight_decay=5e-5)
         self.base_epoch = -1
+        self.ckpt_writer = CheckpointWriter(cfg.keep_checkpoint_num, cfg.async_checkpoint)
+        self.train_state = {'epoch': 0, 'iter': 0, 'batch_order': None, 'sup_loss': 0, 'sup_cnt': 0,
+                            'lr': cfg.lr, 'lr_para': cfg.lr_para, 'prev_min_loss': 1 << 30,
+                            'early_stop_count': cfg.early_stop_count}
 
     def _convert_batch_para(self, py_batch, mode, prev_a_py=None):
         u_input_np = pad_sequences(py_batch['delex_user'], cfg.max_para_len, padding='post',
@@ -218,24 +223,21 @@ class Model:
         return u_input, u_input_np, z_input, m_input, m_input_np, u_len, m_len, degree_input, kw_ret, domain
 
     def train(self):
-        lr = cfg.lr
-        lr_para = cfg.lr_para
-        prev_min_loss, early_stop_count \
-            = 1 << 30, cfg.early_stop_count
+        state = self.train_state
         train_time = 0
         for epoch in range(cfg.epoch_num):
             sw = time.time()
-            if epoch <= self.base_epoch:
+            if epoch <= self.base_epoch or epoch < state['epoch']:
                 continue
             self.training_adjust(epoch)
             self.m.self_adjust(epoch)
             self.m_para.self_adjust(epoch)
-            sup_loss = 0
-            sup_cnt = 0
-            data_iterator = self.reader.mini_batch_iterator('train')
+            sup_loss = state['sup_loss']
+            sup_cnt = state['sup_cnt']
+            data_iterator = self.reader.mini_batch_iterator('train', order=state['batch_order'], start=state['iter'])
             optim = self.optim
             # optim_para = self.optim_para
-            for iter_num, dial_batch in enumerate(data_iterator):
+            for iter_num, dial_batch in enumerate(data_iterator, state['iter']):
                 turn_states = {}
                 prev_z = None
                 for turn_num, turn_batch in enumerate(dial_batch):
@@ -254,7 +256,7 @@ class Model:
 
                     u_input, u_input_np, para_input, para_input_np, u_len, prev_act_input \
                         = self._convert_batch_para(turn_batch, 'train')
-                    sparse_u_input_para = Variable(get_sparse_input_aug(u_input_np), requires_grad=False)
+                    sparse_u_input_para = cuda_(Variable(get_sparse_input_aug(u_input_np), requires_grad=False))
                     para_dec_outs, para_idx, loss_para = self.m_para(u_input=u_input,
                                                                      para_input=para_input,
                                                                      prev_act_input=prev_act_input,
@@ -267,10 +269,10 @@ class Model:
                     final_u_input, final_u_input_np, z_input, m_input, m_input_np, final_u_len, \
                     m_len, degree_input, kw_ret, domain \
                         = self._convert_batch(turn_batch, prev_z, "train")
-                    sparse_u_input_bspan = Variable(get_sparse_input_aug(final_u_input_np), requires_grad=False)
-                    z_input_np = z_input.cpu().data.numpy()
-                    sparse_u_input_response = Variable(get_sparse_selective_input(z_input_np, self.reader.vocab),
-                                                       requires_grad=False)
+                    sparse_u_input_bspan = cuda_(Variable(get_sparse_input_aug(final_u_input_np), requires_grad=False))
+                    z_input_np = kw_ret['z_input_np']
+                    sparse_u_input_response = cuda_(Variable(get_sparse_selective_input(z_input_np, self.reader.vocab),
+                                                             requires_grad=False))
                     loss, pr_loss, m_loss, turn_states = self.m(u_input=final_u_input, z_input=z_input,
                                                                 m_input=m_input, domain=domain,
                                                                 degree_input=degree_input,
@@ -299,6 +301,11 @@ class Model:
 
                     prev_z = turn_batch['bspan']
 
+                if cfg.resume_interval and (iter_num+1) % cfg.resume_interval == 0:
+                    state.update(epoch=epoch, iter=iter_num+1, batch_order=self.reader.batch_order['train'],
+                                 sup_loss=sup_loss, sup_cnt=sup_cnt)
+                    self.save_checkpoint()
+
             epoch_sup_loss = sup_loss / (sup_cnt + 1e-8)
             train_time += time.time() - sw
             logging.info('Traning time: {}'.format(train_time))
@@ -312,24 +319,27 @@ class Model:
             self.save_model(epoch)
             self.save_model_para(epoch)
 
-            if valid_loss <= prev_min_loss:
-                prev_min_loss = valid_loss
-                early_stop_count = cfg.early_stop_count
+            if valid_loss <= state['prev_min_loss']:
+                state['prev_min_loss'] = valid_loss
+                state['early_stop_count'] = cfg.early_stop_count
             else:
-                prev_min_loss = valid_loss
-                early_stop_count -= 1
-                if not early_stop_count:
-                    lr *= cfg.lr_decay
-                    lr_para *= cfg.lr_decay
-                    if lr < 0.08 * cfg.lr:
+                state['prev_min_loss'] = valid_loss
+                state['early_stop_count'] -= 1
+                if not state['early_stop_count']:
+                    state['lr'] *= cfg.lr_decay
+                    state['lr_para'] *= cfg.lr_decay
+                    if state['lr'] < 0.08 * cfg.lr:
                         break
-                    self.optim = Adam(lr=lr, params=filter(lambda x: x.requires_grad, self.m.parameters()),
+                    self.optim = Adam(lr=state['lr'], params=filter(lambda x: x.requires_grad, self.m.parameters()),
                                       weight_decay=5e-5)
-                    self.optim_para = Adam(lr=lr_para, params=filter(lambda x: x.requires_grad, 
+                    self.optim_para = Adam(lr=state['lr_para'], params=filter(lambda x: x.requires_grad,
                                                                      self.m_para.parameters()), weight_decay=5e-5)
-                    logging.info('early stop count out, learning rate %f' % lr)
-                    early_stop_count = cfg.early_stop_count
-                
+                    logging.info('early stop count out, learning rate %f' % state['lr'])
+                    state['early_stop_count'] = cfg.early_stop_count
+            state.update(epoch=epoch+1, iter=0, batch_order=None, sup_loss=0, sup_cnt=0)
+            self.save_checkpoint()
+
+
     def eval(self, data='test'):
         self.m.eval()
         self.reader.result_file = None
@@ -343,7 +353,7 @@ class Model:
             for turn_num, turn_batch in enumerate(dial_batch):
                 u_input, u_input_np, para_input, para_input_np, u_len, prev_act_input \
                     = self._convert_batch_para(turn_batch, 'test', prev_act)
-                sparse_u_input_para = Variable(get_sparse_input_aug(u_input_np), requires_grad=False)
+                sparse_u_input_para = cuda_(Variable(get_sparse_input_aug(u_input_np), requires_grad=False))
                 para_dec_outs, para_idx, prev_act_idx = self.m_para(u_input=u_input,
                                                                  para_input=para_input,
                                                                  u_input_np=u_input_np,
@@ -353,7 +363,7 @@ class Model:
                 u_input, u_input_np, z_input, m_input, m_input_np, u_len, \
                 m_len, degree_input, kw_ret, domain \
                     = self._convert_batch(turn_batch, prev_z, mode=mode)
-                sparse_u_input_bspan = Variable(get_sparse_input_aug(u_input_np), requires_grad=False)
+                sparse_u_input_bspan = cuda_(Variable(get_sparse_input_aug(u_input_np), requires_grad=False))
                 m_idx, z_idx, turn_states = self.m(mode=mode, u_input=u_input, u_len=u_len, z_input=z_input,
                                                    m_input=m_input, domain=domain,
                                                    para_dec=para_dec_outs,
@@ -370,9 +380,9 @@ class Model:
         self.reader.result_file.close()
         self.reader.para_result_file.close()
         ev = self.EV(result_path=cfg.result_path)
-        res = ev.run_metrics()
+        ev.run_metrics()
         self.m.train()
-        return res
+        return ev.metric_dict
 
     def validate(self, data='dev'):
         self.m.eval()
@@ -384,7 +394,7 @@ class Model:
             for turn_num, turn_batch in enumerate(dial_batch):
                 u_input, u_input_np, para_input, para_input_np, u_len, prev_act_input \
                     = self._convert_batch_para(turn_batch, 'train')
-                sparse_u_input_para = Variable(get_sparse_input_aug(u_input_np), requires_grad=False)
+                sparse_u_input_para = cuda_(Variable(get_sparse_input_aug(u_input_np), requires_grad=False))
                 para_dec_outs, _, loss_para = self.m_para(u_input=u_input,
                                                                  para_input=para_input,
                                                                  u_input_np=u_input_np,
@@ -394,10 +404,10 @@ class Model:
                 u_input, u_input_np, z_input, m_input, m_input_np, u_len, \
                 m_len, degree_input, kw_ret, domain \
                     = self._convert_batch(turn_batch, mode="val")
-                sparse_u_input_bspan = Variable(get_sparse_input_aug(u_input_np), requires_grad=False)
-                z_input_np = z_input.cpu().data.numpy()
-                sparse_u_input_response = Variable(get_sparse_selective_input(z_input_np, self.reader.vocab),
-                                                   requires_grad=False)
+                sparse_u_input_bspan = cuda_(Variable(get_sparse_input_aug(u_input_np), requires_grad=False))
+                z_input_np = kw_ret['z_input_np']
+                sparse_u_input_response = cuda_(Variable(get_sparse_selective_input(z_input_np, self.reader.vocab),
+                                                         requires_grad=False))
                 loss, pr_loss, m_loss, turn_states = self.m(u_input=u_input, z_input=z_input,
                                                             m_input=m_input, domain=domain,
                                                             turn_states=turn_states,
@@ -446,7 +456,7 @@ class Model:
                     # optim_para.zero_grad()
                     u_input, u_input_np, para_input, para_input_np, u_len, prev_act_input \
                         = self._convert_batch_para(turn_batch, 'rl')
-                    sparse_u_input_para = Variable(get_sparse_input_aug(u_input_np), requires_grad=False)
+                    sparse_u_input_para = cuda_(Variable(get_sparse_input_aug(u_input_np), requires_grad=False))
                     para_dec_outs, _, _ = self.m_para(u_input=u_input,
                                                    para_input=para_input,
                                                    u_input_np=u_input_np,
@@ -456,7 +466,7 @@ class Model:
                     u_input, u_input_np, z_input, m_input, m_input_np, u_len, \
                     m_len, degree_input, kw_ret, domain\
                         = self._convert_batch(turn_batch, prev_z, mode="rl")
-                    sparse_u_input_bspan = Variable(get_sparse_input_aug(u_input_np), requires_grad=False)
+                    sparse_u_input_bspan = cuda_(Variable(get_sparse_input_aug(u_input_np), requires_grad=False))
                     loss_rl = self.m(u_input=u_input, z_input=z_input,
                                      m_input=m_input, domain=domain,
                                      degree_input=degree_input,
@@ -503,6 +513,34 @@ class Model:
                     logging.info('early stop count out, learning rate %f' % lr)
                     early_stop_count = cfg.early_stop_count
 
+    def quantize(self):
+        if cfg.cuda:
+            logging.warning('dynamic quantization is for CPU inference, running in fp32')
+            return
+        self.m = quantize_dynamic(self.m)
+        self.m_para = quantize_dynamic(self.m_para)
+        logging.info('Model quantized to int8')
+
+    def quantize_guard(self, data='test'):
+        """
+        evaluate in fp32 and then with int8 dynamic quantization, and log the metric deltas and decoding times.
+        The result files are left with the int8 results
+        """
+        sw = time.time()
+        fp32 = self.eval(data)
+        fp32_time = time.time() - sw
+        self.quantize()
+        sw = time.time()
+        int8 = self.eval(data)
+        int8_time = time.time() - sw
+        for key in fp32:
+            # match_metric reports a pair of rates
+            pairs = zip(fp32[key], int8[key]) if isinstance(fp32[key], tuple) else [(fp32[key], int8[key])]
+            for a, b in pairs:
+                logging.info('%s fp32: %.3f int8: %.3f delta: %+.3f' % (key, a, b, b - a))
+        logging.info('decoding time fp32: %.1fs int8: %.1fs speedup: %.2fx' % (fp32_time, int8_time,
+                                                                             fp32_time / int8_time))
+
     def save_model_para(self, epoch, path=None, critical=False):
         if not path:
             path = cfg.para_path + '_' + str(epoch) + '.pkl'
@@ -511,7 +549,7 @@ class Model:
         all_state = {'lstd': self.m_para.state_dict(),
                      'config': cfg.__dict__,
                      'epoch': epoch}
-        torch.save(all_state, path)
+        self.ckpt_writer.save(all_state, path, series=None if critical else 'para')
 
     def save_model(self, epoch, path=None, critical=False):
         if not path:
@@ -521,11 +559,12 @@ class Model:
         all_state = {'lstd': self.m.state_dict(),
                      'config': cfg.__dict__,
                      'epoch': epoch}
-        torch.save(all_state, path)
+        self.ckpt_writer.save(all_state, path, series=None if critical else 'model')
 
     def load_model(self, epoch, path=None):
         if not path:
             path = cfg.model_path + '_' + str(epoch) + '.pkl'
+        self.ckpt_writer.flush()
         all_state = torch.load(path, map_location='cpu')
         self.m.load_state_dict(all_state['lstd'])
         self.base_epoch = epoch
@@ -533,9 +572,41 @@ class Model:
     def load_model_para(self, epoch, path=None):
         if not path:
             path = cfg.para_path + '_' + str(epoch) + '.pkl'
+        self.ckpt_writer.flush()
         all_state = torch.load(path, map_location='cpu')
         self.m_para.load_state_dict(all_state['lstd'])
 
+    def save_checkpoint(self, path=None):
+        """
+        resume checkpoint: models, optimizer, train_state (decay counters, epoch/batch cursor and batch order)
+        and the python/numpy/torch RNG streams
+        """
+        if not path:
+            path = cfg.model_path + '_resume.pkl'
+        all_state = {'lstd': self.m.state_dict(),
+                     'lstd_para': self.m_para.state_dict(),
+                     'optim': self.optim.state_dict(),
+                     'train_state': self.train_state,
+                     'rng': get_rng_state(),
+                     'config': cfg.__dict__}
+        self.ckpt_writer.save(all_state, path)
+
+    def load_checkpoint(self, path=None):
+        if not path:
+            path = cfg.model_path + '_resume.pkl'
+        self.ckpt_writer.flush()
+        all_state = torch.load(path, map_location='cpu')
+        self.m.load_state_dict(all_state['lstd'])
+        self.m_para.load_state_dict(all_state['lstd_para'])
+        self.train_state = all_state['train_state']
+        if len(all_state['optim']['param_groups']) == 1:
+            # the optimizer is rebuilt over self.m only on learning rate decay
+            self.optim = Adam(lr=self.train_state['lr'], params=filter(lambda x: x.requires_grad, self.m.parameters()),
+                              weight_decay=5e-5)
+        self.optim.load_state_dict(all_state['optim'])
+        set_rng_state(all_state['rng'])
+        logging.info('resume from epoch %d batch %d' % (self.train_state['epoch'], self.train_state['iter']))
+
     def training_adjust(self, epoch):
         return
 
@@ -564,6 +635,142 @@ class Model:
         print('total trainable params: %d' % param_cnt)
 
 
+# kept identical to MultiWOZ/model.py by MultiWOZ/tests/test_shared_helpers.py
+def cpu_snapshot(obj):
+    """
+    copy of a (nested) checkpoint state with every tensor copied to CPU memory, so training can go on
+    updating the originals while the copy is written
+    """
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        snapshot = type(obj)((k, cpu_snapshot(v)) for k, v in obj.items())
+        if hasattr(obj, '_metadata'):
+            snapshot._metadata = copy.deepcopy(obj._metadata)   # state_dict versions used by load_state_dict
+        return snapshot
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(cpu_snapshot(v) for v in obj)
+    return copy.deepcopy(obj)
+
+
+class CheckpointWriter(object):
+    """
+    Writes checkpoints from a background thread. save() only snapshots the state to CPU memory; each file is
+    written to a temp file and renamed, so a checkpoint on disk is always complete. Only the last keep_num files
+    of a series are kept (0 keeps all), and pending writes are flushed before loading and on exit.
+    """
+    def __init__(self, keep_num=0, asynchronous=True):
+        self.keep_num = keep_num
+        self.asynchronous = asynchronous
+        self.series = {}
+        self.error = None
+        if asynchronous:
+            self.queue = queue.Queue()
+            self.worker = threading.Thread(target=self._work, daemon=True)
+            self.worker.start()
+            atexit.register(self.close)
+
+    def save(self, state, path, series=None):
+        sw = time.time()
+        state = cpu_snapshot(state)
+        if self.asynchronous:
+            self.queue.put((state, path, series))
+        else:
+            self._write(state, path, series)
+        logging.info('checkpoint %s, training stalled %.3fs' % (path, time.time() - sw))
+
+    def flush(self):
+        if self.asynchronous:
+            self.queue.join()
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def close(self):
+        if self.asynchronous and self.worker.is_alive():
+            self.queue.put(None)
+            self.worker.join()
+
+    def _work(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                self._write(*item)
+            except Exception as e:
+                logging.error('checkpoint writing failed: %s' % e)
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def _write(self, state, path, series):
+        tmp_path = path + '.tmp'
+        torch.save(state, tmp_path)
+        os.replace(tmp_path, path)
+        if series is None:
+            return
+        paths = self.series.setdefault(series, [])
+        if path in paths:
+            paths.remove(path)
+        paths.append(path)
+        while self.keep_num and len(paths) > self.keep_num:
+            old_path = paths.pop(0)
+            if os.path.exists(old_path):
+                os.remove(old_path)
+
+
+# kept identical to MultiWOZ/model.py by MultiWOZ/tests/test_shared_helpers.py
+def set_cpu_threads(num_threads=0, interop_threads=0, cpus=None):
+    """
+    :param num_threads: intra-op threads of torch, 0 keeps the default
+    :param interop_threads: inter-op threads, 0 keeps the default (only settable in torch>=1.2, before any parallel work)
+    :param cpus: cpu ids to pin this process to
+    """
+    if num_threads:
+        torch.set_num_threads(num_threads)
+    if interop_threads and hasattr(torch, 'set_num_interop_threads'):
+        try:
+            torch.set_num_interop_threads(interop_threads)
+        except RuntimeError as e:
+            logging.warning('inter-op threads not set: %s' % e)
+    if cpus and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cpus)
+
+
+def quantize_dynamic(module):
+    """
+    int8 dynamic quantization of the nn.GRU and nn.Linear layers (encoders, decoders, output and copy projections)
+    for CPU inference. Layers this torch cannot quantize stay in fp32
+    """
+    quantization = getattr(torch, 'quantization', None)
+    if quantization is None or not hasattr(quantization, 'quantize_dynamic'):
+        logging.warning('dynamic quantization needs torch>=1.3, running in fp32')
+        return module
+    layers = {torch.nn.Linear}
+    if hasattr(torch.nn.quantized.dynamic, 'GRU'):
+        layers.add(torch.nn.GRU)
+    else:
+        logging.warning('this torch has no dynamic quantized GRU, GRUs stay in fp32')
+    return quantization.quantize_dynamic(module, layers, dtype=torch.qint8)
+
+
+# kept identical to MultiWOZ/model.py by MultiWOZ/tests/test_shared_helpers.py
+def get_rng_state():
+    return {'python': random.getstate(),
+            'numpy': np.random.get_state(),
+            'torch': torch.get_rng_state(),
+            'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else []}
+
+
+def set_rng_state(rng):
+    random.setstate(rng['python'])
+    np.random.set_state(rng['numpy'])
+    torch.set_rng_state(rng['torch'])
+    if rng['cuda'] and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(rng['cuda'])
+
+
 def main():
 
     parser = argparse.ArgumentParser()
@@ -592,6 +799,9 @@ def main():
         torch.cuda.set_device(cfg.cuda_device)
         logging.info('Device: {}'.format(torch.cuda.current_device()))
     cfg.mode = args.mode
+    if args.mode == 'test' and not cfg.cuda:
+        set_cpu_threads(cfg.infer_threads, cfg.infer_interop_threads,
+                        [int(c) for c in cfg.infer_cpus.split(',')] if cfg.infer_cpus else None)
 
     torch.manual_seed(cfg.seed)
     torch.cuda.manual_seed(cfg.seed)
@@ -604,6 +814,8 @@ def main():
         m.load_glove_embedding()
         # m.load_model(cfg.start_epoch)
         # m.load_model_para(cfg.para_start_epoch)
+        if cfg.resume and os.path.exists(cfg.model_path + '_resume.pkl'):
+            m.load_checkpoint()
         m.train()
     elif args.mode == 'adjust':
         m.load_model(cfg.start_epoch)
@@ -612,7 +824,12 @@ def main():
     elif args.mode == 'test':
         m.load_model(cfg.start_epoch)
         m.load_model_para(cfg.para_start_epoch)
-        m.eval()
+        if cfg.quantize and cfg.quantize_guard:
+            m.quantize_guard()
+        else:
+            if cfg.quantize:
+                m.quantize()
+            m.eval()
     elif args.mode == 'rl':
         m.load_model(cfg.start_epoch)
         m.load_model_para(cfg.para_start_epoch)
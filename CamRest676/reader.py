@@ -145,6 +145,7 @@ class _ReaderBase:
         self.vocab = self.Vocab()
         self.result_file = ''
         self.para_result_file = ''
+        self.batch_order = {}
 
     def _construct(self, *args):
         """
@@ -211,7 +212,11 @@ class _ReaderBase:
             dial_batch.append(turn_l)
         return dial_batch
 
-    def mini_batch_iterator(self, set_name):
+    def mini_batch_iterator(self, set_name, order=None, start=0):
+        """
+        :param order: batch order to replay, shuffled if None; the order used is kept in self.batch_order[set_name]
+        :param start: index of the first batch to yield
+        """
         name_to_set = {'train': self.train, 'test': self.test, 'dev': self.dev}
         dial = name_to_set[set_name]
         turn_bucket = self._bucket_by_turn(dial)
@@ -221,9 +226,12 @@ class _ReaderBase:
             batches = self._construct_mini_batch(turn_bucket[k])
             all_batches += batches
         self._mark_batch_as_supervised(all_batches)
-        random.shuffle(all_batches)
-        for i, batch in enumerate(all_batches):
-            yield self._transpose_batch(batch)
+        if order is None:
+            order = list(range(len(all_batches)))
+            random.shuffle(order)
+        self.batch_order[set_name] = order
+        for i in order[start:]:
+            yield self._transpose_batch(all_batches[i])
 
     def get_para_result(self, turn_batch, gen_p):
         results = []
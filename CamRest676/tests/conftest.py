@@ -0,0 +1,8 @@
+import os
+import sys
+
+# the modules of this codebase import each other by name and expect to run from its directory
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+os.makedirs('log', exist_ok=True)
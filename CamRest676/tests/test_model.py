@@ -0,0 +1,149 @@
+import logging
+import random
+import re
+
+import numpy as np
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from config import global_config as cfg
+cfg.init_handler('tsdf-camrest')
+cfg.cuda = False
+
+import model
+from model import Model, CheckpointWriter
+from reader import _ReaderBase
+
+
+class Interrupted(Exception):
+    pass
+
+
+class StubReader(_ReaderBase):
+    """
+    12 dialogues of two or three turns, batched and ordered by the real mini_batch_iterator. A generated paraphrase
+    is a draw from the python random stream
+    """
+    def __init__(self):
+        super(StubReader, self).__init__()
+        for dial_id in range(12):
+            self.train.append([{'dial_id': dial_id, 'x': dial_id + 0.1 * turn_num, 'delex_user': [1], 'bspan': [],
+                                'degree': [0.] * cfg.degree_size} for turn_num in range(2 + dial_id % 3 // 2)])
+
+    def get_para_result(self, turn_batch, gen_p):
+        return ['%.6f' % random.random() for _ in turn_batch['dial_id']]
+
+
+class StubDialogLoss(torch.nn.Module):
+    def __init__(self):
+        super(StubDialogLoss, self).__init__()
+        self.linear = torch.nn.Linear(2, 1)
+        self.losses = []
+
+    def self_adjust(self, epoch):
+        pass
+
+    def forward(self, u_input, para_dec, turn_states, **kwargs):
+        x = torch.stack([u_input + float(np.random.rand()), para_dec], dim=1)
+        loss = self.linear(torch.nn.functional.dropout(x, 0.5, True)).pow(2).mean()
+        self.losses.append(float(loss))
+        return loss, loss, loss, turn_states
+
+
+class StubParaLoss(torch.nn.Module):
+    def __init__(self):
+        super(StubParaLoss, self).__init__()
+        self.linear = torch.nn.Linear(1, 1)
+
+    def self_adjust(self, epoch):
+        pass
+
+    def forward(self, u_input, mode='train', **kwargs):
+        para_dec = self.linear(u_input.view(-1, 1)).view(-1)
+        return para_dec, None, para_dec.pow(2).mean()
+
+
+class StubModel(Model):
+    """
+    Model.train and its checkpoints over the stub reader and models, the turn losses drawing from the python, numpy
+    and torch random streams. Training raises Interrupted right after the checkpoint numbered interrupt_at
+    """
+    def __init__(self, seed, interrupt_at=0):
+        torch.manual_seed(seed)
+        self.reader = StubReader()
+        self.m, self.m_para = StubDialogLoss(), StubParaLoss()
+        self.optim = torch.optim.Adam([{'params': self.m.parameters()}, {'params': self.m_para.parameters()}],
+                                      lr=cfg.lr, weight_decay=5e-5)
+        self.base_epoch = -1
+        self.ckpt_writer = CheckpointWriter(asynchronous=False)
+        self.train_state = {'epoch': 0, 'iter': 0, 'batch_order': None, 'sup_loss': 0, 'sup_cnt': 0,
+                            'lr': cfg.lr, 'lr_para': cfg.lr_para, 'prev_min_loss': 1 << 30,
+                            'early_stop_count': cfg.early_stop_count}
+        self.saves, self.interrupt_at = 0, interrupt_at
+
+    def _convert_batch_para(self, py_batch, mode, prev_a_py=None):
+        u_input = torch.tensor(py_batch['x'])
+        return u_input, None, None, None, None, None
+
+    def _get_final_input(self, py_batch, para_results, epoch):
+        py_batch['final_user'] = para_results
+        return py_batch, 1.0
+
+    def _convert_batch(self, py_batch, prev_z_py=None, mode='train'):
+        u_input = torch.tensor(py_batch['x']) + torch.tensor([float(para) for para in py_batch['final_user']])
+        return u_input, None, None, None, None, None, None, None, {'z_input_np': None}, None
+
+    def validate(self, data='dev'):
+        # grows with the epochs, so the learning rate decays and the optimizer is rebuilt over self.m
+        return float(sum(p.pow(2).sum() for p in self.m.parameters())) + self.train_state['epoch'], 0.
+
+    def save_model(self, *args, **kwargs):
+        pass
+
+    def save_model_para(self, *args, **kwargs):
+        pass
+
+    def save_checkpoint(self, path=None):
+        Model.save_checkpoint(self, path)
+        self.saves += 1
+        if self.saves == self.interrupt_at:
+            raise Interrupted()
+
+
+def test_train_resume_continues_like_an_uninterrupted_run(tmp_path, monkeypatch, caplog):
+    for name, value in [('model_path', str(tmp_path / 'camrest')), ('batch_size', 2), ('epoch_num', 4),
+                        ('resume_interval', 1), ('early_stop_count', 1), ('spv_proportion', 100)]:
+        monkeypatch.setattr(cfg, name, value)
+    monkeypatch.setattr(model, 'get_sparse_input_aug', lambda u_input_np: torch.zeros(1))
+    monkeypatch.setattr(model, 'get_sparse_selective_input', lambda z_input_np, vocab: torch.zeros(1))
+    caplog.set_level(logging.INFO)
+
+    def epoch_logs():
+        logs = [re.match(r'(avg training|validation) loss in epoch \d+ .*', record.getMessage())
+                for record in caplog.records]
+        caplog.clear()
+        return [log.group(0) for log in logs if log]
+
+    random.seed(0)
+    np.random.seed(0)
+    full = StubModel(0)
+    full.train()
+    full_logs = epoch_logs()
+
+    random.seed(0)
+    np.random.seed(0)
+    # 6 batches and an epoch-end checkpoint per epoch: interrupted in epoch 2, after the optimizer was rebuilt
+    interrupted = StubModel(0, interrupt_at=17)
+    with pytest.raises(Interrupted):
+        interrupted.train()
+    resumed = StubModel(1)
+    resumed.load_checkpoint()
+    assert (resumed.train_state['epoch'], resumed.train_state['iter']) == (2, 3)
+    assert resumed.train_state['sup_cnt'] == interrupted.train_state['sup_cnt'] > 0
+    assert len(resumed.optim.param_groups) == 1
+    resumed.train()
+    # epochs 0 and 1 are skipped and epoch 2 goes on from its fourth batch
+    assert interrupted.m.losses + resumed.m.losses == full.m.losses
+    assert epoch_logs() == full_logs
+    assert len(full_logs) == 8
@@ -0,0 +1,266 @@
+import types
+
+import numpy as np
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from config import global_config as cfg
+cfg.init_handler('tsdf-camrest')
+cfg.cuda = False
+
+from reader import _ReaderBase
+from tsd_net import TSD, Paraphrase, get_sparse_input_aug, get_sparse_selective_input
+
+
+def finish_episode_single(log_probas, saved_rewards):
+    """
+    per-example episode loss of the original implementation
+    """
+    R = 0
+    policy_loss = []
+    rewards = []
+    for r in saved_rewards:
+        R = r + 0.8 * R
+        rewards.insert(0, R)
+
+    rewards = torch.Tensor(rewards)
+
+    for log_prob, reward in zip(log_probas, rewards):
+        policy_loss.append(-log_prob * reward)
+    l = len(policy_loss)
+    policy_loss = sum(policy_loss)
+    return policy_loss / l
+
+
+def test_finish_episode_matches_per_example():
+    torch.manual_seed(0)
+    for _ in range(20):
+        batch_size, max_len = 6, 9
+        length = torch.randint(1, max_len, (batch_size,)).long()
+        rewards = torch.rand(max_len + 1, batch_size)
+        log_probas = torch.randn(max_len, batch_size)
+        steps = torch.arange(max_len + 1).long().view(-1, 1)
+        rewards = rewards * (steps <= length.view(1, -1)).float()
+        log_probas = log_probas * (steps[:-1] < length.view(1, -1)).float()
+        num = int(length.max())
+
+        batched = TSD.finish_episode(None, list(log_probas[:num]), list(rewards[:num + 1]), length)
+        for b in range(batch_size):
+            n = int(length[b])
+            single = finish_episode_single([float(p) for p in log_probas[:n, b]],
+                                           [float(r) for r in rewards[:n + 1, b]])
+            assert abs(float(batched[b]) - float(single)) < 1e-5
+
+
+def eos_hidden_loop(hiddens, z_inputs, eos_idx):
+    """
+    hidden state after EOS_Z2 picked per row, as the original bspan decoding loop did
+    """
+    batch_size = z_inputs[0].size(0)
+    picked = [None] * batch_size
+    for last_hidden, z_tm1 in zip(hiddens, z_inputs):
+        z_np = z_tm1.view(-1).cpu().data.numpy()
+        for i in range(batch_size):
+            if z_np[i] == eos_idx:
+                picked[i] = last_hidden[:, i, :]
+    for i in range(batch_size):
+        if picked[i] is None:
+            picked[i] = hiddens[-1][:, i, :]
+    return torch.stack(picked, dim=1)
+
+
+def test_eos_hidden_matches_loop():
+    eos_idx = 3
+    for seed in range(10):
+        torch.manual_seed(seed)
+        batch_size, z_length, hidden_size = 7, 8, 5
+        hiddens = [torch.randn(1, batch_size, hidden_size) for _ in range(z_length)]
+        # few ids, so that rows see no, one or several EOS_Z2
+        z_inputs = [torch.randint(0, 6, (1, batch_size)).long() for _ in range(z_length)]
+        eos_step = torch.ones(batch_size).long() * -1
+        for t, z_tm1 in enumerate(z_inputs):
+            eos_step = eos_step.masked_fill(z_tm1.view(-1) == eos_idx, t)
+        assert torch.equal(TSD.eos_hidden(None, hiddens, eos_step), eos_hidden_loop(hiddens, z_inputs, eos_idx))
+
+
+class ScriptedDecoder:
+    """
+    decoder stub predicting a fixed id sequence and recording the inputs it is fed
+    """
+    def __init__(self, predictions, vocab_size):
+        self.predictions = predictions   # [T,B]
+        self.vocab_size = vocab_size
+        self.inputs = []
+
+    def forward(self, p_tm1, last_hidden, **kwargs):
+        self.inputs.append(p_tm1.clone())
+        pred = self.predictions[len(self.inputs) - 1]
+        proba = torch.zeros(pred.size(0), self.vocab_size + 10).scatter_(1, pred.view(-1, 1), 1.)
+        return None, last_hidden, proba
+
+
+def test_para_decode_feeds_back_clamped_predictions(monkeypatch):
+    monkeypatch.setattr(cfg, 'max_para_len', 6)
+    torch.manual_seed(0)
+    predictions = torch.randint(0, cfg.vocab_size + 10, (cfg.max_para_len, 4)).long()
+    decoder = ScriptedDecoder(predictions, cfg.vocab_size)
+    model = types.SimpleNamespace(p_decoder=decoder)
+    go = torch.ones(1, 4).long()
+    decoded = Paraphrase.para_decode(model, None, go, None, None, None, None, None)
+
+    assert [[int(w) for w in row] for row in decoded] == predictions.t().tolist()
+    unk_clamped = predictions.masked_fill(predictions >= cfg.vocab_size, 2)
+    assert torch.equal(torch.cat(decoder.inputs, 0), torch.cat([go, unk_clamped[:-1]], 0))
+
+
+GO, EOS, V = 7, 6, 8
+
+
+def next_word_table(rows):
+    """
+    [V,V] next word probabilities: rows maps a previous word to {word: probability}, the other words get 1e-6
+    and EOS 1e-9 unless listed
+    """
+    table = torch.ones(V, V) * 1e-6
+    table[:, EOS] = 1e-9
+    for prev, row in rows.items():
+        for word, p in row.items():
+            table[prev, word] = p
+    return table / table.sum(1, keepdim=True)
+
+
+def scripted_beam_search(tables, beam_size, max_len, req_ids=None):
+    """
+    runs TSD.batch_beam_search with a step_fn reading the next word probabilities of example b from tables[b]
+    """
+    batch_size = tables.size(0)
+    tsd = types.SimpleNamespace(beam_size=beam_size)
+    tsd.beam_index = lambda batch_size: TSD.beam_index(tsd, batch_size)
+    example = torch.arange(batch_size * beam_size).long() // beam_size
+
+    def step(t, z_tm1, last_hidden):
+        return tables[example, z_tm1.view(-1)], last_hidden, last_hidden
+
+    decoded, _, _ = TSD.batch_beam_search(tsd, step, GO, torch.zeros(1, batch_size, 3), batch_size, max_len, EOS,
+                                          req_ids=req_ids)
+    return decoded.tolist()
+
+
+def test_batch_beam_search_with_one_beam_is_greedy(monkeypatch):
+    monkeypatch.setattr(cfg, 'beam_len_bonus', 0.5)
+    torch.manual_seed(5)
+    max_len = 6
+    tables = torch.softmax(torch.randn(5, V, V) * 2, dim=2)
+    for b in range(5):
+        word, greedy = GO, []
+        for t in range(max_len):
+            word = int(tables[b, word].argmax())
+            greedy.append(word)
+            if word == EOS:
+                break
+        assert scripted_beam_search(tables[b:b + 1], 1, max_len)[0] == greedy + [0] * (max_len - len(greedy))
+    # the batch decodes its examples independently
+    assert scripted_beam_search(tables, 1, max_len) == [scripted_beam_search(tables[b:b + 1], 1, max_len)[0]
+                                                         for b in range(5)]
+
+
+def test_batch_beam_search_falls_back_from_finished_to_failed_to_live(monkeypatch):
+    monkeypatch.setattr(cfg, 'beam_len_bonus', 0.)
+    max_len = 5
+    tables = torch.stack([
+        # finished [5,EOS] wins over the failed [EOS], which scores higher
+        next_word_table({GO: {5: .5, EOS: .4, 1: .1}, 5: {EOS: .9, 2: .1}, 1: {EOS: .9, 2: .1},
+                         2: {2: .5, EOS: .5}}),
+        # word 5 is never decoded, the best failed hypothesis is returned
+        next_word_table({GO: {1: .5, 2: .3, 3: .2}, 1: {EOS: .9, 4: .1}, 2: {EOS: .9, 4: .1}, 3: {EOS: .9, 4: .1},
+                         4: {EOS: .9, 4: .1}}),
+        # EOS is never decoded, the best live beam is returned without EOS
+        next_word_table({GO: {1: .7, 2: .3}, 1: {1: .6, 2: .4}, 2: {2: .6, 1: .4}}),
+        # finished hypotheses keep the score of the beam they end: [1,EOS] wins over [2,EOS]
+        # although EOS is much more likely after 2
+        next_word_table({GO: {1: .6, 2: .37, 4: .03}, 1: {3: .7, EOS: .3}, 2: {EOS: .99}, 4: {EOS: .99},
+                         3: {3: .5, EOS: .5}}),
+    ])
+    req_ids = torch.LongTensor([[5], [5], [-1], [-1]])
+    assert scripted_beam_search(tables, 3, max_len, req_ids) == [[5, EOS, 0, 0, 0], [1, EOS, 0, 0, 0],
+                                                                 [1, 1, 1, 1, 1], [1, EOS, 0, 0, 0]]
+
+
+def get_sparse_input_aug_loop(x_input_np):
+    """
+    sparse input of the original implementation
+    """
+    ignore_index = [0]
+    unk = 2
+    result = np.zeros((x_input_np.shape[0], x_input_np.shape[1], cfg.vocab_size + x_input_np.shape[0]),
+                      dtype=np.float32)
+    result.fill(1e-10)
+    for t in range(x_input_np.shape[0]):
+        for b in range(x_input_np.shape[1]):
+            w = x_input_np[t][b]
+            if w not in ignore_index:
+                if w != unk:
+                    result[t][b][x_input_np[t][b]] = 1.0
+                else:
+                    result[t][b][cfg.vocab_size + t] = 1.0
+    result_np = result.transpose((1, 0, 2))
+    return torch.from_numpy(result_np).float()
+
+
+def get_sparse_selective_input_loop(x_input_np, vocab):
+    """
+    selective sparse input of the original implementation
+    """
+    result = np.zeros((x_input_np.shape[0], x_input_np.shape[1], cfg.vocab_size + x_input_np.shape[0]),
+                       dtype=np.float32)
+    result.fill(1e-10)
+    reqs = ['address', 'phone', 'postcode', 'pricerange', 'area']
+    for t in range(x_input_np.shape[0] - 1):
+        for b in range(x_input_np.shape[1]):
+            w = x_input_np[t][b]
+            word = vocab.decode(w)
+            if word in reqs:
+                slot = vocab.encode(word + '_SLOT')
+                result[t + 1][b][slot] = 1.0
+            else:
+                if w == 2 or w >= cfg.vocab_size:
+                    result[t + 1][b][cfg.vocab_size + t] = 5.0
+                else:
+                    result[t + 1][b][w] = 1.0
+    result_np = result.transpose((1, 0, 2))
+    return torch.from_numpy(result_np).float()
+
+
+def random_padded_input(rng, T, B, high, common=()):
+    """
+    [T,B] token ids below high with <unk>, many of the common words and trailing pads
+    """
+    x = rng.randint(1, high, size=(T, B))
+    if len(common):
+        picked = rng.rand(T, B) < 0.4
+        x[picked] = np.array(common)[rng.randint(len(common), size=int(picked.sum()))]
+    x[rng.rand(T, B) < 0.2] = 2   # <unk>
+    lengths = rng.randint(1, T + 1, size=B)
+    x[np.arange(T).reshape(-1, 1) >= lengths.reshape(1, -1)] = 0
+    return x
+
+
+def test_sparse_input_aug_matches_loop():
+    rng = np.random.RandomState(0)
+    for _ in range(10):
+        x = random_padded_input(rng, rng.randint(1, 20), rng.randint(1, 8), cfg.vocab_size)
+        assert torch.equal(get_sparse_input_aug(x), get_sparse_input_aug_loop(x))
+
+
+def test_sparse_selective_input_matches_loop():
+    vocab = _ReaderBase.Vocab()
+    reqs = ['address', 'phone', 'postcode', 'pricerange', 'area']
+    for w in reqs + [w + '_SLOT' for w in reqs] + ['food', 'name', 'EOS_Z1']:
+        vocab._absolute_add_item(w)
+    requested = [vocab.encode(w) for w in reqs]
+    rng = np.random.RandomState(0)
+    for _ in range(10):
+        # ids from cfg.vocab_size on are oov
+        x = random_padded_input(rng, rng.randint(1, 20), rng.randint(1, 8), cfg.vocab_size + 50, requested)
+        assert torch.equal(get_sparse_selective_input(x, vocab), get_sparse_selective_input_loop(x, vocab))
@@ -7,7 +7,7 @@ from torch.autograd import Variable
 import numpy as np
 import math
 from config import global_config as cfg
-import copy, random, time, logging
+import copy, random, time, logging, contextlib, functools
 
 from torch.distributions import Categorical
 from reader import pad_sequences
@@ -17,6 +17,80 @@ def cuda_(var):
     return var.cuda() if cfg.cuda else var
 
 
+# bf16 helpers, kept identical to MultiWOZ/damd_net.py by MultiWOZ/tests/test_shared_helpers.py
+_bf16_supported = None
+
+
+def bf16_enabled():
+    """
+    whether the bf16 CPU autocast of cfg.bf16 is in use: it needs torch.autocast (torch>=1.10) and a CPU with native
+    bf16 support, otherwise everything runs in fp32
+    """
+    global _bf16_supported
+    if not cfg.bf16 or cfg.cuda:
+        return False
+    if _bf16_supported is None:
+        _bf16_supported = hasattr(torch, 'autocast')
+        try:
+            _bf16_supported = _bf16_supported and torch.ops.mkldnn._is_mkldnn_bf16_supported()
+        except (AttributeError, RuntimeError):
+            pass
+        if not _bf16_supported:
+            logging.warning('bf16 autocast is not supported by this torch or CPU, running in fp32')
+    return _bf16_supported
+
+
+def autocast(enabled=True):
+    """
+    bf16 CPU autocast region if bf16_enabled(), enabled=False opens an fp32 region inside of one
+    """
+    if not bf16_enabled():
+        return contextlib.ExitStack()
+    return torch.autocast('cpu', dtype=torch.bfloat16, enabled=enabled)
+
+
+def bf16_autocast(forward):
+    """
+    run a forward method in the bf16 autocast region
+    """
+    @functools.wraps(forward)
+    def wrapper(*args, **kwargs):
+        with autocast():
+            return forward(*args, **kwargs)
+    return wrapper
+
+
+def fp32(func):
+    """
+    keep a numerically sensitive function out of the bf16 autocast region, with its floating point tensor
+    arguments (or lists of them) cast to fp32
+    """
+    def to_fp32(x):
+        if torch.is_tensor(x) and x.is_floating_point():
+            return x.float()
+        if isinstance(x, list):
+            return [to_fp32(v) for v in x]
+        return x
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not bf16_enabled():
+            return func(*args, **kwargs)
+        with autocast(enabled=False):
+            return func(*[to_fp32(a) for a in args], **{k: to_fp32(v) for k, v in kwargs.items()})
+    return wrapper
+
+
+@fp32
+def copy_score_sum(copy_score, sparse_input):
+    """
+    :param copy_score: exp copy scores [B,T]
+    :param sparse_input: [B,T,V_aug]
+    :return: copy scores summed onto the augmented vocabulary [B,V_aug]
+    """
+    return torch.bmm(copy_score.unsqueeze(1), sparse_input).squeeze(1)
+
+
 def toss_(p):
     return random.randint(0, 99) <= p
 
@@ -33,43 +107,38 @@ def get_sparse_input_aug(x_input_np):
     :param x_input_np: [T,B]
     :return: Numpy array: [B,T,aug_V]
     """
-    ignore_index = [0]
     unk = 2
-    result = np.zeros((x_input_np.shape[0], x_input_np.shape[1], cfg.vocab_size + x_input_np.shape[0]),
-                      dtype=np.float32)
+    T, B = x_input_np.shape
+    x_input_np = x_input_np.transpose((1, 0))  # [B,T]
+    result = np.zeros((B, T, cfg.vocab_size + T), dtype=np.float32)
     result.fill(1e-10)
-    for t in range(x_input_np.shape[0]):
-        for b in range(x_input_np.shape[1]):
-            w = x_input_np[t][b]
-            if w not in ignore_index:
-                if w != unk:
-                    result[t][b][x_input_np[t][b]] = 1.0
-                else:
-                    result[t][b][cfg.vocab_size + t] = 1.0
-    result_np = result.transpose((1, 0, 2))
-    result = torch.from_numpy(result_np).float()
+    # <unk> is copied from its position, <pad> is ignored
+    sparse_idx = np.where(x_input_np != unk, x_input_np, cfg.vocab_size + np.arange(T).reshape(1, -1))
+    bidx, tidx = np.nonzero(x_input_np != 0)
+    result[bidx, tidx, sparse_idx[bidx, tidx]] = 1.0
+    result = torch.from_numpy(result).float()
     return result
 
 
 def get_sparse_selective_input(x_input_np, vocab):
-    result = np.zeros((x_input_np.shape[0], x_input_np.shape[1], cfg.vocab_size + x_input_np.shape[0]),
-                       dtype=np.float32)
-    result.fill(1e-10)
     reqs = ['address', 'phone', 'postcode', 'pricerange', 'area']
-    for t in range(x_input_np.shape[0] - 1):
-        for b in range(x_input_np.shape[1]):
-            w = x_input_np[t][b]
-            word = vocab.decode(w)
-            if word in reqs:
-                slot = vocab.encode(word + '_SLOT')
-                result[t + 1][b][slot] = 1.0
-            else:
-                if w == 2 or w >= cfg.vocab_size:
-                    result[t + 1][b][cfg.vocab_size + t] = 5.0
-                else:
-                    result[t + 1][b][w] = 1.0
-    result_np = result.transpose((1, 0, 2))
-    result = torch.from_numpy(result_np).float()
+    T, B = x_input_np.shape
+    result = np.zeros((B, T, cfg.vocab_size + T), dtype=np.float32)
+    result.fill(1e-10)
+    # token t is copied at position t + 1
+    x_input_np = x_input_np[:-1].transpose((1, 0))  # [B,T-1]
+    # decode each distinct word once instead of each token
+    words, inverse = np.unique(x_input_np, return_inverse=True)
+    slots = np.array([vocab.encode(vocab.decode(w) + '_SLOT') if vocab.decode(w) in reqs else -1 for w in words],
+                     dtype=np.int64)
+    slot_idx = slots[inverse].reshape(x_input_np.shape)
+    oov = (x_input_np == 2) | (x_input_np >= cfg.vocab_size)
+    oov_idx = cfg.vocab_size + np.arange(T - 1).reshape(1, -1)
+    sparse_idx = np.where(slot_idx >= 0, slot_idx, np.where(oov, oov_idx, x_input_np))
+    sparse_val = np.where((slot_idx < 0) & oov, 5.0, 1.0)
+    bidx, tidx = np.indices(x_input_np.shape)
+    result[bidx, tidx + 1, sparse_idx] = sparse_val
+    result = torch.from_numpy(result).float()
     return result
 
 
@@ -190,7 +259,7 @@ class BSpanDecoder(nn.Module):
         return torch.from_numpy(position_enc).type(torch.FloatTensor)
 
     def forward(self, u_enc_out, z_tm1, last_hidden, u_input_np, pv_z_enc_out, prev_z_input_np, u_emb,
-                pv_z_emb, position, sparse_bspan, para_dec_out, para_input_np):
+                pv_z_emb, position, sparse_bspan, para_dec_out, para_input_np, sparse_pv_z=None):
 
         sparse_u_input = sparse_bspan
         context_para = self.attn_p(last_hidden, para_dec_out, mask=True, inp_seqs=para_input_np,
@@ -220,12 +289,9 @@ class BSpanDecoder(nn.Module):
         u_copy_score = F.tanh(self.proj_copy1(u_enc_out.transpose(0, 1)))  # [B,T,H]
         # stable version of copynet
         u_copy_score = torch.matmul(u_copy_score, gru_out.squeeze(0).unsqueeze(2)).squeeze(2)
-        u_copy_score = u_copy_score.cpu()
         u_copy_score_max = torch.max(u_copy_score, dim=1, keepdim=True)[0]
         u_copy_score = torch.exp(u_copy_score - u_copy_score_max)  # [B,T]
-        u_copy_score = torch.log(torch.bmm(u_copy_score.unsqueeze(1), sparse_u_input)).squeeze(
-            1) + u_copy_score_max  # [B,V]
-        u_copy_score = cuda_(u_copy_score)
+        u_copy_score = torch.log(copy_score_sum(u_copy_score, sparse_u_input)) + u_copy_score_max  # [B,V]
         if pv_z_enc_out is None:
             # u_copy_score = self.inp_dropout(u_copy_score)
             scores = F.softmax(torch.cat([gen_score, u_copy_score], dim=1), dim=1)
@@ -234,15 +300,11 @@ class BSpanDecoder(nn.Module):
             proba = gen_score + u_copy_score[:, :cfg.vocab_size]  # [B,V]
             proba = torch.cat([proba, u_copy_score[:, cfg.vocab_size:]], 1)
         else:
-            sparse_pv_z_input = Variable(get_sparse_input_aug(prev_z_input_np), requires_grad=False)
             pv_z_copy_score = F.tanh(self.proj_copy2(pv_z_enc_out.transpose(0, 1)))  # [B,T,H]
             pv_z_copy_score = torch.matmul(pv_z_copy_score, gru_out.squeeze(0).unsqueeze(2)).squeeze(2)
-            pv_z_copy_score = pv_z_copy_score.cpu()
             pv_z_copy_score_max = torch.max(pv_z_copy_score, dim=1, keepdim=True)[0]
             pv_z_copy_score = torch.exp(pv_z_copy_score - pv_z_copy_score_max)  # [B,T]
-            pv_z_copy_score = torch.log(torch.bmm(pv_z_copy_score.unsqueeze(1), sparse_pv_z_input)).squeeze(
-                1) + pv_z_copy_score_max  # [B,V]
-            pv_z_copy_score = cuda_(pv_z_copy_score)
+            pv_z_copy_score = torch.log(copy_score_sum(pv_z_copy_score, sparse_pv_z)) + pv_z_copy_score_max  # [B,V]
             scores = F.softmax(torch.cat([gen_score, u_copy_score, pv_z_copy_score], dim=1), dim=1)
             gen_score, u_copy_score, pv_z_copy_score = scores[:, :cfg.vocab_size], \
                                                        scores[:,
@@ -281,12 +343,9 @@ class ResponseDecoder(nn.Module):
         gen_score = self.proj(torch.cat([z_context, u_context, gru_out], 2)).squeeze(0)
         z_copy_score = F.tanh(self.proj_copy2(z_enc_out.transpose(0, 1)))
         z_copy_score = torch.matmul(z_copy_score, gru_out.squeeze(0).unsqueeze(2)).squeeze(2)
-        z_copy_score = z_copy_score.cpu()
         z_copy_score_max = torch.max(z_copy_score, dim=1, keepdim=True)[0]
         z_copy_score = torch.exp(z_copy_score - z_copy_score_max)  # [B,T]
-        z_copy_score = torch.log(torch.bmm(z_copy_score.unsqueeze(1), sparse_z_input)).squeeze(
-            1) + z_copy_score_max  # [B,V]
-        z_copy_score = cuda_(z_copy_score)
+        z_copy_score = torch.log(copy_score_sum(z_copy_score, sparse_z_input)) + z_copy_score_max  # [B,V]
 
         scores = F.softmax(torch.cat([gen_score, z_copy_score], dim=1), dim=1)
         gen_score, z_copy_score = scores[:, :cfg.vocab_size], \
@@ -329,12 +388,9 @@ class ActDecoder(nn.Module):
         u_copy_score = F.tanh(self.proj_copy(u_enc_out.transpose(0, 1)))  # [B,T,H]
         # stable version of copynet
         u_copy_score = torch.matmul(u_copy_score, gru_out.squeeze(0).unsqueeze(2)).squeeze(2)
-        u_copy_score = u_copy_score.cpu()
         u_copy_score_max = torch.max(u_copy_score, dim=1, keepdim=True)[0]
         u_copy_score = torch.exp(u_copy_score - u_copy_score_max)  # [B,T]
-        u_copy_score = torch.log(torch.bmm(u_copy_score.unsqueeze(1), sparse_u_input)).squeeze(
-            1) + u_copy_score_max  # [B,V]
-        u_copy_score = cuda_(u_copy_score)
+        u_copy_score = torch.log(copy_score_sum(u_copy_score, sparse_u_input)) + u_copy_score_max  # [B,V]
 
         # u_copy_score = self.inp_dropout(u_copy_score)
         scores = F.softmax(torch.cat([gen_score, u_copy_score], dim=1), dim=1)
@@ -382,12 +438,9 @@ class ParaDecoder(nn.Module):
         u_copy_score = F.tanh(self.proj_copy(u_enc_out.transpose(0, 1)))  # [B,T,H]
         # stable version of copynet
         u_copy_score = torch.matmul(u_copy_score, gru_out.squeeze(0).unsqueeze(2)).squeeze(2)
-        u_copy_score = u_copy_score.cpu()
         u_copy_score_max = torch.max(u_copy_score, dim=1, keepdim=True)[0]
         u_copy_score = torch.exp(u_copy_score - u_copy_score_max)  # [B,T]
-        u_copy_score = torch.log(torch.bmm(u_copy_score.unsqueeze(1), sparse_u_input)).squeeze(
-            1) + u_copy_score_max  # [B,V]
-        u_copy_score = cuda_(u_copy_score)
+        u_copy_score = torch.log(copy_score_sum(u_copy_score, sparse_u_input)) + u_copy_score_max  # [B,V]
 
         # u_copy_score = self.inp_dropout(u_copy_score)
         scores = F.softmax(torch.cat([gen_score, u_copy_score], dim=1), dim=1)
@@ -419,6 +472,7 @@ class Paraphrase(nn.Module):
         self.para_loss = nn.NLLLoss(ignore_index=0)
         self.act_loss = nn.NLLLoss(ignore_index=0)
 
+    @bf16_autocast
     def forward(self, u_input, u_input_np, para_input, prev_act_input, u_len, mode, sparse_u_input_para):
         if mode == 'train':
             para_dec, para_index, para_proba, prev_act_proba = \
@@ -503,9 +557,7 @@ class Paraphrase(nn.Module):
                 a_proba, a_index = torch.topk(proba, 1)
                 a_index = a_index.data.view(-1)
                 decoded_act.append(a_index.clone())
-                for i in range(a_index.size(0)):
-                    if a_index[i] >= cfg.vocab_size or a_index[i] < 0:
-                        a_index[i] = 2  # unk
+                a_index = torch.where(a_index >= cfg.vocab_size, torch.full_like(a_index, 2), a_index)  # unk
                 a_tml = cuda_(Variable(a_index).view(1, -1))
 
             a_input_np = prev_act_input.cpu().data.numpy()
@@ -525,9 +577,8 @@ class Paraphrase(nn.Module):
                 parat_proba, parat_index = torch.topk(proba, 1)  # [B,1]
                 parat_index = parat_index.data.view(-1)
                 decoded.append(parat_index.clone())
-                for i in range(parat_index.size(0)):
-                    if parat_index[i] >= cfg.vocab_size or parat_index[i] < 0:
-                        parat_index[i] = 2  # unk
+                parat_index = torch.where(parat_index >= cfg.vocab_size, torch.full_like(parat_index, 2),
+                                          parat_index)  # unk
                 p_tm1 = cuda_(Variable(parat_index).view(1, -1))
 
             para_dec_outs = torch.cat(para_dec_outs, dim=0)
@@ -545,14 +596,14 @@ class Paraphrase(nn.Module):
             parat_proba, parat_index = torch.topk(proba, 1)  # [B,1]
             parat_index = parat_index.data.view(-1)
             decoded.append(parat_index.clone())
-            for i in range(parat_index.size(0)):
-                if parat_index[i] >= cfg.vocab_size:
-                    parat_index[i] = 2  # unk
-            u_tm1 = cuda_(Variable(parat_index).view(1, -1))
+            parat_index = torch.where(parat_index >= cfg.vocab_size, torch.full_like(parat_index, 2),
+                                      parat_index)  # unk
+            p_tm1 = cuda_(Variable(parat_index).view(1, -1))
         decoded = torch.stack(decoded, dim=0).transpose(0, 1)
         decoded = list(decoded)
         return [list(_) for _ in decoded]
 
+    @fp32
     def supervised_loss(self, para_proba, prev_act_proba, para_input, prev_act_input):
         para_proba = para_proba[:, :, :cfg.vocab_size].contiguous()
         prev_act_proba = prev_act_proba[:, :, :cfg.vocab_size].contiguous()
@@ -583,6 +634,7 @@ class TSD(nn.Module):
         self.z_length = z_length
         self.max_ts = max_ts
         self.beam_search = beam_search
+        self.bspan_beam_search = kwargs.get('bspan_beam_search', False)
         self.teacher_force = teacher_force
 
         self.pr_loss = nn.NLLLoss(ignore_index=0)
@@ -590,10 +642,11 @@ class TSD(nn.Module):
 
         self.saved_log_policy = []
 
-        if self.beam_search:
+        if self.beam_search or self.bspan_beam_search:
             self.beam_size = kwargs['beam_size']
             self.eos_token_idx = kwargs['eos_token_idx']
 
+    @bf16_autocast
     def forward(self, u_input, u_input_np, m_input, m_input_np, z_input, u_len, m_len, turn_states,
                 degree_input, mode, domain, sparse_bspan, sparse_response, para_dec, para_input_np, **kwargs):
         if mode == 'train' or mode == 'valid':
@@ -649,9 +702,11 @@ class TSD(nn.Module):
         pv_z_emb = None
         batch_size = u_input.size(1)
         pv_z_enc_out = None
+        sparse_pv_z = None
 
         if prev_z_input is not None:
             pv_z_enc_out, _, pv_z_emb = self.u_encoder(prev_z_input, prev_z_len)
+            sparse_pv_z = cuda_(Variable(get_sparse_input_aug(prev_z_input_np), requires_grad=False))
         u_enc_out, u_enc_hidden, u_emb = self.u_encoder(u_input, u_len)
         last_hidden = u_enc_hidden[:-1]
         z_tm1 = cuda_(Variable(torch.ones(1, batch_size).long() * 3))  # GO_2 token
@@ -660,25 +715,22 @@ class TSD(nn.Module):
             pz_dec_outs = []
             pz_proba = []
             z_length = z_input.size(0) if z_input is not None else self.z_length  # GO token
-            hiddens = [None] * batch_size
+            hiddens = []
+            eos_step = cuda_(torch.ones(batch_size).long() * -1)
             for t in range(z_length):
                 pz_dec_out, last_hidden, proba = \
                     self.z_decoder(u_enc_out=u_enc_out, u_input_np=u_input_np,
                                    z_tm1=z_tm1, last_hidden=last_hidden,
                                    para_dec_out=para_dec, para_input_np=para_input_np,
                                    pv_z_enc_out=pv_z_enc_out, prev_z_input_np=prev_z_input_np,
-                                   u_emb=u_emb, pv_z_emb=pv_z_emb, position=t, sparse_bspan=sparse_bspan)
+                                   u_emb=u_emb, pv_z_emb=pv_z_emb, position=t, sparse_bspan=sparse_bspan,
+                                   sparse_pv_z=sparse_pv_z)
                 pz_proba.append(proba)
                 pz_dec_outs.append(pz_dec_out)
-                z_np = z_tm1.view(-1).cpu().data.numpy()
-                for i in range(batch_size):
-                    if z_np[i] == self.vocab.encode('EOS_Z2'):
-                        hiddens[i] = last_hidden[:, i, :]
+                hiddens.append(last_hidden)
+                eos_step = eos_step.masked_fill(z_tm1.data.view(-1) == self.vocab.encode('EOS_Z2'), t)
                 z_tm1 = z_input[t].view(1, -1)
-            for i in range(batch_size):
-                if hiddens[i] is None:
-                    hiddens[i] = last_hidden[:, i, :]
-            last_hidden = torch.stack(hiddens, dim=1)
+            last_hidden = self.eos_hidden(hiddens, eos_step)
 
             z_input_np = z_input.cpu().data.numpy()
 
@@ -704,13 +756,15 @@ class TSD(nn.Module):
             pm_dec_proba = torch.stack(pm_dec_proba, dim=0)  # [T,B,V]
             return pz_proba, pm_dec_proba, None
         else:
-            pz_dec_outs, bspan_index, last_hidden = self.bspan_decoder(u_enc_out, z_tm1, last_hidden, u_input_np,
-                                                                       pv_z_enc_out=pv_z_enc_out,
-                                                                       prev_z_input_np=prev_z_input_np,
-                                                                       para_dec_out=para_dec,
-                                                                       para_input_np=para_input_np,
-                                                                       u_emb=u_emb, pv_z_emb=pv_z_emb,
-                                                                       sparse_bspan=sparse_bspan)
+            bspan_decoder = self.bspan_beam_decoder if self.bspan_beam_search else self.bspan_decoder
+            pz_dec_outs, bspan_index, last_hidden = bspan_decoder(u_enc_out, z_tm1, last_hidden, u_input_np,
+                                                                  pv_z_enc_out=pv_z_enc_out,
+                                                                  prev_z_input_np=prev_z_input_np,
+                                                                  para_dec_out=para_dec,
+                                                                  para_input_np=para_input_np,
+                                                                  u_emb=u_emb, pv_z_emb=pv_z_emb,
+                                                                  sparse_bspan=sparse_bspan,
+                                                                  sparse_pv_z=sparse_pv_z)
             pz_dec_outs = torch.cat(pz_dec_outs, dim=0)
             if cfg.dataset == "camrest":
                 degree_input = self.reader.db_degree_handler(bspan_index, kwargs['dial_id'])
@@ -732,46 +786,50 @@ class TSD(nn.Module):
                                             degree_input, bspan_index)
 
     def bspan_decoder(self, u_enc_out, z_tm1, last_hidden, u_input_np, pv_z_enc_out, prev_z_input_np, u_emb, pv_z_emb,
-                      sparse_bspan, para_dec_out, para_input_np):
+                      sparse_bspan, para_dec_out, para_input_np, sparse_pv_z=None):
         pz_dec_outs = []
         pz_proba = []
         decoded = []
         batch_size = u_enc_out.size(1)
-        hiddens = [None] * batch_size
+        hiddens = []
+        eos_step = cuda_(torch.ones(batch_size).long() * -1)
         for t in range(cfg.z_length):
             pz_dec_out, last_hidden, proba = \
                 self.z_decoder(u_enc_out=u_enc_out, u_input_np=u_input_np,
                                z_tm1=z_tm1, last_hidden=last_hidden, pv_z_enc_out=pv_z_enc_out,
                                prev_z_input_np=prev_z_input_np, u_emb=u_emb, pv_z_emb=pv_z_emb, position=t,
                                para_dec_out=para_dec_out, para_input_np=para_input_np,
-                               sparse_bspan=sparse_bspan)
+                               sparse_bspan=sparse_bspan, sparse_pv_z=sparse_pv_z)
             pz_proba.append(proba)
             pz_dec_outs.append(pz_dec_out)
             z_proba, z_index = torch.topk(proba, 1)  # [B,1]
             z_index = z_index.data.view(-1)
             decoded.append(z_index.clone())
-            for i in range(z_index.size(0)):
-                if z_index[i] >= cfg.vocab_size or z_index[i] < 0:
-                    z_index[i] = 2  # unk
-            z_np = z_tm1.view(-1).cpu().data.numpy()
-            for i in range(batch_size):
-                if z_np[i] == self.vocab.encode('EOS_Z2'):
-                    hiddens[i] = last_hidden[:, i, :]
+            z_index = z_index.masked_fill((z_index >= cfg.vocab_size) | (z_index < 0), 2)  # unk
+            hiddens.append(last_hidden)
+            eos_step = eos_step.masked_fill(z_tm1.data.view(-1) == self.vocab.encode('EOS_Z2'), t)
             z_tm1 = cuda_(Variable(z_index).view(1, -1))
-        for i in range(batch_size):
-            if hiddens[i] is None:
-                hiddens[i] = last_hidden[:, i, :]
-        last_hidden = torch.stack(hiddens, dim=1)
+        last_hidden = self.eos_hidden(hiddens, eos_step)
         decoded = torch.stack(decoded, dim=0).transpose(0, 1)
         decoded = list(decoded)
         decoded = [list(_) for _ in decoded]
         return pz_dec_outs, decoded, last_hidden
 
+    def eos_hidden(self, hiddens, eos_step):
+        """
+        :param hiddens: list of [1,B,H] hidden states after each bspan step
+        :param eos_step: [B] last step fed with EOS_Z2, -1 if there is none
+        :return: [1,B,H] hidden state after EOS_Z2, the final one for rows without it
+        """
+        hiddens = torch.cat(hiddens, dim=0)  # [T,B,H]
+        eos_step = eos_step.masked_fill(eos_step < 0, hiddens.size(0) - 1)
+        return hiddens.gather(0, eos_step.view(1, -1, 1).expand(1, hiddens.size(1), hiddens.size(2)))
+
     def greedy_decode(self, pz_dec_outs, u_enc_out, m_tm1, u_input_np, last_hidden, degree_input, bspan_index):
         decoded = []
         bspan_index_np = pad_sequences(bspan_index).transpose((1, 0))
-        sparse_response = Variable(get_sparse_selective_input(bspan_index_np, self.reader.vocab),
-                                    requires_grad=False)
+        sparse_response = cuda_(Variable(get_sparse_selective_input(bspan_index_np, self.reader.vocab),
+                                         requires_grad=False))
         for t in range(self.max_ts):
             proba, last_hidden, _ = self.m_decoder(pz_dec_outs, u_enc_out, u_input_np, m_tm1,
                                                    degree_input, last_hidden, bspan_index_np,
@@ -779,129 +837,183 @@ class TSD(nn.Module):
             mt_proba, mt_index = torch.topk(proba, 1)  # [B,1]
             mt_index = mt_index.data.view(-1)
             decoded.append(mt_index.clone())
-            for i in range(mt_index.size(0)):
-                if mt_index[i] >= cfg.vocab_size or mt_index[i] < 0:
-                    mt_index[i] = 2  # unk
+            mt_index = mt_index.masked_fill((mt_index >= cfg.vocab_size) | (mt_index < 0), 2)  # unk
             m_tm1 = cuda_(Variable(mt_index).view(1, -1))
         decoded = torch.stack(decoded, dim=0).transpose(0, 1)
         decoded = list(decoded)
         return [list(_) for _ in decoded]
 
-    def beam_search_decode_single(self, pz_dec_outs, u_enc_out, m_tm1, u_input_np, last_hidden, degree_input,
-                                  bspan_index, sparse_response):
-        eos_token_id = self.vocab.encode(cfg.eos_m_token)
-        batch_size = pz_dec_outs.size(1)
-        if batch_size != 1:
-            raise ValueError('"Beam search single" requires batch size to be 1')
-
-        class BeamState:
-            def __init__(self, score, last_hidden, decoded, length):
-                """
-                Beam state in beam decoding
-                :param score: sum of log-probabilities
-                :param last_hidden: last hidden
-                :param decoded: list of *Variable[1*1]* of all decoded words
-                :param length: current decoded sentence length
-                """
-                self.score = score
-                self.last_hidden = last_hidden
-                self.decoded = decoded
-                self.length = length
-
-            def update_clone(self, score_incre, last_hidden, decoded_t):
-                decoded = copy.copy(self.decoded)
-                decoded.append(decoded_t)
-                clone = BeamState(self.score + score_incre, last_hidden, decoded, self.length + 1)
-                return clone
-
-        def beam_result_valid(decoded_t, bspan_index):
-            decoded_t = [_.view(-1).data[0] for _ in decoded_t]
-            req_slots = self.get_req_slots(bspan_index)
-            decoded_sentence = self.vocab.sentence_decode(decoded_t, cfg.eos_m_token)
-            for req in req_slots:
-                if req not in decoded_sentence:
-                    return False
-            return True
-
-        def score_bonus(state, decoded, bspan_index):
-            bonus = cfg.beam_len_bonus
-            return bonus
-
-        def soft_score_incre(score, turn):
-            return score
-
-        finished, failed = [], []
-        states = []  # sorted by score decreasingly
-        dead_k = 0
-        states.append(BeamState(0, last_hidden, [m_tm1], 0))
-        bspan_index_np = np.array(bspan_index).reshape(-1, 1)
-        for t in range(self.max_ts):
-            new_states = []
-            k = 0
-            while k < len(states) and k < self.beam_size - dead_k:
-                state = states[k]
-                last_hidden, m_tm1 = state.last_hidden, state.decoded[-1]
-                proba, last_hidden, _ = self.m_decoder(pz_dec_outs, u_enc_out, u_input_np, m_tm1, degree_input,
-                                                       last_hidden, bspan_index_np, sparse_response=sparse_response)
-
-                proba = torch.log(proba)
-                mt_proba, mt_index = torch.topk(proba, self.beam_size - dead_k)  # [1,K]
-                for new_k in range(self.beam_size - dead_k):
-                    score_incre = soft_score_incre(mt_proba[0][new_k].data[0], t) + score_bonus(state,
-                                                                                                mt_index[0][new_k].data[
-                                                                                                    0], bspan_index)
-                    if len(new_states) >= self.beam_size - dead_k and state.score + score_incre < new_states[-1].score:
-                        break
-                    decoded_t = mt_index[0][new_k]
-                    if decoded_t.data[0] >= cfg.vocab_size:
-                        decoded_t.data[0] = 2  # unk
-                    if self.vocab.decode(decoded_t.data[0]) == cfg.eos_m_token:
-                        if beam_result_valid(state.decoded, bspan_index):
-                            finished.append(state)
-                            dead_k += 1
-                        else:
-                            failed.append(state)
-                    else:
-                        decoded_t = decoded_t.view(1, -1)
-                        new_state = state.update_clone(score_incre, last_hidden, decoded_t)
-                        new_states.append(new_state)
-
-                k += 1
-            if self.beam_size - dead_k < 0:
+    def beam_index(self, batch_size):
+        """
+        :return: [B*K], position in the batch of every hypothesis, the K beams of an example are contiguous
+        """
+        return cuda_(torch.arange(batch_size).long().view(-1, 1).repeat(1, self.beam_size).view(-1))
+
+    def batch_beam_search(self, step_fn, go_idx, last_hidden, batch_size, max_len, eos_idx, req_ids=None):
+        """
+        batched beam search over [B*K] hypotheses, shared by the bspan and response decoders.
+        every decoded token scores its log-probability plus cfg.beam_len_bonus. Among the top K candidates of an
+        example, those within its live width that end with eos are finished when they contain all req_ids (and
+        take one beam off the example), failed otherwise; the live beams are the top non-eos candidates.
+        As in the single-example search, a finished or failed hypothesis keeps the score of the beam it ends,
+        without the eos log-probability and bonus. Deliberate deviations from that search: req_ids are matched
+        as tokens where it looked for the slot names as substrings of the decoded sentence, and the eos
+        candidates are taken from the top K over all beams instead of each beam's own expansion.
+        :param step_fn: (t, z_tm1 [1,B*K], last_hidden [1,B*K,H]) -> proba [B*K,V_aug], last_hidden, dec_out [1,B*K,H]
+        :param last_hidden: [1,B,H]
+        :param req_ids: [B,R] tokens a finished hypothesis must contain, -1 for padding
+        :return: decoded [B,max_len] ending with eos and padded with 0, dec_outs [max_len,B,H], last_hidden [1,B,H].
+            An example with no hypothesis ending in eos falls back to its best live beam, which has run for max_len
+            steps: its max_len tokens have no eos, like a greedy decoding cut at max_len
+        """
+        K, B, H = self.beam_size, batch_size, last_hidden.size(2)
+        inf = float('inf')
+        if req_ids is None:
+            req_ids = cuda_(torch.ones(B, 1).long() * -1)
+        R = req_ids.size(1)
+        beam_idx = self.beam_index(B)
+        beam_offset = cuda_(torch.arange(B).long().view(-1, 1) * K)  # [B,1]
+        rank = cuda_(torch.arange(K).long().view(1, -1))  # [1,K]
+        req_ids = req_ids.index_select(0, beam_idx)  # [B*K,R]
+        hit = (req_ids < 0).long()
+        scores = cuda_(torch.zeros(B, K))
+        scores[:, 1:] = -inf  # all beams start from the same go token
+        width = cuda_(torch.ones(B).long() * K)  # live beams of each example
+        tokens, dec_outs = cuda_(torch.zeros(B * K, 0).long()), cuda_(torch.zeros(B * K, 0, H))
+        last_hidden = last_hidden.index_select(1, beam_idx)
+        z_tm1 = cuda_(Variable(torch.ones(1, B * K).long() * go_idx))
+
+        def new_pool():
+            return {'score': cuda_(torch.ones(B) * -inf), 'tokens': cuda_(torch.zeros(B, max_len).long()),
+                    'dec_outs': cuda_(torch.zeros(B, max_len, H)), 'last_hidden': cuda_(torch.zeros(B, H))}
+
+        def merge(pool, cond, score, tokens, dec_outs, last_hidden):
+            # take the candidate of example b where cond[b], candidates are padded to max_len
+            pad = max_len - tokens.size(1)
+            tokens = torch.cat([tokens, tokens.new_zeros(B, pad)], 1)
+            dec_outs = torch.cat([dec_outs, dec_outs.new_zeros(B, pad, H)], 1)
+            pool['score'] = torch.where(cond, score, pool['score'])
+            pool['tokens'] = torch.where(cond.view(-1, 1), tokens, pool['tokens'])
+            pool['dec_outs'] = torch.where(cond.view(-1, 1, 1), dec_outs, pool['dec_outs'])
+            pool['last_hidden'] = torch.where(cond.view(-1, 1), last_hidden, pool['last_hidden'])
+
+        def record(pool, mask, score, tokens, dec_outs, last_hidden):
+            best_score, best_k = score.masked_fill(mask == 0, -inf).max(1)  # [B]
+            best = beam_offset.view(-1) + best_k
+            merge(pool, best_score > pool['score'], best_score, tokens.index_select(0, best),
+                  dec_outs.index_select(0, best), last_hidden.index_select(0, best))
+
+        finished, failed = new_pool(), new_pool()
+        for t in range(max_len):
+            proba, last_hidden, dec_out = step_fn(t, z_tm1, last_hidden)
+            V_aug = proba.size(1)
+            dec_out, hidden = dec_out.data.squeeze(0), last_hidden.data.squeeze(0)  # [B*K,H]
+            cand = (scores.view(-1, 1) + torch.log(proba.data) + cfg.beam_len_bonus).view(B, -1)  # [B,K*V_aug]
+
+            # hypotheses ending here
+            top_score, top_idx = cand.topk(K, dim=1)  # [B,K]
+            parent = (beam_offset + top_idx // V_aug).view(-1)
+            ends = (rank < width.view(-1, 1)) & (top_idx % V_aug == eos_idx) & (top_score > -inf)
+            complete = (hit.index_select(0, parent).sum(1) == R).view(B, K)
+            end_tokens = torch.cat([tokens.index_select(0, parent), tokens.new_ones(B * K, 1) * eos_idx], 1)
+            end_outs = torch.cat([dec_outs.index_select(0, parent), dec_out.index_select(0, parent).unsqueeze(1)], 1)
+            end_hidden = hidden.index_select(0, parent)
+            end_score = scores.view(-1).index_select(0, parent).view(B, K)  # score of the ended beam, without eos
+            record(finished, ends & complete, end_score, end_tokens, end_outs, end_hidden)
+            record(failed, ends & (complete == 0), end_score, end_tokens, end_outs, end_hidden)
+            width = width - (ends & complete).long().sum(1)
+            if (width > 0).long().sum().item() == 0:
                 break
-            new_states = new_states[:self.beam_size - dead_k]
-            new_states.sort(key=lambda x: -x.score)
-            states = new_states
-
-            if t == self.max_ts - 1 and not finished:
-                finished = failed
-                print('FAIL')
-                if not finished:
-                    finished.append(states[0])
-
-        finished.sort(key=lambda x: -x.score)
-        decoded_t = finished[0].decoded
-        decoded_t = [_.view(-1).data[0] for _ in decoded_t]
-        decoded_sentence = self.vocab.sentence_decode(decoded_t, cfg.eos_m_token)
-        print(decoded_sentence)
-        generated = torch.cat(finished[0].decoded, dim=1).data  # [B=1, T]
-        return generated
+
+            # live hypotheses
+            cand.view(B, K, V_aug)[:, :, eos_idx] = -inf
+            scores, live_idx = cand.topk(K, dim=1)
+            scores = scores.masked_fill(rank >= width.view(-1, 1), -inf)
+            parent = (beam_offset + live_idx // V_aug).view(-1)
+            z_index = (live_idx % V_aug).view(-1)
+            z_index = z_index.masked_fill(z_index >= cfg.vocab_size, 2)  # unk
+            tokens = torch.cat([tokens.index_select(0, parent), z_index.view(-1, 1)], 1)
+            dec_outs = torch.cat([dec_outs.index_select(0, parent), dec_out.index_select(0, parent).unsqueeze(1)], 1)
+            hit = torch.max(hit.index_select(0, parent), (req_ids == z_index.view(-1, 1)).long())
+            last_hidden = last_hidden.index_select(1, parent)
+            z_tm1 = cuda_(Variable(z_index).view(1, -1))
+
+        # examples without a finished hypothesis fall back to the best failed one, then to the best live beam (no eos)
+        merge(finished, finished['score'] == -inf, failed['score'], failed['tokens'], failed['dec_outs'],
+              failed['last_hidden'])
+        best = beam_offset.view(-1)
+        merge(finished, finished['score'] == -inf, scores[:, 0], tokens.index_select(0, best),
+              dec_outs.index_select(0, best), last_hidden.data.squeeze(0).index_select(0, best))
+        return finished['tokens'], cuda_(Variable(finished['dec_outs'].transpose(0, 1))), \
+               cuda_(Variable(finished['last_hidden'].unsqueeze(0)))
+
+    def bspan_beam_decoder(self, u_enc_out, z_tm1, last_hidden, u_input_np, pv_z_enc_out, prev_z_input_np, u_emb,
+                           pv_z_emb, sparse_bspan, para_dec_out, para_input_np, sparse_pv_z=None):
+        """
+        beam search counterpart of bspan_decoder, the returned hidden is the one that produced EOS_Z2
+        """
+        batch_size = u_enc_out.size(1)
+        beam_idx = self.beam_index(batch_size)
+        u_enc_out, u_input_np = u_enc_out.index_select(1, beam_idx), np.repeat(u_input_np, self.beam_size, 1)
+        para_dec_out = para_dec_out.index_select(1, beam_idx)
+        para_input_np = np.repeat(para_input_np, self.beam_size, 1)
+        sparse_bspan = sparse_bspan.index_select(0, beam_idx)
+        if pv_z_enc_out is not None:
+            pv_z_enc_out = pv_z_enc_out.index_select(1, beam_idx)
+            prev_z_input_np = np.repeat(prev_z_input_np, self.beam_size, 1)
+            sparse_pv_z = sparse_pv_z.index_select(0, beam_idx)
+
+        def step(t, z_tm1, last_hidden):
+            pz_dec_out, last_hidden, proba = \
+                self.z_decoder(u_enc_out=u_enc_out, u_input_np=u_input_np,
+                               z_tm1=z_tm1, last_hidden=last_hidden, pv_z_enc_out=pv_z_enc_out,
+                               prev_z_input_np=prev_z_input_np, u_emb=None, pv_z_emb=None, position=t,
+                               para_dec_out=para_dec_out, para_input_np=para_input_np,
+                               sparse_bspan=sparse_bspan, sparse_pv_z=sparse_pv_z)
+            return proba, last_hidden, pz_dec_out
+
+        decoded, pz_dec_outs, last_hidden = self.batch_beam_search(step, z_tm1.data[0, 0].item(), last_hidden, batch_size,
+                                                             cfg.z_length, self.vocab.encode('EOS_Z2'))
+        decoded = list(decoded)
+        decoded = [list(_) for _ in decoded]
+        return torch.split(pz_dec_outs, 1, dim=0), decoded, last_hidden
+
+    def get_req_ids(self, bspan_index):
+        """
+        :return: [B,R] ids of the requested slots of every bspan, -1 for padding
+        """
+        req_ids = []
+        for bspan in bspan_index:
+            if cfg.dataset == "camrest":
+                req_slots = self.get_req_slots_camrest(bspan)
+            else:
+                req_slots = self.get_req_slots_multiwoz(bspan)
+            req_ids.append([self.vocab.encode(_) for _ in req_slots] + [-1])
+        req_ids = pad_sequences(req_ids, padding='post', value=-1)
+        return cuda_(torch.from_numpy(req_ids).long())
 
     def beam_search_decode(self, pz_dec_outs, u_enc_out, m_tm1, u_input_np, last_hidden, degree_input, bspan_index):
-        vars = torch.split(pz_dec_outs, 1, dim=1), torch.split(u_enc_out, 1, dim=1), torch.split(
-            m_tm1, 1, dim=1), torch.split(last_hidden, 1, dim=1), torch.split(degree_input, 1, dim=0)
-        decoded = []
+        batch_size = u_enc_out.size(1)
+        beam_idx = self.beam_index(batch_size)
         bspan_index_np = pad_sequences(bspan_index).transpose((1, 0))
-        sparse_response = Variable(get_sparse_selective_input(bspan_index_np, self.reader.vocab),
-                                    requires_grad=False)
-        for i, (pz_dec_out_s, u_enc_out_s, m_tm1_s, last_hidden_s, degree_input_s) in enumerate(zip(*vars)):
-            decoded_s = self.beam_search_decode_single(pz_dec_out_s, u_enc_out_s, m_tm1_s,
-                                                       u_input_np[:, i].reshape((-1, 1)),
-                                                       last_hidden_s, degree_input_s, bspan_index[i],
-                                                       sparse_response=sparse_response)
-            decoded.append(decoded_s)
-        return [list(_.view(-1)) for _ in decoded]
+        sparse_response = cuda_(Variable(get_sparse_selective_input(bspan_index_np, self.reader.vocab),
+                                         requires_grad=False))
+        pz_dec_outs, u_enc_out = pz_dec_outs.index_select(1, beam_idx), u_enc_out.index_select(1, beam_idx)
+        degree_input = degree_input.index_select(0, beam_idx)
+        sparse_response = sparse_response.index_select(0, beam_idx)
+        u_input_np = np.repeat(u_input_np, self.beam_size, 1)
+        bspan_index_np = np.repeat(bspan_index_np, self.beam_size, 1)
+
+        def step(t, m_tm1, last_hidden):
+            return self.m_decoder(pz_dec_outs, u_enc_out, u_input_np, m_tm1, degree_input, last_hidden,
+                                  bspan_index_np, sparse_response=sparse_response)
+
+        decoded, _, _ = self.batch_beam_search(step, m_tm1.data[0, 0].item(), last_hidden, batch_size, self.max_ts,
+                                         self.eos_token_idx, req_ids=self.get_req_ids(bspan_index))
+        decoded = list(decoded)
+        return [list(_) for _ in decoded]
 
+    @fp32
     def supervised_loss(self, pz_proba, pm_dec_proba, z_input, m_input):
         pz_proba, pm_dec_proba = pz_proba[:, :, :cfg.vocab_size].contiguous(), pm_dec_proba[:, :,
                                                                                :cfg.vocab_size].contiguous()
@@ -935,110 +1047,86 @@ class TSD(nn.Module):
                 reqs.append(token)
         return reqs
 
-    def reward(self, m_tm1, decoded, bspan_index):
+    def reward(self, m_tm1, seen, req_ids):
         """
         The setting of the reward function is heuristic. It can be better optimized.
-        :param m_tm1:
-        :param decoded:
-        :param bspan_index:
-        :return:
+        :param m_tm1: [B] last decoded token
+        :param seen: [B,R] requested slots already decoded
+        :param req_ids: [B,R] requested slots of the bspan, -1 for padding
+        :return: reward [B], seen [B,R], finished [B]
         """
-        if cfg.dataset == "camrest":
-            req_slots = self.get_req_slots_camrest(bspan_index)
-        else:
-            req_slots = self.get_req_slots_multiwoz(bspan_index)
-
-        m_tm1 = self.vocab.decode(m_tm1[0])
-        finished = m_tm1 == 'EOS_M'
-        decoded = [_.view(-1)[0] for _ in decoded]
-        decoded_sentence = self.vocab.sentence_decode(decoded, cfg.eos_m_token).split()
-        reward = -0.01
-        '''
-        if not finished:
-            if m_tm1 in req_slots:
-                if decoded_sentence and m_tm1 not in decoded_sentence[:-1]:
-                    reward = 1.0
-        '''
-        # some modification for reward function.
-        if m_tm1 in req_slots:
-            if decoded_sentence and m_tm1 not in decoded_sentence[:-1]:
-                reward += 1.0
-            else:
-                reward -= 1.0
-        return reward, finished
+        is_req = (req_ids == m_tm1.view(-1, 1)).long()  # [B,R]
+        req_hit = is_req.sum(1) > 0
+        first_hit = (is_req * seen).sum(1) == 0
+        reward = cuda_(torch.ones(m_tm1.size(0))) * -0.01
+        # some modification for reward function: a requested slot scores once, repeating it is penalized.
+        reward = reward + req_hit.float() * (first_hit.float() * 2 - 1)
+        seen = torch.max(seen, is_req)
+        finished = m_tm1 == self.vocab.encode(cfg.eos_m_token)
+        return reward, seen, finished
 
     def sampling_decode(self, pz_dec_outs, u_enc_out, m_tm1, u_input_np, last_hidden, degree_input, bspan_index):
-        vars = torch.split(pz_dec_outs, 1, dim=1), torch.split(u_enc_out, 1, dim=1), torch.split(
-            m_tm1, 1, dim=1), torch.split(last_hidden, 1, dim=1), torch.split(degree_input, 1, dim=0)
-        batch_loss = []
-
-        sample_num = 1
-
-        for i, (pz_dec_out_s, u_enc_out_s, m_tm1_s, last_hidden_s, degree_input_s) in enumerate(zip(*vars)):
-            if cfg.dataset == "camrest":
-                if not self.get_req_slots_camrest(bspan_index[i]):
-                    continue
-            else:
-                if not self.get_req_slots_multiwoz(bspan_index[i]):
-                    continue
-            for j in range(sample_num):
-                loss = self.sampling_decode_single(pz_dec_out_s, u_enc_out_s, m_tm1_s,
-                                                   u_input_np[:, i].reshape((-1, 1)),
-                                                   last_hidden_s, degree_input_s, bspan_index[i])
-                batch_loss.append(loss)
-        if not batch_loss:
+        """
+        sample one response per example in a single batched episode, examples without requested slots in the
+        bspan are left out of the loss
+        :return: mean policy loss, None if no example requests a slot
+        """
+        req_ids = self.get_req_ids(bspan_index)  # [B,R]
+        has_req = ((req_ids >= 0).long().sum(1) > 0).float()
+        if has_req.sum().item() == 0:
             return None
-        else:
-            return sum(batch_loss) / len(batch_loss)
-
-    def sampling_decode_single(self, pz_dec_outs, u_enc_out, m_tm1, u_input_np, last_hidden, degree_input, bspan_index):
-        decoded = []
-        reward_sum = 0
-        log_probs = []
-        rewards = []
-        bspan_index_np = np.array(bspan_index).reshape(-1, 1)
-        sparse_response = Variable(get_sparse_selective_input(bspan_index_np, self.reader.vocab),
-                                   requires_grad=False)
+        batch_size = u_enc_out.size(1)
+        bspan_index_np = pad_sequences(bspan_index).transpose((1, 0))
+        sparse_response = cuda_(Variable(get_sparse_selective_input(bspan_index_np, self.reader.vocab),
+                                         requires_grad=False))
+        seen = torch.zeros_like(req_ids)
+        done = cuda_(torch.zeros(batch_size)) > 0
+        length = cuda_(torch.zeros(batch_size).long())  # number of actions of each episode
+        log_probs, rewards = [], []
         for t in range(self.max_ts):
             # reward
-            reward, finished = self.reward(m_tm1.data.view(-1), decoded, bspan_index)
-            reward_sum += reward
-            rewards.append(reward)
+            reward, seen, finished = self.reward(m_tm1.data.view(-1), seen, req_ids)
+            rewards.append(reward * (done == 0).float())
             if t == self.max_ts - 1:
-                finished = True
-            if finished:
-                loss = self.finish_episode(log_probs, rewards)
-                return loss
+                finished = torch.ones_like(finished)
+            length = length.masked_fill(finished & (done == 0), t)
+            done = done | finished
+            if (done == 0).long().sum().item() == 0:
+                break
             # action
             proba, last_hidden, _ = self.m_decoder(pz_dec_outs, u_enc_out, u_input_np, m_tm1,
                                                    degree_input, last_hidden, bspan_index_np,
                                                    sparse_response=sparse_response)
-            proba = proba.squeeze(0)  # [B,V]
             dis = Categorical(proba)
             action = dis.sample()
-            log_probs.append(dis.log_prob(action))
+            log_probs.append(dis.log_prob(action) * (done == 0).float())
             mt_index = action.data.view(-1)
-            decoded.append(mt_index.clone())
-
-            for i in range(mt_index.size(0)):
-                if mt_index[i] >= cfg.vocab_size:
-                    mt_index[i] = 2  # unk
-
+            mt_index = mt_index.masked_fill(mt_index >= cfg.vocab_size, 2)  # unk
             m_tm1 = cuda_(Variable(mt_index).view(1, -1))
+        loss = self.finish_episode(log_probs, rewards, length)
+        return (loss * has_req).sum() / has_req.sum()
 
-    def finish_episode(self, log_probas, saved_rewards):
+    def finish_episode(self, log_probas, saved_rewards, length):
+        """
+        batched form of the per-example episode loss: returns are accumulated forward over the rewards, and, as
+        before, the k-th action of an episode of length n is weighted by the return at step n-k
+        :param log_probas: list of [B], zero after the end of each episode
+        :param saved_rewards: list of [B], zero after the end of each episode
+        :param length: [B] number of actions of each episode
+        :return: [B] policy loss of each episode
+        """
         R = 0
-        policy_loss = []
-        rewards = []
+        returns = []
         for r in saved_rewards:
             R = r + 0.8 * R
-            rewards.insert(0, R)
+            returns.append(R)
+        returns = torch.stack(returns, dim=0)  # [T+1,B]
+        if not log_probas:
+            return torch.zeros_like(returns[0])
 
-        rewards = torch.Tensor(rewards)
+        steps = cuda_(torch.arange(len(log_probas)).long()).view(-1, 1)  # [T,1]
+        rewards = returns.gather(0, (length.view(1, -1) - steps).clamp(min=0))  # [T,B]
         # rewards = (rewards - rewards.mean()) / (rewards.std() + np.finfo(np.float32).eps)
 
-        for log_prob, reward in zip(log_probas, rewards):
-            policy_loss.append(-log_prob * reward)
-        l = len(policy_loss)
-        policy_loss = sum(policy_loss)
-        return policy_loss / l
+        policy_loss = -(torch.stack(log_probas, dim=0) * rewards).sum(0)
+        return policy_loss / length.clamp(min=1).float()
@@ -68,10 +68,31 @@ class _Config:
         self.epoch_num = 100
         self.early_stop_count = 5
         self.weight_decay_count = 3
+        self.warmup_steps = 0   # optimizer updates of linear learning rate warmup
+        self.accum_token_budget = 0   # target tokens accumulated across turns and batches per update, 0 to update every turn
         self.teacher_force = 100
         self.multi_acts_training = False
         self.multi_act_sampling_num = 1
+        self.aspn_aug_token_budget = 4096   # max act tokens per multi-act decoding pass, 0 for a single pass
         self.valid_loss = 'score'
+        self.full_valid_interval = 1   # epochs between decode-based validations, teacher-forced metrics are logged in between
+        self.valid_subsample = 0   # dialogues of a fixed dev subsample stratified by turn number for decode-based validation, 0 for all
+        self.background_valid = False   # validate epoch-end snapshots in a CPU process, early stopping and lr decay lag one epoch
+        self.dist_world_size = 1   # CPU training processes with DistributedDataParallel over gloo (torch>=1.1), batch_size is split over them
+        self.dist_rank = 0
+        self.dist_url = 'tcp://127.0.0.1:29500'
+        self.infer_threads = 0   # torch intra-op threads at test time on CPU, 0 for the default
+        self.infer_interop_threads = 0
+        self.infer_workers = 1   # single-threaded CPU processes decoding shards of the test batches
+        self.infer_pin_cpus = False   # pin each decoding worker to one cpu
+        self.infer_bench_batches = 10   # test batches timed per configuration by -mode bench, 0 for all
+        self.quantize = False   # int8 dynamic quantization of the GRU and Linear layers for CPU inference (torch>=1.3)
+        self.quantize_guard = False   # with quantize, evaluate in fp32 too and log the metric deltas and decoding times
+        self.bf16 = False   # bf16 CPU autocast for the GRUs and projections (torch>=1.10), falls back to fp32 if unsupported
+        self.para_cache_interval = 0   # reuse paraphrase generations for this many paraphrase (odd) epochs, 0 to disable
+        self.resume = False   # continue training from resume.pkl in exp_path
+        self.resume_interval = 0   # dialogue batches between resume checkpoints, 0 to save them at epoch ends only
+        self.async_checkpoint = True   # write checkpoints from a background thread
 
         # evaluation settings
         self.eval_load_path ='experiments/all_multi_acts_sample3_sd777_lr0.005_bs80_sp5_dc3'
@@ -1,4 +1,4 @@
-import copy, operator
+import copy, operator, contextlib, functools, logging
 from queue import PriorityQueue
 import numpy as np
 import torch
@@ -18,6 +18,70 @@ def cuda_(var):
     return var.cuda() if cfg.cuda else var
 
 
+# bf16 helpers, kept identical to CamRest676/tsd_net.py by MultiWOZ/tests/test_shared_helpers.py
+_bf16_supported = None
+
+
+def bf16_enabled():
+    """
+    whether the bf16 CPU autocast of cfg.bf16 is in use: it needs torch.autocast (torch>=1.10) and a CPU with native
+    bf16 support, otherwise everything runs in fp32
+    """
+    global _bf16_supported
+    if not cfg.bf16 or cfg.cuda:
+        return False
+    if _bf16_supported is None:
+        _bf16_supported = hasattr(torch, 'autocast')
+        try:
+            _bf16_supported = _bf16_supported and torch.ops.mkldnn._is_mkldnn_bf16_supported()
+        except (AttributeError, RuntimeError):
+            pass
+        if not _bf16_supported:
+            logging.warning('bf16 autocast is not supported by this torch or CPU, running in fp32')
+    return _bf16_supported
+
+
+def autocast(enabled=True):
+    """
+    bf16 CPU autocast region if bf16_enabled(), enabled=False opens an fp32 region inside of one
+    """
+    if not bf16_enabled():
+        return contextlib.ExitStack()
+    return torch.autocast('cpu', dtype=torch.bfloat16, enabled=enabled)
+
+
+def bf16_autocast(forward):
+    """
+    run a forward method in the bf16 autocast region
+    """
+    @functools.wraps(forward)
+    def wrapper(*args, **kwargs):
+        with autocast():
+            return forward(*args, **kwargs)
+    return wrapper
+
+
+def fp32(func):
+    """
+    keep a numerically sensitive function out of the bf16 autocast region, with its floating point tensor
+    arguments (or lists of them) cast to fp32
+    """
+    def to_fp32(x):
+        if torch.is_tensor(x) and x.is_floating_point():
+            return x.float()
+        if isinstance(x, list):
+            return [to_fp32(v) for v in x]
+        return x
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not bf16_enabled():
+            return func(*args, **kwargs)
+        with autocast(enabled=False):
+            return func(*[to_fp32(a) for a in args], **{k: to_fp32(v) for k, v in kwargs.items()})
+    return wrapper
+
+
 def init_gru(gru):
     def weight_reset(m):
         if isinstance(m, nn.Conv2d) or isinstance(m, nn.Linear):
@@ -29,16 +93,24 @@ def init_gru(gru):
             torch.nn.init.orthogonal_(hh[i : i + gru.hidden_size], gain=1)
 
 
-def label_smoothing(labels, smoothing_rate, vocab_size_oov):
-    with torch.no_grad():
-        confidence = 1.0 - smoothing_rate
-        low_confidence = (1.0 - confidence) / labels.new_tensor(vocab_size_oov - 1)
-        y_tensor = labels.data if isinstance(labels, Variable) else labels
-        y_tensor = y_tensor.type(torch.LongTensor).contiguous().view(-1, 1)
-        n_dims = vocab_size_oov
-        y_one_hot = torch.zeros(y_tensor.size()[0], n_dims).fill_(low_confidence).scatter_(1, y_tensor, confidence)
-        y_one_hot = cuda_(y_one_hot.view(*labels.shape, -1))
-    return y_one_hot
+@fp32
+def label_smoothing_nll(logprob, labels, smoothing_rate, ignore_index=None):
+    """
+    label smoothed nll computed from the target indexes, without building the smoothed one-hot labels.
+    The mass of the other words is divided by an integer tensor as the original dense labels did, so the loss
+    matches them on every torch version: torch<1.5 (e.g. the pinned 1.0.1) truncates it to 0, and then only the
+    target word is weighted, by 1 - smoothing_rate
+    :param logprob: [B,T,V_oov]
+    :param labels: [B,T]
+    :return: loss summed over T and averaged over B
+    """
+    confidence = 1.0 - smoothing_rate
+    low_confidence = float((1.0 - confidence) / labels.new_tensor(logprob.size(2) - 1))
+    target_logprob = logprob.gather(2, labels.unsqueeze(2)).squeeze(2)   # [B,T]
+    nll = -(confidence - low_confidence) * target_logprob - low_confidence * logprob.sum(2)
+    if ignore_index is not None:
+        nll = nll.masked_fill(labels == ignore_index, 0.)
+    return nll.sum(1).mean()
 
 
 def get_one_hot_input(x_input_np):
@@ -47,28 +119,46 @@ def get_one_hot_input(x_input_np):
     :param x_input_np: [B, Tenc]
     :return: tensor: [B,Tenc, V+Tenc]
     """
-    def to_one_hot(y, n_dims=None):
-        """ Take integer y (tensor or variable) with n dims and convert it to 1-hot representation with n+1 dims. """
-        y_tensor = y.data if isinstance(y, Variable) else y
-        y_tensor = y_tensor.type(torch.LongTensor).contiguous().view(-1, 1)
-        n_dims = n_dims if n_dims is not None else int(torch.max(y_tensor)) + 1
-        y_one_hot = torch.zeros(y_tensor.size()[0], n_dims).fill_(0.).scatter_(1, y_tensor, 1)   #1e-10
-        return cuda_(y_one_hot.view(*y.shape, -1))
-
-    new_input_np = np.copy(x_input_np)
-    for b in range(x_input_np.shape[0]):
-        for t in range(x_input_np.shape[1]):
-            if x_input_np[b][t] == 2:
-                new_input_np[b][t] = cfg.vocab_size + t
-    # x_input_ = (x_input_np==unk)*(widx_offset + cfg.vocab_size-unk) + x_input_np
-
-    # input_np[input_np==2] = 0
-    input_t = cuda_(torch.from_numpy(new_input_np).type(torch.LongTensor))   #[B, T]
-    input_t_onehot = to_one_hot(input_t, n_dims=cfg.vocab_size+input_t.size()[1])   #[B,T,V+T]
-    input_t_onehot[:, :, 0] = 0.   #<pad> to zero
-    # print(x_input_np.shape[0])
-    # return torch.Tensor(x_input_np.shape[1], x_input_np.shape[0], cfg.vocab_size + x_input_np.shape[0]).fill_(1e-10)
-    return input_t_onehot
+    return one_hot_input(cuda_(torch.from_numpy(x_input_np).long()))
+
+
+def one_hot_input(x_input, out=None):
+    """
+    one-hot copy input built on the device of the ids, <unk> at step t is mapped to V+t
+    :param x_input: [B, Tenc] ids with oovs as <unk>
+    :param out: [B, Tenc, V+Tenc] tensor to refill in place, a new one is allocated if None
+    :return: tensor: [B,Tenc, V+Tenc]
+    """
+    B, T = x_input.size()
+    oov_idx = torch.arange(cfg.vocab_size, cfg.vocab_size + T, dtype=torch.long, device=x_input.device)
+    x_input = torch.where(x_input == 2, oov_idx.unsqueeze(0).expand(B, T), x_input)
+    if out is None:
+        out = torch.zeros(B, T, cfg.vocab_size + T, device=x_input.device)
+    else:
+        out.zero_()
+    out.scatter_(2, x_input.unsqueeze(2), 1.)
+    out[:, :, 0] = 0.   #<pad> to zero
+    return out
+
+
+def get_attn_mask(inp_seqs, stop_tok):
+    """
+    :param inp_seqs: ndarray of [T,B]
+    :param stop_tok: list of token ids ending a sequence
+    :return: mask of [B,1,T], 1 for <pad> and for positions from the first stop token on
+    """
+    mask = (np.cumsum(np.isin(inp_seqs, stop_tok), axis=0) > 0) | (inp_seqs == 0)
+    return cuda_(torch.from_numpy(mask.transpose((1, 0)).astype(np.int64)) > 0).unsqueeze(1)
+
+
+def masked_softmax(energies, mask, dim):
+    """
+    softmax giving exactly zero weight to masked positions
+    :param mask: broadcastable to energies, 1 for positions to ignore, or None
+    """
+    if mask is not None:
+        energies = energies.masked_fill(mask, -1e20)
+    return F.softmax(energies, dim=dim)
 
 
 class Attn(nn.Module):
@@ -87,14 +177,7 @@ class Attn(nn.Module):
         :param encoder_outputs: tensor of size [B,T, H]
         """
         attn_energies = self.score(hidden, encoder_outputs)   # [B,T,H]
-        if mask is None:
-            normalized_energy = F.softmax(attn_energies, dim=2)  # [B,1,T]
-        else:
-            # mask = (inp_seqs > 0).float()
-            attn_energies.masked_fill_(mask, -1e20)
-            # print('masked attn:', attn_energies[0:2,:,:])
-            normalized_energy = F.softmax(attn_energies, dim=2)  # [B,1,T]
-            # print('masked normalized attn:', normalized_energy[0:2,:,:])
+        normalized_energy = masked_softmax(attn_energies, mask, dim=2)  # [B,1,T]
 
         context = torch.bmm(normalized_energy, encoder_outputs)  # [B,1,H]
         return context  # [B,1, H]
@@ -222,17 +305,21 @@ class Copy(nn.Module):
         self.copy_weight = copy_weight
 
 
-    def forward(self, enc_out_hs, dec_hs):
+    def forward(self, enc_out_hs, dec_hs, mask=None):
         """
         get unnormalized copy score
         :param enc_out_hs: [B, Tenc,  H]
         :param dec_hs: [B, Tdec, H]   testing: Tdec=1
+        :param mask: [B, 1, Tenc], masked positions get -1e20, i.e. zero weight in the final softmax
         :return: raw_cp_score of each position, size [B, Tdec, Tenc]
         """
         # print(B,H,Tdec, enc_out_hs.size(0))
         raw_cp_score = torch.tanh(self.Wcopy(enc_out_hs))   #[B,Tenc,H]
         raw_cp_score = torch.einsum('beh,bdh->bde',raw_cp_score, dec_hs)    #[B, Tdec, Tenc]
-        return raw_cp_score * self.copy_weight
+        raw_cp_score = raw_cp_score * self.copy_weight
+        if mask is not None:
+            raw_cp_score = raw_cp_score.masked_fill(mask, -1e20)
+        return raw_cp_score
 
 
 # def get_final_scores(raw_scores, word_onehot_input, input_idx_oov, vocab_size_oov):
@@ -286,6 +373,7 @@ class Copy(nn.Module):
 #     # print('total_score:' , total_score.cpu().detach().numpy()[0,:3, 0:40])
 #     return total_score.contiguous()   #[B, Tdec, vocab_size_oov]
 
+@fp32
 def get_final_scores(raw_scores, word_onehot_input, input_idx_oov, vocab_size_oov):
     """
     :param raw_scores: list of tensor of size [B, Tdec, V], [B, Tdec, Tenc1], [B, Tdec, Tenc1] ...
@@ -407,8 +495,7 @@ class DomainSpanDecoder(nn.Module):
         raw_scores.append(raw_gen_score)
 
         if not first_turn:
-            raw_cp_score_dspn = self.cp_pvdspn(hidden_states['dspn'], dec_hs)   #[B,Ta]
-            raw_cp_score_dspn.masked_fill_(self.mask_pvdspn.repeat(1,Tdec,1), -1e20)
+            raw_cp_score_dspn = self.cp_pvdspn(hidden_states['dspn'], dec_hs, self.mask_pvdspn)   #[B,Ta]
             raw_scores.append(raw_cp_score_dspn)
             word_onehot_input.append(inputs['pv_dspn_onehot'])
             input_idx_oov.append(inputs['pv_dspn_nounk'])
@@ -459,6 +546,7 @@ class BeliefSpanDecoder(nn.Module):
         :param dec_last_w: word index of last decoding step
         :param dec_last_h: hidden state of last decoding step
         :param first_turn: [description], defaults to False
+        :param para_dec: paraphrase decoder outputs [B,T,H] and their pad mask [B,1,T], from Paraphrase.forward
         :returns: [description]
         """
 
@@ -468,8 +556,10 @@ class BeliefSpanDecoder(nn.Module):
         gru_input.append(embed_last_w)
         # print(embed_last_w.size())
 
+        para_hs, mask_para = para_dec
         if first_step:
             self.mask_user = (inputs['user']==0).unsqueeze(1)#.to(dec_last_w.device)     # [B,1,T]
+            self.mask_para = mask_para
             self.mask_pvresp = (inputs['pv_resp']==0).unsqueeze(1)#.to(dec_last_w.device)     # [B,1,T]
             self.mask_pvbspn = (inputs['pv_'+self.bspn_mode]==0).unsqueeze(1)#.to(dec_last_w.device)     # [B,1,T]
             # print('masks:', self.mask_user.device, self.mask_pvresp.device, self.mask_pvbspn.device)
@@ -479,7 +569,7 @@ class BeliefSpanDecoder(nn.Module):
 
         # print('user:', inputs['user'][0:2, :])
         context_user = self.attn_user.forward(dec_last_h, hidden_states['user'], self.mask_user)
-        context_para = self.attn_para.forward(dec_last_h, para_dec, self.mask_para)
+        context_para = self.attn_para.forward(dec_last_h, para_hs, self.mask_para)
         # context_user = self.attn_user(dec_last_h, huser, self.mask_user)
         gru_input.append(context_user)
         gru_input.append(context_para)
@@ -512,21 +602,18 @@ class BeliefSpanDecoder(nn.Module):
         raw_gen_score = self.Wgen(dec_hs)    #[B, Tdec, V]
         raw_scores.append(raw_gen_score)
 
-        raw_cp_score_user = self.cp_user(hidden_states['user'], dec_hs)   #[B, Tdec,Tu]
-        raw_cp_score_user.masked_fill_(self.mask_user.repeat(1,Tdec,1), -1e20)
+        raw_cp_score_user = self.cp_user(hidden_states['user'], dec_hs, self.mask_user)   #[B, Tdec,Tu]
         raw_scores.append(raw_cp_score_user)
         word_onehot_input.append(inputs['user_onehot'])
         input_idx_oov.append(inputs['user_nounk'])
 
         if not first_turn:
-            raw_cp_score_pvresp = self.cp_pvresp(hidden_states['resp'], dec_hs)   #[B, Tdec,Tr]
-            raw_cp_score_pvresp.masked_fill_(self.mask_pvresp.repeat(1,Tdec,1), -1e20)
+            raw_cp_score_pvresp = self.cp_pvresp(hidden_states['resp'], dec_hs, self.mask_pvresp)   #[B, Tdec,Tr]
             raw_scores.append(raw_cp_score_pvresp)
             word_onehot_input.append(inputs['pv_resp_onehot'])
             input_idx_oov.append(inputs['pv_resp_nounk'])
 
-            raw_cp_score_pvbspn = self.cp_pvbspn(hidden_states[self.bspn_mode], dec_hs)   #[B, Tdec, Tb]
-            raw_cp_score_pvbspn.masked_fill_(self.mask_pvbspn.repeat(1,Tdec,1), -1e20)
+            raw_cp_score_pvbspn = self.cp_pvbspn(hidden_states[self.bspn_mode], dec_hs, self.mask_pvbspn)   #[B, Tdec, Tb]
             raw_scores.append(raw_cp_score_pvbspn)
             word_onehot_input.append(inputs['pv_%s_onehot'%self.bspn_mode])
             input_idx_oov.append(inputs['pv_%s_nounk'%self.bspn_mode])
@@ -661,14 +748,12 @@ class ActSpanDecoder(nn.Module):
 
         if cfg.enable_bspn:
             if bidx is None:
-                raw_cp_score_bspn = self.cp_bspn(hidden_states[cfg.bspn_mode], dec_hs)   #[B,Tb]
-                raw_cp_score_bspn.masked_fill_(self.mask_bspn.repeat(1,Tdec,1), -1e20)
+                raw_cp_score_bspn = self.cp_bspn(hidden_states[cfg.bspn_mode], dec_hs, self.mask_bspn)   #[B,Tb]
                 raw_scores.append(raw_cp_score_bspn)
                 word_onehot_input.append(inputs[cfg.bspn_mode + '_onehot'])
                 input_idx_oov.append(inputs[cfg.bspn_mode + '_nounk'])
             else:
-                raw_cp_score_bspn = self.cp_bspn(hidden_states[cfg.bspn_mode][bidx], dec_hs)   #[B,Tb]
-                raw_cp_score_bspn.masked_fill_(self.mask_bspn[bidx].repeat(1,Tdec,1), -1e20)
+                raw_cp_score_bspn = self.cp_bspn(hidden_states[cfg.bspn_mode][bidx], dec_hs, self.mask_bspn[bidx])   #[B,Tb]
                 raw_scores.append(raw_cp_score_bspn)
                 word_onehot_input.append(inputs[cfg.bspn_mode + '_onehot'][bidx])
                 input_idx_oov.append(inputs[cfg.bspn_mode + '_nounk'][bidx])
@@ -676,28 +761,24 @@ class ActSpanDecoder(nn.Module):
 
         if cfg.enable_dspn:
             if bidx is None:
-                raw_cp_score_dspn = self.cp_dspn(hidden_states['dspn'], dec_hs)   #[B,Tb]
-                raw_cp_score_dspn.masked_fill_(self.mask_dspn.repeat(1,Tdec,1), -1e20)
+                raw_cp_score_dspn = self.cp_dspn(hidden_states['dspn'], dec_hs, self.mask_dspn)   #[B,Tb]
                 raw_scores.append(raw_cp_score_dspn)
                 word_onehot_input.append(inputs['dspn_onehot'])
                 input_idx_oov.append(inputs['dspn_nounk'])
             else:
-                raw_cp_score_dspn = self.cp_dspn(hidden_states['dspn'][bidx], dec_hs)   #[B,Tb]
-                raw_cp_score_dspn.masked_fill_(self.mask_dspn[bidx].repeat(1,Tdec,1), -1e20)
+                raw_cp_score_dspn = self.cp_dspn(hidden_states['dspn'][bidx], dec_hs, self.mask_dspn[bidx])   #[B,Tb]
                 raw_scores.append(raw_cp_score_dspn)
                 word_onehot_input.append(inputs['dspn_onehot'][bidx])
                 input_idx_oov.append(inputs['dspn_nounk'][bidx])
 
         if not first_turn and cfg.use_pvaspn:
             if bidx is None:
-                raw_cp_score_aspn = self.cp_pvaspn(hidden_states['aspn'], dec_hs)   #[B,Ta]
-                raw_cp_score_aspn.masked_fill_(self.mask_pvaspn.repeat(1,Tdec,1), -1e20)
+                raw_cp_score_aspn = self.cp_pvaspn(hidden_states['aspn'], dec_hs, self.mask_pvaspn)   #[B,Ta]
                 raw_scores.append(raw_cp_score_aspn)
                 word_onehot_input.append(inputs['pv_aspn_onehot'])
                 input_idx_oov.append(inputs['pv_aspn_nounk'])
             else:
-                raw_cp_score_aspn = self.cp_pvaspn(hidden_states['aspn'][bidx], dec_hs)   #[B,Ta]
-                raw_cp_score_aspn.masked_fill_(self.mask_pvaspn[bidx].repeat(1,Tdec,1), -1e20)
+                raw_cp_score_aspn = self.cp_pvaspn(hidden_states['aspn'][bidx], dec_hs, self.mask_pvaspn[bidx])   #[B,Ta]
                 raw_scores.append(raw_cp_score_aspn)
                 word_onehot_input.append(inputs['pv_aspn_onehot'][bidx])
                 input_idx_oov.append(inputs['pv_aspn_nounk'][bidx])
@@ -804,23 +885,20 @@ class ResponseDecoder(nn.Module):
         raw_scores.append(raw_gen_score)
         # print('raw_gen_score:' , raw_gen_score.cpu().detach().numpy()[0,:3, 0:40])
 
-        raw_cp_score_usdx = self.cp_usdx(hidden_states['usdx'], dec_hs)   #[B,Tu]
-        raw_cp_score_usdx.masked_fill_(self.mask_usdx.repeat(1,Tdec,1), -1e20)
+        raw_cp_score_usdx = self.cp_usdx(hidden_states['usdx'], dec_hs, self.mask_usdx)   #[B,Tu]
         raw_scores.append(raw_cp_score_usdx)
         word_onehot_input.append(inputs['usdx_onehot'])
         input_idx_oov.append(inputs['usdx_nounk'])
 
         if cfg.enable_bspn:
-            raw_cp_score_bspn = self.cp_bspn(hidden_states[cfg.bspn_mode], dec_hs)   #[B,Tb]
-            raw_cp_score_bspn.masked_fill_(self.mask_bspn.repeat(1,Tdec,1), -1e20)
+            raw_cp_score_bspn = self.cp_bspn(hidden_states[cfg.bspn_mode], dec_hs, self.mask_bspn)   #[B,Tb]
             raw_scores.append(raw_cp_score_bspn)
             word_onehot_input.append(inputs[cfg.bspn_mode + '_onehot'])
             input_idx_oov.append(inputs[cfg.bspn_mode + '_nounk'])
             # print('raw_cp_score_bspn:' , raw_cp_score_bspn.cpu().detach().numpy()[0,:3, 0:40])
 
         if cfg.enable_aspn:
-            raw_cp_score_aspn = self.cp_aspn(hidden_states['aspn'], dec_hs)   #[B,Ta]
-            raw_cp_score_aspn.masked_fill_(self.mask_aspn.repeat(1,Tdec,1), -1e20)
+            raw_cp_score_aspn = self.cp_aspn(hidden_states['aspn'], dec_hs, self.mask_aspn)   #[B,Ta]
             raw_scores.append(raw_cp_score_aspn)
             word_onehot_input.append(inputs['aspn_onehot'])
             input_idx_oov.append(inputs['aspn_nounk'])
@@ -929,27 +1007,42 @@ class DAMD(nn.Module):
             'dspn': False,
             'resp': False}
 
-    def supervised_loss(self, inputs, probs):
-        def LabelSmoothingNLLLoss(logprob, labels):
-                return -(labels * logprob).sum((1,2)).mean()
+    @fp32
+    def supervised_loss(self, inputs, probs, token_sum=False):
+        """
+        :param token_sum: return the total loss summed over the target tokens of all spans instead of the sum of
+            the span losses, and their number in losses['tokens']; every span loss, the label smoothed resp one
+            included, is then a per-token mean over its non-pad targets
+        """
         total_loss = 0
         losses = {'bsdx':0, 'bspn':0, 'aspn':0, 'resp':0}
+        tokens = 0
         for name, prob in probs.items():
             if name == 'aspn_aug':
                 continue
             # print(prob)
             # pred = torch.log(prob.view(-1, prob.size(2)))
             # print(pred[0, :50])
-            if name != 'resp' or cfg.label_smoothing == .0:
+            label = inputs[name+'_4loss']
+            if token_sum:
+                span_tokens = (label != 0).long().sum()
+                if name != 'resp' or cfg.label_smoothing == .0:
+                    loss_sum = F.nll_loss(prob.view(-1, prob.size(2)), label.view(-1), ignore_index=0,
+                                          reduction='sum')
+                else:
+                    loss_sum = label_smoothing_nll(prob, label, self.label_smth, ignore_index=0) * label.size(0)
+                total_loss += loss_sum
+                tokens += span_tokens
+                losses[name] = loss_sum / span_tokens.clamp(min=1).float()
+            elif name != 'resp' or cfg.label_smoothing == .0:
                 pred = prob.view(-1, prob.size(2))   #[B,T,Voov] -> [B*T, Voov]
-                label = inputs[name+'_4loss'].view(-1)
+                label = label.view(-1)
                 # print(label[:50])
                 loss = self.nllloss(pred, label)
                 total_loss += loss
                 losses[name] = loss
             else:
-                label = label_smoothing(inputs[name+'_4loss'], self.label_smth, self.vsize_oov)
-                loss = LabelSmoothingNLLLoss(prob, label) / 10
+                loss = label_smoothing_nll(prob, label, self.label_smth) / 10
                 total_loss += loss
                 losses[name] = loss
 
@@ -958,21 +1051,48 @@ class DAMD(nn.Module):
             pred = prob.view(-1, prob.size(2))   #[B,T,Voov] -> [B*T, Voov]
             label = inputs['aspn_aug_4loss'].view(-1)
             # print(label.size())
-            loss = self.nllloss(pred, label)
-            total_loss += loss
+            if token_sum:
+                span_tokens = (label != 0).long().sum()
+                loss_sum = F.nll_loss(pred, label, ignore_index=0, reduction='sum')
+                total_loss += loss_sum
+                tokens += span_tokens
+                loss = loss_sum / span_tokens.clamp(min=1).float()
+            else:
+                loss = self.nllloss(pred, label)
+                total_loss += loss
             losses['aspn_aug'] = loss
         else:
             losses['aspn_aug'] = 0
 
+        if token_sum:
+            losses['tokens'] = tokens
         return total_loss, losses
 
 
-    def forward(self, inputs, hidden_states, first_turn, mode, para_dec):
+    def token_accuracy(self, inputs, probs):
+        """
+        teacher-forced argmax accuracy of each decoded span
+        :return: dict of name+'_tokens' and name+'_correct' counts over the non-pad label tokens
+        """
+        counts = {}
+        for name, prob in probs.items():
+            if name == 'aspn_aug':
+                continue
+            label = inputs[name+'_4loss']   #[B,T]
+            mask = (label != 0).long()
+            counts[name+'_tokens'] = mask.sum()
+            counts[name+'_correct'] = ((prob.argmax(2) == label).long() * mask).sum()
+        return counts
+
+    @bf16_autocast
+    def forward(self, inputs, hidden_states, first_turn, mode, para_dec, token_sum=False):
         if mode == 'train' or mode == 'valid':
             # probs, hidden_states = \
             probs = \
                 self.train_forward(inputs, hidden_states, first_turn, para_dec)
-            total_loss, losses = self.supervised_loss(inputs, probs)
+            total_loss, losses = self.supervised_loss(inputs, probs, token_sum=token_sum)
+            if mode == 'valid':
+                losses.update(self.token_accuracy(inputs, probs))
             return total_loss, losses
         elif mode == 'test':
             decoded = self.test_forward(inputs, hidden_states, first_turn, para_dec)
@@ -981,49 +1101,56 @@ class DAMD(nn.Module):
             raise NotImplementedError('RL not available at the moment')
 
 
+    def encode_pv(self, name, encoder, inputs, hidden_states):
+        """
+        encode the previous turn span inputs[name]. Out of training the encodings are kept in the turn state
+        of the dialogue batch, and rows whose ids equal the ones encoded in the previous turn are reused
+        :return: outputs [B,T,H], hidden [n_layer*bi-direc,B,H]
+        """
+        ids = inputs[name]
+        cache = hidden_states.setdefault('pv_enc_cache', {})
+        if self.training or name not in cache or cache[name][0].size() != ids.size():
+            enc, last_h = encoder.forward(ids)
+        else:
+            prev_ids, enc, last_h = cache[name]
+            changed = ((prev_ids != ids).long().sum(1) > 0).nonzero().view(-1)
+            if changed.numel():
+                new_enc, new_last_h = encoder.forward(ids.index_select(0, changed))
+                enc = enc.index_copy(0, changed, new_enc)
+                last_h = last_h.index_copy(1, changed, new_last_h)
+        if not self.training:
+            cache[name] = (ids, enc, last_h)
+        return enc, last_h
+
     def train_forward(self, inputs, hidden_states, first_turn, para_dec):
         """
         compute required outputs for a single dialogue turn. Turn state{Dict} will be updated in each call.
         """
-        def train_decode(name, init_hidden, hidden_states, probs, para_dec, bidx=None):
+        def train_decode(name, init_hidden, hidden_states, probs, para_dec, inputs=inputs):
 
-            batch_size = inputs['user'].size(0) if bidx is None else len(bidx)
+            batch_size = inputs['user'].size(0)
             dec_last_w = cuda_(torch.ones(batch_size, 1).long() * self.go_idx[name])
-            if bidx is None:
-                dec_last_h = (init_hidden[-1]+init_hidden[-2]).unsqueeze(0)
-            else:
-                dec_last_h = (init_hidden[-1]+init_hidden[-2]).unsqueeze(0)[:, bidx, :]
+            dec_last_h = (init_hidden[-1]+init_hidden[-2]).unsqueeze(0)
 
-            decode_step = inputs[name].size(1) if bidx is None else inputs['aspn_aug_batch'].size(1)
+            decode_step = inputs[name].size(1)
             hiddens = []
             for t in range(decode_step):
                 # print('%s step %d'%(name, t))
                 first_step = (t==0)
-                if bidx is None:
-                    dec_last_h = self.decoders[name].forward(inputs, hidden_states, dec_last_w,
-                                                             dec_last_h, first_turn, first_step, para_dec)
-                    hiddens.append(dec_last_h)
-                    dec_last_w = inputs[name][:, t].view(-1, 1)
-                else:
-                    assert name == 'aspn', 'only act span decoder support batch idx selection'
-                    dec_last_h = self.decoders[name].forward(inputs, hidden_states, dec_last_w,
-                                                             dec_last_h, first_turn, first_step, para_dec,
-                                                             bidx=bidx)
-                    hiddens.append(dec_last_h)
-                    dec_last_w = inputs['aspn_aug_batch'][:, t].view(-1, 1)
+                dec_last_h = self.decoders[name].forward(inputs, hidden_states, dec_last_w,
+                                                         dec_last_h, first_turn, first_step, para_dec)
+                hiddens.append(dec_last_h)
+                dec_last_w = inputs[name][:, t].view(-1, 1)
 
             dec_hs =  torch.cat(hiddens, dim=0).transpose(0,1)  # [1,B,H] ---> [B,T,H]
-            if bidx is None:
-                probs[name] = self.decoders[name].get_probs(inputs, hidden_states, dec_hs, first_turn)
-                if name != 'resp':
-                    hidden_states[name] = dec_hs
-            else:
-                probs = self.decoders[name].get_probs(inputs, hidden_states, dec_hs, first_turn, bidx=bidx)
+            probs[name] = self.decoders[name].get_probs(inputs, hidden_states, dec_hs, first_turn)
+            if name != 'resp':
+                hidden_states[name] = dec_hs
             return hidden_states, probs
 
         user_enc, user_enc_last_h = self.user_encoder.forward(inputs['user'])
         usdx_enc, usdx_enc_last_h = self.usdx_encoder.forward(inputs['usdx'])
-        resp_enc, resp_enc_last_h = self.usdx_encoder.forward(inputs['pv_resp'])
+        resp_enc, resp_enc_last_h = self.encode_pv('pv_resp', self.usdx_encoder, inputs, hidden_states)
         hidden_states['user'] = user_enc
         hidden_states['usdx'] = usdx_enc
         hidden_states['resp'] = resp_enc
@@ -1031,38 +1158,41 @@ class DAMD(nn.Module):
         probs = {}
 
         if cfg.enable_dspn:
-            dspn_enc, _ = self.span_encoder.forward(inputs['pv_dspn'])
+            dspn_enc, _ = self.encode_pv('pv_dspn', self.span_encoder, inputs, hidden_states)
             hidden_states['dspn'] = dspn_enc
             hidden_states, probs = train_decode('dspn', usdx_enc_last_h, hidden_states, probs, para_dec)
 
         if cfg.enable_bspn:
-            bspn_enc, _ = self.span_encoder.forward(inputs['pv_'+cfg.bspn_mode])
+            bspn_enc, _ = self.encode_pv('pv_'+cfg.bspn_mode, self.span_encoder, inputs, hidden_states)
             hidden_states[cfg.bspn_mode] = bspn_enc
             init_hidden = user_enc_last_h if cfg.bspn_mode == 'bspn' else usdx_enc_last_h
             hidden_states, probs = train_decode(cfg.bspn_mode, init_hidden, hidden_states, probs, para_dec)
 
         if cfg.enable_aspn:
-            aspn_enc, _ = self.span_encoder.forward(inputs['pv_aspn'])
+            aspn_enc, _ = self.encode_pv('pv_aspn', self.span_encoder, inputs, hidden_states)
             hidden_states['aspn'] = aspn_enc
             hidden_states, probs = train_decode('aspn', usdx_enc_last_h, hidden_states, probs, para_dec)
 
         hidden_states, probs = train_decode('resp', usdx_enc_last_h, hidden_states, probs, para_dec)
 
         if cfg.enable_dst and cfg.bspn_mode == 'bsdx':
-            bspn_enc, _ = self.span_encoder.forward(inputs['pv_bspn'])
+            bspn_enc, _ = self.encode_pv('pv_bspn', self.span_encoder, inputs, hidden_states)
             hidden_states['bspn'] = bspn_enc
             hidden_states, probs = train_decode('bspn', user_enc_last_h, hidden_states, probs, para_dec)
 
         if cfg.enable_aspn and cfg.multi_acts_training and 'aspn_aug' in inputs:
+            # all act variants go through the act decoder as one expanded batch, split only to keep
+            # the decoded tokens of a pass within cfg.aspn_aug_token_budget
             probs['aspn_aug'] = []
-            batch_size = inputs['user'].size(0)
-
-            for b in range(len(inputs['aspn_bidx'])//batch_size+1):
-                bidx_batch = inputs['aspn_bidx'][b*batch_size : (b+1)*batch_size]
-                if bidx_batch:
-                    inputs['aspn_aug_batch'] = inputs['aspn_aug'][b*batch_size : (b+1)*batch_size, :]
-                    _, ps = train_decode('aspn', usdx_enc_last_h, hidden_states, None, para_dec, bidx=bidx_batch)
-                    probs['aspn_aug'].append(ps)
+            aug_num, aug_len = inputs['aspn_aug'].size()
+            chunk = max(1, cfg.aspn_aug_token_budget // aug_len) if cfg.aspn_aug_token_budget else aug_num
+            for start in range(0, aug_num, chunk):
+                bidx = inputs['aspn_bidx'][start:start+chunk]
+                aug_inputs, aug_hidden_states = select_batch(inputs, hidden_states, bidx)
+                aug_inputs['aspn'] = inputs['aspn_aug'][start:start+chunk]
+                _, ps = train_decode('aspn', usdx_enc_last_h[:, bidx], aug_hidden_states, {}, para_dec,
+                                     inputs=aug_inputs)
+                probs['aspn_aug'].append(ps['aspn'])
 
         return probs
 
@@ -1070,7 +1200,7 @@ class DAMD(nn.Module):
     def test_forward(self, inputs, hs, first_turn, para_dec):
         user_enc, user_enc_last_h = self.user_encoder.forward(inputs['user'])
         usdx_enc, usdx_enc_last_h = self.usdx_encoder.forward(inputs['usdx'])
-        resp_enc, resp_enc_last_h = self.usdx_encoder.forward(inputs['pv_resp'])
+        resp_enc, resp_enc_last_h = self.encode_pv('pv_resp', self.usdx_encoder, inputs, hs)
         hs['user'] = user_enc
         hs['usdx'] = usdx_enc
         hs['resp'] = resp_enc
@@ -1078,17 +1208,17 @@ class DAMD(nn.Module):
         decoded = {}
 
         if cfg.enable_dst and cfg.bspn_mode == 'bsdx':
-            bspn_enc, _ = self.span_encoder.forward(inputs['pv_bspn'])
+            bspn_enc, _ = self.encode_pv('pv_bspn', self.span_encoder, inputs, hs)
             hs['bspn'] = bspn_enc
             hs, decoded = self.greedy_decode('bspn', user_enc_last_h, first_turn, inputs, hs, decoded, para_dec)
 
         if cfg.enable_dspn:
-            dspn_enc, dspn_enc_last_h = self.span_encoder.forward(inputs['pv_dspn'])
+            dspn_enc, dspn_enc_last_h = self.encode_pv('pv_dspn', self.span_encoder, inputs, hs)
             hs['dspn'] = dspn_enc
             hs, decoded = self.greedy_decode('dspn', usdx_enc_last_h, first_turn, inputs, hs, decoded, para_dec)
 
         if cfg.enable_bspn:
-            bspn_enc, bspn_enc_last_h = self.span_encoder.forward(inputs['pv_'+cfg.bspn_mode])
+            bspn_enc, bspn_enc_last_h = self.encode_pv('pv_'+cfg.bspn_mode, self.span_encoder, inputs, hs)
             hs[cfg.bspn_mode] = bspn_enc
             init_hidden = user_enc_last_h if cfg.bspn_mode == 'bspn' else usdx_enc_last_h
             hs, decoded = self.greedy_decode(cfg.bspn_mode, init_hidden, first_turn, inputs, hs, decoded, para_dec)
@@ -1103,7 +1233,7 @@ class DAMD(nn.Module):
 
 
         if cfg.enable_aspn:
-            aspn_enc, aspn_enc_last_h = self.span_encoder.forward(inputs['pv_aspn'])
+            aspn_enc, aspn_enc_last_h = self.encode_pv('pv_aspn', self.span_encoder, inputs, hs)
             hs['aspn'] = aspn_enc
             if cfg.aspn_decode_mode == 'greedy':
                 hs, decoded = self.greedy_decode('aspn', usdx_enc_last_h, first_turn, inputs, hs, decoded, para_dec)
@@ -1409,27 +1539,15 @@ class DAMD(nn.Module):
         for i in range(cfg.nbest):
             decoded['aspn'].append([list(_) for _ in wid_seqs_np[:, i, :]])
         if cfg.act_selection_scheme == 'high_test_act_f1':
-            decode_chosen = []
-            hidden_chosen = []
+            ref_rows, ref_acts = self.reader.aspan_to_act_ids(inputs['aspn_np'])
+            cand_rows, cand_acts = self.reader.aspan_to_act_ids(wid_seqs_np[:, :self.nbest].reshape(batch_size*self.nbest, -1))
+            scores = utils.batch_f1_score(ref_rows, ref_acts, cand_rows, cand_acts, batch_size, self.nbest)   #[B, nbest]
+            max_score_idx = scores.argmax(1).tolist()
             for b in range(batch_size):
-                ref = self.reader.vocab.sentence_decode(inputs['aspn_np'][b], eos='<eos_a>')
-                ref_acts= self.reader.aspan_to_act_list(ref)
-                scores = []
-                acts = ''
-                for i in range(self.nbest):
-                    decode_str = self.reader.vocab.sentence_decode(decoded['aspn'][i][b], eos='<eos_a>')
-                    decode_str_acts= self.reader.aspan_to_act_list(decode_str)
-                    acts += decode_str + ' | '
-                    f1 = utils.f1_score(ref_acts, decode_str_acts)
-                    # print(decode_str, f1)
-                    scores.append(f1)
-                multi_acts.append(acts[:-3])
-                max_score_idx = scores.index(max(scores))
-                decode_chosen.append(decoded_batch[b][max_score_idx])
-                hidden_chosen.append(hiddens_batch[b][max_score_idx])
-
-            hidden_chosen = torch.stack(hidden_chosen, dim=0)   #[B, T, H]
-            decode_chosen = torch.stack(decode_chosen, dim=0).cpu().numpy()   #[B,T]
+                multi_acts.append(' | '.join(self.reader.vocab.sentence_decode(decoded['aspn'][i][b], eos='<eos_a>')
+                                             for i in range(self.nbest)))
+            hidden_chosen = hiddens_batch[list(range(batch_size)), max_score_idx]   #[B, T, H]
+            decode_chosen = wid_seqs_np[list(range(batch_size)), max_score_idx]   #[B,T]
             self.reader.multi_acts_record = multi_acts   #[B, T]
         else:
             hidden_chosen = hiddens_batch[:, 0, :, :]   #[B, nbest, T, H]
@@ -1486,12 +1604,37 @@ class DAMD(nn.Module):
 
 
 
+def select_batch(inputs, hidden_states, bidx):
+    """
+    gather the batch rows bidx of everything the act span decoder reads, once for a whole decoding pass
+    :param bidx: list of batch indexes, may repeat
+    :return: inputs, hidden_states dicts of the selected rows
+    """
+    input_keys = ['user', 'usdx', 'pv_aspn', 'db', 'pv_aspn_onehot', 'pv_aspn_nounk']
+    if cfg.enable_bspn:
+        input_keys += [cfg.bspn_mode, cfg.bspn_mode + '_onehot', cfg.bspn_mode + '_nounk']
+    if cfg.enable_dspn:
+        input_keys += ['dspn', 'dspn_onehot', 'dspn_nounk']
+    sel_inputs = {k: inputs[k][bidx] for k in input_keys if k in inputs}
+    sel_hidden_states = {k: h[bidx] for k, h in hidden_states.items() if k in ['usdx', 'aspn', 'dspn', cfg.bspn_mode]}
+    return sel_inputs, sel_hidden_states
+
+
 def update_input(name, inputs):
-    inputs[name+'_unk_np'] = copy.deepcopy(inputs[name+'_np'])
-    inputs[name+'_unk_np'][inputs[name+'_unk_np']>=cfg.vocab_size] = 2   # <unk>
-    inputs[name+'_onehot'] = get_one_hot_input(inputs[name+'_unk_np'])
-    inputs[name] = cuda_(torch.from_numpy(inputs[name+'_unk_np']).long())
-    inputs[name+'_nounk'] = cuda_(torch.from_numpy(inputs[name+'_np']).long())
+    """
+    feed a decoded span to the following decoders. The ids are copied to the device once and the
+    <unk> ids and one-hot input are derived there; without autograd the one-hot tensor already in
+    inputs is refilled in place instead of allocating a new one
+    """
+    nounk = cuda_(torch.from_numpy(inputs[name+'_np']).long())
+    unk = torch.where(nounk >= cfg.vocab_size, torch.full_like(nounk, 2), nounk)   # <unk>
+    onehot = inputs.get(name+'_onehot')
+    reuse = not torch.is_grad_enabled() and onehot is not None and \
+            onehot.size() == (unk.size(0), unk.size(1), cfg.vocab_size + unk.size(1))
+    inputs[name+'_unk_np'] = np.where(inputs[name+'_np'] >= cfg.vocab_size, 2, inputs[name+'_np'])
+    inputs[name+'_onehot'] = one_hot_input(unk, out=onehot if reuse else None)
+    inputs[name] = unk
+    inputs[name+'_nounk'] = nounk
 
 
 class BeamSearchNode(object):
@@ -1577,23 +1720,9 @@ class Attn_Para(nn.Module):
     def forward(self, hidden, encoder_outputs, mask=False, inp_seqs=None, stop_tok=None, normalize=True):
         encoder_outputs = encoder_outputs.transpose(0, 1)  # [B,T,H]
         attn_energies = self.score(hidden, encoder_outputs)
-        if True or not mask:
-            normalized_energy = F.softmax(attn_energies, dim=2)  # [B,1,T]
-        else:
-            mask_idx = []
-            # inp_seqs: ndarray of [T,B]
-            # inp_seqs = inp_seqs.cpu().numpy()
-            for b in range(inp_seqs.shape[1]):
-                for t in range(inp_seqs.shape[0] + 1):
-                    if t == inp_seqs.shape[0] or inp_seqs[t, b] in stop_tok:
-                        mask_idx.append(t)
-                        break
-            mask = []
-            for mask_len in mask_idx:
-                mask.append([1.] * mask_len + [0.] * (inp_seqs.shape[0] - mask_len))
-            mask = cuda_(torch.FloatTensor(mask))  # [B,T]
-            attn_energies = attn_energies * mask.unsqueeze(1)
-            normalized_energy = F.softmax(attn_energies, dim=2)  # [B,1,T]
+        # inp_seqs: ndarray of [T,B]
+        mask = get_attn_mask(inp_seqs, stop_tok) if mask else None
+        normalized_energy = masked_softmax(attn_energies, mask, dim=2)  # [B,1,T]
 
         context = torch.bmm(normalized_energy, encoder_outputs)  # [B,1,H]
         return context.transpose(0, 1)  # [1,B,H]
@@ -1641,11 +1770,11 @@ class ActDecoder(nn.Module):
         u_copy_score = F.tanh(self.proj_copy(u_enc_out.transpose(0, 1)))  # [B,T,H]
         # stable version of copynet
         u_copy_score = torch.matmul(u_copy_score, gru_out.squeeze(0).unsqueeze(2)).squeeze(2)
-        u_copy_score = u_copy_score.cpu()
+        if sparse_u_input.dim() == 3:
+            u_copy_score = u_copy_score.cpu()   # dense sparse input is kept on cpu
         u_copy_score_max = torch.max(u_copy_score, dim=1, keepdim=True)[0]
         u_copy_score = torch.exp(u_copy_score - u_copy_score_max)  # [B,T]
-        u_copy_score = torch.log(torch.bmm(u_copy_score.unsqueeze(1), sparse_u_input)).squeeze(
-            1) + u_copy_score_max  # [B,V]
+        u_copy_score = torch.log(aug_copy_score(u_copy_score, sparse_u_input)) + u_copy_score_max  # [B,V]
         u_copy_score = cuda_(u_copy_score)
 
         # u_copy_score = self.inp_dropout(u_copy_score)
@@ -1694,11 +1823,11 @@ class ParaDecoder(nn.Module):
         u_copy_score = F.tanh(self.proj_copy(u_enc_out.transpose(0, 1)))  # [B,T,H]
         # stable version of copynet
         u_copy_score = torch.matmul(u_copy_score, gru_out.squeeze(0).unsqueeze(2)).squeeze(2)
-        u_copy_score = u_copy_score.cpu()
+        if sparse_u_input.dim() == 3:
+            u_copy_score = u_copy_score.cpu()   # dense sparse input is kept on cpu
         u_copy_score_max = torch.max(u_copy_score, dim=1, keepdim=True)[0]
         u_copy_score = torch.exp(u_copy_score - u_copy_score_max)  # [B,T]
-        u_copy_score = torch.log(torch.bmm(u_copy_score.unsqueeze(1), sparse_u_input)).squeeze(
-            1) + u_copy_score_max  # [B,V]
+        u_copy_score = torch.log(aug_copy_score(u_copy_score, sparse_u_input)) + u_copy_score_max  # [B,V]
         u_copy_score = cuda_(u_copy_score)
 
         # u_copy_score = self.inp_dropout(u_copy_score)
@@ -1731,13 +1860,19 @@ class Paraphrase(nn.Module):
         self.para_loss = nn.NLLLoss(ignore_index=0)
         self.act_loss = nn.NLLLoss(ignore_index=0)
 
-    def forward(self, u_input, u_input_np, para_input, prev_act_input, u_len, mode, sparse_u_input_para):
+    @bf16_autocast
+    def forward(self, u_input, u_input_np, para_input, prev_act_input, u_len, mode, sparse_u_input_para, decode=True,
+                token_sum=False):
+        """
+        :param token_sum: in train mode, return the loss as (sum over the target tokens, number of them)
+        """
         if mode == 'train':
             para_dec, para_index, para_proba, prev_act_proba = \
                 self.forward_turn(u_input=u_input, u_len=u_len, mode=mode, u_input_np=u_input_np, para_input=para_input,
-                                  prev_act_input=prev_act_input, sparse_u_input_para=sparse_u_input_para)
+                                  prev_act_input=prev_act_input, sparse_u_input_para=sparse_u_input_para,
+                                  decode=decode)
             para_loss = self.supervised_loss(torch.log(para_proba), torch.log(prev_act_proba),
-                                             para_input, prev_act_input)
+                                             para_input, prev_act_input, token_sum=token_sum)
             return para_dec, para_index, para_loss
 
         else:
@@ -1747,9 +1882,11 @@ class Paraphrase(nn.Module):
 
             return para_dec, para_index, prev_act_index
 
-    def forward_turn(self, u_input, u_len, mode, u_input_np, sparse_u_input_para, para_input=None, prev_act_input=None):
+    def forward_turn(self, u_input, u_len, mode, u_input_np, sparse_u_input_para, para_input=None, prev_act_input=None,
+                     decode=True):
         """
         compute required outputs(paraphrase) for a single dialogue turn.
+        in train mode, decode=False skips the greedy paraphrase generation and returns None as para_index.
         """
 
         batch_size = u_input.size(1)
@@ -1796,11 +1933,14 @@ class Paraphrase(nn.Module):
 
             para_proba = torch.stack(para_dec_proba, dim=0)
             para_dec_outs = torch.cat(para_dec_outs, dim=0)
-
-            p_tm1 = cuda_(torch.ones(1, batch_size).long())
-            para_index = self.para_decode(u_enc_out, p_tm1, u_input_np, last_hidden,
-                                          sparse_u_input_para=sparse_u_input_para,
-                                          a_enc_out=prev_a_dec_outs, a_input_np=a_input_np)
+            para_dec_outs = (para_dec_outs.transpose(0, 1), (para_input == 0).t().unsqueeze(1))   # [B,T,H], [B,1,T]
+
+            para_index = None
+            if decode:
+                p_tm1 = cuda_(torch.ones(1, batch_size).long())
+                para_index = self.para_decode(u_enc_out, p_tm1, u_input_np, last_hidden,
+                                              sparse_u_input_para=sparse_u_input_para,
+                                              a_enc_out=prev_a_dec_outs, a_input_np=a_input_np)
             return para_dec_outs, para_index, para_proba, prev_a_proba
 
         else:
@@ -1815,9 +1955,7 @@ class Paraphrase(nn.Module):
                 a_proba, a_index = torch.topk(proba, 1)
                 a_index = a_index.data.view(-1)
                 decoded_act.append(a_index.clone())
-                for i in range(a_index.size(0)):
-                    if a_index[i] >= cfg.vocab_size:
-                        a_index[i] = 2  # unk
+                a_index = torch.where(a_index >= cfg.vocab_size, torch.full_like(a_index, 2), a_index)  # unk
                 a_tml = cuda_(a_index.view(1, -1))
 
             a_input_np = prev_act_input.cpu().data.numpy()
@@ -1837,14 +1975,17 @@ class Paraphrase(nn.Module):
                 parat_proba, parat_index = torch.topk(proba, 1)  # [B,1]
                 parat_index = parat_index.data.view(-1)
                 decoded.append(parat_index.clone())
-                for i in range(parat_index.size(0)):
-                    if parat_index[i] >= cfg.vocab_size:
-                        parat_index[i] = 2  # unk
+                parat_index = torch.where(parat_index >= cfg.vocab_size, torch.full_like(parat_index, 2),
+                                          parat_index)  # unk
                 p_tm1 = cuda_(parat_index.view(1, -1))
 
             para_dec_outs = torch.cat(para_dec_outs, dim=0)
-            decoded = torch.stack(decoded, dim=0).transpose(0, 1)
-            decoded = list(decoded)
+            decoded = torch.stack(decoded, dim=0)   # [T,B]
+            # steps after the first generated <eos_u> are padding
+            eos = (decoded == self.vocab.encode('<eos_u>')).long()
+            para_mask = (eos.cumsum(0) - eos) > 0
+            para_dec_outs = (para_dec_outs.transpose(0, 1), para_mask.t().unsqueeze(1))   # [B,T,H], [B,1,T]
+            decoded = list(decoded.transpose(0, 1))
             return para_dec_outs, [list(_) for _ in decoded], [list(_) for _ in decoded_act]
 
     def para_decode(self, u_enc_out, p_tm1, u_input_np, last_hidden, sparse_u_input_para, a_enc_out, a_input_np):
@@ -1857,17 +1998,23 @@ class Paraphrase(nn.Module):
             parat_proba, parat_index = torch.topk(proba, 1)  # [B,1]
             parat_index = parat_index.data.view(-1)
             decoded.append(parat_index.clone())
-            for i in range(parat_index.size(0)):
-                if parat_index[i] >= cfg.vocab_size:
-                    parat_index[i] = 2  # unk
-            u_tm1 = cuda_(parat_index.view(1, -1))
+            parat_index = torch.where(parat_index >= cfg.vocab_size, torch.full_like(parat_index, 2),
+                                      parat_index)  # unk
+            p_tm1 = cuda_(parat_index.view(1, -1))
         decoded = torch.stack(decoded, dim=0).transpose(0, 1)
         decoded = list(decoded)
         return [list(_) for _ in decoded]
 
-    def supervised_loss(self, para_proba, prev_act_proba, para_input, prev_act_input):
+    @fp32
+    def supervised_loss(self, para_proba, prev_act_proba, para_input, prev_act_input, token_sum=False):
         para_proba = para_proba[:, :, :cfg.vocab_size].contiguous()
         prev_act_proba = prev_act_proba[:, :, :cfg.vocab_size].contiguous()
+        if token_sum:
+            para_loss = F.nll_loss(para_proba.view(-1, para_proba.size(2)), para_input.view(-1), ignore_index=0,
+                                   reduction='sum')
+            act_loss = F.nll_loss(prev_act_proba.view(-1, prev_act_proba.size(2)), prev_act_input.view(-1),
+                                  ignore_index=0, reduction='sum')
+            return para_loss + act_loss, (para_input != 0).long().sum() + (prev_act_input != 0).long().sum()
         para_loss = self.para_loss(para_proba.view(-1, para_proba.size(2)), para_input.view(-1))
         act_loss = self.act_loss(prev_act_proba.view(-1, prev_act_proba.size(2)), prev_act_input.view(-1))
         loss = para_loss + act_loss
@@ -1887,24 +2034,50 @@ def nan(v):
     return np.isnan(np.sum(v.data.cpu().numpy()))
 
 
+def get_sparse_input_aug_idx(x_input_np):
+    """
+    index form of the sparse input, usable by the copy mechanism without the dense tensor
+    :param x_input_np: [T,B]
+    :return: Numpy array: [B,T], position in aug_V of each token, -1 for ignored tokens
+    """
+    T = x_input_np.shape[0]
+    x_input_np = x_input_np.transpose((1, 0))
+    oov_idx = cfg.vocab_size + np.arange(T).reshape(1, -1)   # oov words are copied from their position
+    sparse_idx = np.where(x_input_np < cfg.vocab_size, x_input_np, oov_idx)
+    sparse_idx[x_input_np == 0] = -1   # <pad>
+    return sparse_idx.astype(np.int64)
+
+
 def get_sparse_input_aug(x_input_np):
     """
     sparse input of
     :param x_input_np: [T,B]
     :return: Numpy array: [B,T,aug_V]
     """
-    ignore_index = [0]
-    result = np.zeros((x_input_np.shape[0], x_input_np.shape[1], cfg.vocab_size + x_input_np.shape[0]),
-                      dtype=np.float32)
+    T, B = x_input_np.shape
+    sparse_idx = get_sparse_input_aug_idx(x_input_np)
+    result = np.zeros((B, T, cfg.vocab_size + T), dtype=np.float32)
     result.fill(1e-10)
-    for t in range(x_input_np.shape[0]):
-        for b in range(x_input_np.shape[1]):
-            w = x_input_np[t][b]
-            if w not in ignore_index:
-                if w < cfg.vocab_size:
-                    result[t][b][x_input_np[t][b]] = 1.0
-                else:
-                    result[t][b][cfg.vocab_size + t] = 1.0
-    result_np = result.transpose((1, 0, 2))
-    result = torch.from_numpy(result_np).float()
+    bidx, tidx = np.nonzero(sparse_idx >= 0)
+    result[bidx, tidx, sparse_idx[bidx, tidx]] = 1.0
+    result = torch.from_numpy(result).float()
+    return result
+
+
+@fp32
+def aug_copy_score(copy_score, sparse_input):
+    """
+    project copy scores of input positions onto the augmented vocabulary
+    :param copy_score: [B,T]
+    :param sparse_input: dense tensor [B,T,aug_V] from get_sparse_input_aug,
+                         or LongTensor [B,T] from get_sparse_input_aug_idx
+    :return: tensor of size [B,aug_V]
+    """
+    if sparse_input.dim() == 3:
+        return torch.bmm(copy_score.unsqueeze(1), sparse_input).squeeze(1)
+    aug_vocab_size = cfg.vocab_size + sparse_input.size(1)
+    valid = (sparse_input >= 0).float()
+    # every position contributes 1e-10 to every word, as the dense input does
+    result = (copy_score.sum(1, keepdim=True) * 1e-10).repeat(1, aug_vocab_size)
+    result = result.scatter_add(1, sparse_input.clamp(min=0), copy_score * valid)
     return result
@@ -1,4 +1,5 @@
-import os, random, argparse, time, logging, json, tqdm
+import os, random, argparse, time, logging, json, tqdm, copy, queue, threading, atexit, pickle
+from collections import deque
 import numpy as np
 
 import torch
@@ -10,9 +11,8 @@ from config import global_config as cfg
 from reader import MultiWozReader
 from damd_net import DAMD, cuda_, get_one_hot_input, Paraphrase
 from eval import MultiWozEvaluator
-from damd_net import get_sparse_input_aug
+from damd_net import get_sparse_input_aug_idx
 from para_analysis import realization_multiwoz, slots_match_multiwoz
-from nltk.translate.bleu_score import sentence_bleu
 from filter_eval import filter_punct
 from reader import pad_sequences
 
@@ -29,6 +29,12 @@ class Model(object):
             self.m = torch.nn.DataParallel(m, device_ids=cfg.cuda_device)
             self.m_para = torch.nn.DataParallel(m_para, device_ids=cfg.cuda_device)
             # print(self.m.module)
+        if cfg.dist_world_size > 1:
+            # one CPU replica per process, gradients are all-reduced over gloo
+            self.m = torch.nn.parallel.DistributedDataParallel(self.m, find_unused_parameters=True,
+                                                               broadcast_buffers=False)
+            self.m_para = torch.nn.parallel.DistributedDataParallel(self.m_para, find_unused_parameters=True,
+                                                                    broadcast_buffers=False)
         self.evaluator = MultiWozEvaluator(self.reader) # evaluator class
         if cfg.cuda:
             self.m = self.m.cuda()  #cfg.cuda_device[0]
@@ -36,7 +42,16 @@ class Model(object):
         self.optim = Adam(lr=cfg.lr, params=[{'params': filter(lambda x: x.requires_grad, self.m.parameters())},
                                              {'params': filter(lambda x: x.requires_grad, self.m_para.parameters())}],
                           weight_decay=5e-5)
+        self.scheduler = LRScheduler(self.optim, cfg.lr, cfg.lr_decay, cfg.weight_decay_count, cfg.warmup_steps)
         self.base_epoch = -1
+        self.quantized = False   # the decoding workers of parallel_decode quantize their copies to match
+        self.para_cache, self.para_cache_version = {}, None
+        self.ckpt_writer = CheckpointWriter(asynchronous=cfg.async_checkpoint)
+        if cfg.valid_subsample:
+            self.reader.build_dev_sample(cfg.valid_subsample)
+        # everything besides the models and optimizer that a resumed run needs to continue like an uninterrupted one
+        self.train_state = {'epoch': 0, 'iter': 0, 'batch_order': None, 'sup_loss': 0, 'sup_cnt': 0,
+                            'prev_min_loss': 1 << 30, 'early_stop_count': cfg.early_stop_count}
 
         if cfg.limit_bspn_vocab:
             self.reader.bspn_masks_tensor = {}
@@ -88,6 +103,30 @@ class Model(object):
 
         return u_input, u_input_np, delex_para_input, delex_para_input_np, u_len, prev_dial_act_input
 
+    def para_cache_lookup(self, turn_batch, turn_num, epoch):
+        """
+        paraphrases are cached by (dial_id, turn_num, version), the version of m_para changing every
+        cfg.para_cache_interval paraphrase epochs. Paraphrases are only used on odd epochs, so generations are
+        reused from interval 2 on, an interval of 1 regenerates them every time
+        :return: cached paraphrases of the turn batch, None unless all of them are cached
+        """
+        if not cfg.para_cache_interval:
+            return None
+        version = (epoch // 2) // cfg.para_cache_interval   # counted over the odd epochs using paraphrases
+        keys = [(dial_id, turn_num, version) for dial_id in turn_batch['dial_id']]
+        if not all(key in self.para_cache for key in keys):
+            return None
+        return [self.para_cache[key] for key in keys]
+
+    def para_cache_store(self, turn_batch, turn_num, epoch, para_results):
+        if not cfg.para_cache_interval:
+            return
+        version = (epoch // 2) // cfg.para_cache_interval   # counted over the odd epochs using paraphrases
+        if version != self.para_cache_version:
+            self.para_cache, self.para_cache_version = {}, version   # drop generations of an older m_para
+        for dial_id, para in zip(turn_batch['dial_id'], para_results):
+            self.para_cache[(dial_id, turn_num, version)] = para
+
     def _get_final_input(self, py_batch, para_results, epoch):
         user = py_batch['user']
         delex_user = py_batch['usdx']
@@ -117,12 +156,13 @@ class Model(object):
                 para_utter.append(self.reader.vocab.sentence_decode(para[i]))
 
             slots_match_success = slots_match_multiwoz(delex_user_utter, para_results)
+            bleu = utils.batch_sentence_bleu(
+                [[filter_punct(user_utter[i]).split(" "), filter_punct(para_utter[i]).split(" ")]
+                 for i in range(batch_size)],
+                [filter_punct(gen_para[i]).split(" ") for i in range(batch_size)])
 
             for i in range(batch_size):
-                s1 = filter_punct(user_utter[i]).split(" ")
-                s2 = filter_punct(para_utter[i]).split(" ")
-                s = filter_punct(gen_para[i]).split(" ")
-                if success[i] and slots_match_success[i] and sentence_bleu([s1, s2], s) > cfg.bleu_threshold:
+                if success[i] and slots_match_success[i] and bleu[i] > cfg.bleu_threshold:
                     good += 1
                     select = self.reader.vocab.sentence_encode(gen_para[i].split() + ['<eos_u>'])
                     delex_select = self.reader.vocab.sentence_encode(para_results[i].split() + ['<eos_u>'])
@@ -200,51 +240,62 @@ class Model(object):
             return
         new_labels = np.copy(raw_labels)
         if copy_sources:
-            bidx, tidx = np.where(raw_labels>=self.reader.vocab_size)
             copy_sources = np.concatenate(copy_sources, axis=1)
-            for b in bidx:
-                for t in tidx:
-                    oov_idx = raw_labels[b, t]
-                    if len(np.where(copy_sources[b, :] == oov_idx)[0])==0:
-                        new_labels[b, t] = 2
+            # labels that can not be copied from any source of the same example become <unk>. They are checked
+            # on every row holding an oov label crossed with every step holding one, as the original loop did
+            bidx, tidx = np.where(raw_labels>=self.reader.vocab_size)
+            checked = np.zeros(raw_labels.shape, dtype=bool)
+            checked[np.unique(bidx).reshape(-1, 1), np.unique(tidx).reshape(1, -1)] = True   # [B,T]
+            copyable = (raw_labels[:, :, None] == copy_sources[:, None, :]).any(axis=2)   # [B,T]
+            new_labels[checked & ~copyable] = 2
         return cuda_(torch.from_numpy(new_labels).long())
 
     def train(self):
-        lr = cfg.lr
-        prev_min_loss, early_stop_count = 1 << 30, cfg.early_stop_count
-        weight_decay_count = cfg.weight_decay_count
+        state = self.train_state
         train_time = 0
         sw = time.time()
+        validator = BackgroundValidator() if cfg.background_valid and cfg.dist_rank == 0 else None
 
         for epoch in range(cfg.epoch_num):
-            if epoch <= self.base_epoch:
+            if epoch <= self.base_epoch or epoch < state['epoch']:
                 continue
             self.training_adjust(epoch)
-            sup_loss = 0
-            sup_cnt = 0
+            sup_loss = state['sup_loss']
+            sup_cnt = state['sup_cnt']
             optim = self.optim
             # data_iterator generatation size: (batch num, turn num, batch size)
             btm = time.time()
-            data_iterator = self.reader.get_batches('train')
-            for iter_num, dial_batch in enumerate(data_iterator):
+            grad, accum_tokens, epoch_tokens = 0, 0, 0
+            data_iterator = self.reader.get_batches('train', order=state['batch_order'], start=state['iter'])
+            for iter_num, dial_batch in enumerate(data_iterator, state['iter']):
                 hidden_states = {}
                 py_prev = {'pv_resp': None, 'pv_bspn': None, 'pv_aspn': None, 'pv_dspn': None, 'pv_bsdx': None}
                 bgt = time.time()
                 for turn_num, turn_batch in enumerate(dial_batch):
                     # print('turn %d'%turn_num)
                     # print(len(turn_batch['dial_id']))
-                    optim.zero_grad()
+                    if not accum_tokens:
+                        optim.zero_grad()
                     
                     u_input, u_input_np, para_input, para_input_np, u_len, prev_act_input \
                         = self._convert_batch_para(turn_batch, 'train')
-                    sparse_u_input_para = get_sparse_input_aug(u_input_np)
+                    sparse_u_input_para = cuda_(torch.from_numpy(get_sparse_input_aug_idx(u_input_np)))
+                    # paraphrases are only used on odd epochs, and may be cached from an earlier epoch
+                    if epoch % 2 == 0:
+                        para_results = [''] * len(turn_batch['dial_id'])
+                    else:
+                        para_results = self.para_cache_lookup(turn_batch, turn_num, epoch)
                     para_dec_outs, para_idx, loss_para = self.m_para(u_input=u_input,
                                                                      para_input=para_input,
                                                                      prev_act_input=prev_act_input,
                                                                      u_input_np=u_input_np,
                                                                      u_len=u_len, mode="train",
-                                                                     sparse_u_input_para=sparse_u_input_para)
-                    para_results = self.reader.get_para_result(turn_batch, para_idx)
+                                                                     sparse_u_input_para=sparse_u_input_para,
+                                                                     decode=para_results is None,
+                                                                     token_sum=bool(cfg.accum_token_budget))
+                    if para_results is None:
+                        para_results = self.reader.get_para_result(turn_batch, para_idx)
+                        self.para_cache_store(turn_batch, turn_num, epoch, para_results)
                     turn_batch, weight = self._get_final_input(turn_batch, para_results, epoch)
                     
                     first_turn = (turn_num == 0)
@@ -252,7 +303,7 @@ class Model(object):
                     inputs = self.add_torch_input(inputs, first_turn=first_turn)
                     # total_loss, losses, hidden_states = self.m(inputs, hidden_states, first_turn, mode='train')
                     dial_total_loss, losses = self.m(inputs, hidden_states, first_turn, mode='train',
-                                                     para_dec=para_dec_outs)
+                                                     para_dec=para_dec_outs, token_sum=bool(cfg.accum_token_budget))
                     # print('forward completed')
                     py_prev['pv_resp'] = turn_batch['resp']
                     if cfg.enable_bspn:
@@ -263,67 +314,112 @@ class Model(object):
                     if cfg.enable_dspn:
                         py_prev['pv_dspn'] = turn_batch['dspn']
 
-                    total_loss = loss_para + dial_total_loss.mean()
+                    if cfg.accum_token_budget:
+                        # losses summed over the real target tokens of the paraphrase and dialog spans
+                        para_loss_sum, para_tokens = loss_para
+                        token_loss = para_loss_sum + dial_total_loss.sum()
+                        tokens = float(para_tokens) + float(losses['tokens'].sum())
+                        total_loss = token_loss / max(tokens, 1.)
+                    else:
+                        total_loss = loss_para + dial_total_loss.mean()
+                        tokens = float(sum((inputs[name+'_4loss'] != 0).long().sum() for name, loss in losses.items()
+                                           if name != 'aspn_aug' and torch.is_tensor(loss)))
+                    epoch_tokens += tokens
+                    loss_scale = 1.
+                    if cfg.dist_world_size > 1 and cfg.accum_token_budget:
+                        # all ranks have to update together, and DDP averages the gradients over them
+                        loss_scale, tokens = cfg.dist_world_size, all_reduce_sum(tokens)
                     # print('forward time:%f'%(time.time()-test_begin))
                     # test_begin = time.time()
-                    total_loss.backward(retain_graph=False)
+                    if cfg.accum_token_budget:
+                        # gradients of the token sums, divided by the accumulated tokens at the update
+                        (token_loss * loss_scale).backward(retain_graph=False)
+                    else:
+                        total_loss.backward(retain_graph=False)
                     # total_loss.backward(retain_graph=turn_num != len(dial_batch) - 1)
                     # print('backward time:%f'%(time.time()-test_begin))
-                    grad = torch.nn.utils.clip_grad_norm_(self.m.parameters(), 5.0)
-                    optim.step()
+                    accum_tokens += tokens
+                    if accum_tokens >= cfg.accum_token_budget:
+                        grad = self.optim_step(accum_tokens)
+                        accum_tokens = 0
                     sup_loss += float(total_loss)
                     sup_cnt += 1
-                    torch.cuda.empty_cache()
 
                 if (iter_num+1)%cfg.report_interval==0:
                     logging.info(
-                            'iter:{} [total|bspn|aspn|resp] loss: {:.2f} {:.2f} {:.2f} {:.2f} grad:{:.2f} time: {:.1f} turn:{} '.format(iter_num+1,
+                            'iter:{} [total|bspn|aspn|resp] loss: {:.2f} {:.2f} {:.2f} {:.2f} grad:{:.2f} time: {:.1f} turn:{} tok/s:{:.0f}'.format(iter_num+1,
                                                                            float(total_loss),
                                                                            float(losses[cfg.bspn_mode]),float(losses['aspn']),float(losses['resp']),
                                                                            grad,
                                                                            time.time()-btm,
-                                                                           turn_num+1))
+                                                                           turn_num+1,
+                                                                           epoch_tokens/(time.time()-btm)))
                     if cfg.enable_dst and cfg.bspn_mode == 'bsdx':
                         logging.info('bspn-dst:{:.3f}'.format(float(losses['bspn'])))
                     if cfg.multi_acts_training:
                         logging.info('aspn-aug:{:.3f}'.format(float(losses['aspn_aug'])))
 
+                if cfg.resume_interval and (iter_num+1) % cfg.resume_interval == 0:
+                    if accum_tokens:
+                        # accumulated gradients are not checkpointed
+                        grad = self.optim_step(accum_tokens)
+                        accum_tokens = 0
+                    state.update(epoch=epoch, iter=iter_num+1, batch_order=self.reader.batch_order['train'],
+                                 sup_loss=sup_loss, sup_cnt=sup_cnt)
+                    self.save_checkpoint()
+
                 # btm = time.time()
                 # if (iter_num+1)%40==0:
                 #     print('validation checking ... ')
                 #     valid_sup_loss, valid_unsup_loss = self.validate(do_test=False)
                 #     logging.info('validation loss in epoch %d sup:%f unsup:%f' % (epoch, valid_sup_loss, valid_unsup_loss))
 
+            if accum_tokens:
+                grad = self.optim_step(accum_tokens)
             epoch_sup_loss = sup_loss / (sup_cnt + 1e-8)
             # do_test = True if (epoch+1)%5==0 else False
             do_test = False
-            valid_loss = self.validate(do_test=do_test)
-            logging.info('epoch: %d, train loss: %.3f, valid loss: %.3f, total time: %.1fmin' % (epoch+1, epoch_sup_loss,
-                    valid_loss, (time.time()-sw)/60))
-            # self.save_model(epoch)
-            if valid_loss <= prev_min_loss:
-                early_stop_count = cfg.early_stop_count
-                weight_decay_count = cfg.weight_decay_count
-                prev_min_loss = valid_loss
-                self.save_model(epoch)
-            else:
-                early_stop_count -= 1
-                weight_decay_count -= 1
-                logging.info('epoch: %d early stop countdown %d' % (epoch+1, early_stop_count))
-                if not early_stop_count:
-                    self.load_model()
-                    print('result preview...')
-                    file_handler = logging.FileHandler(os.path.join(cfg.exp_path, 'eval_log%s.json'%cfg.seed))
-                    logging.getLogger('').addHandler(file_handler)
-                    logging.info(str(cfg))
-                    self.eval()
+            result = None
+            if validator is not None:
+                # validation of this epoch runs in the background, the decisions use the one of the epoch before
+                validator.submit(epoch, self.m, self.m_para, do_test)
+                logging.info('epoch: %d, train loss: %.3f, total time: %.1fmin' % (epoch+1, epoch_sup_loss,
+                        (time.time()-sw)/60))
+                if len(validator.pending) > 1:
+                    result = validator.result()
+            elif cfg.dist_rank == 0:
+                valid_loss = self.validate(do_test=do_test, epoch=epoch)
+                if valid_loss is None:
+                    logging.info('epoch: %d, train loss: %.3f, decode-based validation skipped, total time: %.1fmin' % (
+                        epoch+1, epoch_sup_loss, (time.time()-sw)/60))
+                else:
+                    logging.info('epoch: %d, train loss: %.3f, valid loss: %.3f, total time: %.1fmin' % (epoch+1,
+                            epoch_sup_loss, valid_loss, (time.time()-sw)/60))
+                result = (epoch, valid_loss)
+            if cfg.dist_world_size > 1:
+                result = sync_valid_result(result)
+            stop = result is not None and self.valid_decision(*result)
+            if stop:
+                if validator is not None:
+                    validator.close()
+                if cfg.dist_rank:
                     return
-                if not weight_decay_count:
-                    lr *= cfg.lr_decay
-                    self.optim = Adam(lr=lr, params=filter(lambda x: x.requires_grad, self.m.parameters()),
-                                  weight_decay=5e-5)
-                    weight_decay_count = cfg.weight_decay_count
-                    logging.info('learning rate decay, learning rate: %f' % (lr))
+                self.load_model()
+                print('result preview...')
+                file_handler = logging.FileHandler(os.path.join(cfg.exp_path, 'eval_log%s.json'%cfg.seed))
+                logging.getLogger('').addHandler(file_handler)
+                logging.info(str(cfg))
+                self.eval()
+                return
+            state.update(epoch=epoch+1, iter=0, batch_order=None, sup_loss=0, sup_cnt=0)
+            self.save_checkpoint()
+        if validator is not None:
+            while validator.pending:
+                if self.valid_decision(*validator.result()):
+                    break
+            validator.close()
+        if cfg.dist_rank:
+            return
         self.load_model()
         print('result preview...')
         file_handler = logging.FileHandler(os.path.join(cfg.exp_path, 'eval_log%s.json'%cfg.seed))
@@ -332,33 +428,55 @@ class Model(object):
         self.eval()
 
 
-    def validate(self, data='dev', do_test=False):
+    def valid_decision(self, epoch, valid_loss, lstd=None, lstd_para=None):
+        """
+        lr decay and early stopping on the validation loss of an epoch
+        :param lstd: model states of that epoch to save if it improved, the current ones if None
+        :return: True if training should stop
+        """
+        state = self.train_state
+        if valid_loss is None:
+            return False
+        improved = valid_loss <= state['prev_min_loss']
+        self.scheduler.epoch_step(improved)
+        if improved:
+            state['early_stop_count'] = cfg.early_stop_count
+            state['prev_min_loss'] = valid_loss
+            self.save_model(epoch, lstd=lstd, lstd_para=lstd_para)
+            return False
+        state['early_stop_count'] -= 1
+        logging.info('epoch: %d early stop countdown %d' % (epoch+1, state['early_stop_count']))
+        return not state['early_stop_count']
+
+    def fast_validate(self, data='dev'):
+        """
+        teacher-forced validation from the batched training forward pass, without decoding
+        :return: dict of the cfg.valid_loss losses averaged over turns, and the loss and token accuracy of each span
+        """
         self.m.eval()
-        valid_loss, count = 0, 0
-        data_iterator = self.reader.get_batches(data)
-        result_collection = {}
-        for batch_num, dial_batch in enumerate(data_iterator):
-            hidden_states = {}
-            py_prev = {'pv_resp': None, 'pv_bspn': None, 'pv_aspn':None, 'pv_dspn': None, 'pv_bsdx': None}
-            for turn_num, turn_batch in enumerate(dial_batch):
-
-                u_input, u_input_np, para_input, para_input_np, u_len, prev_act_input \
-                    = self._convert_batch_para(turn_batch, 'train')
-                sparse_u_input_para = Variable(get_sparse_input_aug(u_input_np), requires_grad=False)
-                para_dec_outs, _, loss_para = self.m_para(u_input=u_input,
-                                                          para_input=para_input,
-                                                          u_input_np=u_input_np,
-                                                          u_len=u_len, mode="train",
-                                                          prev_act_input=prev_act_input,
-                                                          sparse_u_input_para=sparse_u_input_para)
-
-                first_turn = (turn_num == 0)
-                inputs = self.reader.convert_batch(turn_batch, py_prev, first_turn=first_turn)
-                inputs = self.add_torch_input(inputs, first_turn=first_turn)
-                # total_loss, losses, hidden_states = self.m(inputs, hidden_states, first_turn, mode='train')
-                if cfg.valid_loss not in ['score', 'match', 'success', 'bleu']:
-                    valid_loss += float(loss_para)
-                    total_loss, losses = self.m(inputs, hidden_states, first_turn, mode='train', para_dec=para_dec_outs)
+        loss_sum = {'total_loss': 0, 'bspn_loss': 0, 'aspn_loss': 0, 'resp_loss': 0}
+        span_loss, span_correct, span_tokens = {}, {}, {}
+        count = 0
+        with torch.no_grad():
+            for batch_num, dial_batch in enumerate(self.reader.get_batches(data)):
+                hidden_states = {}
+                py_prev = {'pv_resp': None, 'pv_bspn': None, 'pv_aspn':None, 'pv_dspn': None, 'pv_bsdx': None}
+                for turn_num, turn_batch in enumerate(dial_batch):
+                    u_input, u_input_np, para_input, para_input_np, u_len, prev_act_input \
+                        = self._convert_batch_para(turn_batch, 'train')
+                    sparse_u_input_para = cuda_(torch.from_numpy(get_sparse_input_aug_idx(u_input_np)))
+                    para_dec_outs, _, loss_para = self.m_para(u_input=u_input,
+                                                              para_input=para_input,
+                                                              u_input_np=u_input_np,
+                                                              u_len=u_len, mode="train",
+                                                              prev_act_input=prev_act_input,
+                                                              sparse_u_input_para=sparse_u_input_para,
+                                                              decode=False)
+
+                    first_turn = (turn_num == 0)
+                    inputs = self.reader.convert_batch(turn_batch, py_prev, first_turn=first_turn)
+                    inputs = self.add_torch_input(inputs, first_turn=first_turn)
+                    total_loss, losses = self.m(inputs, hidden_states, first_turn, mode='valid', para_dec=para_dec_outs)
                     py_prev['pv_resp'] = turn_batch['resp']
                     if cfg.enable_bspn:
                         py_prev['pv_bspn'] = turn_batch['bspn']
@@ -368,17 +486,70 @@ class Model(object):
                     if cfg.enable_dspn:
                         py_prev['pv_dspn'] = turn_batch['dspn']
 
-                    if cfg.valid_loss == 'total_loss':
-                        valid_loss += float(total_loss)
-                    elif cfg.valid_loss == 'bspn_loss':
-                        valid_loss += float(losses[cfg.bspn_mode])
-                    elif cfg.valid_loss == 'aspn_loss':
-                        valid_loss += float(losses['aspn'])
-                    elif cfg.valid_loss == 'resp_loss':
-                        valid_loss += float(losses['reps'])
-                    else:
-                        raise ValueError('Invalid validation loss type!')
-                else:
+                    turn_losses = {'total_loss': total_loss, 'bspn_loss': losses[cfg.bspn_mode],
+                                   'aspn_loss': losses['aspn'], 'resp_loss': losses['resp']}
+                    for key, loss in turn_losses.items():
+                        loss_sum[key] += float(loss_para) + float(loss)
+                    for name in ['bspn', 'bsdx', 'aspn', 'dspn', 'resp']:
+                        if name+'_tokens' in losses:
+                            tokens = float(losses[name+'_tokens'])
+                            span_loss[name] = span_loss.get(name, 0) + float(losses[name]) * tokens
+                            span_correct[name] = span_correct.get(name, 0) + float(losses[name+'_correct'])
+                            span_tokens[name] = span_tokens.get(name, 0) + tokens
+                    count += 1
+
+        metrics = {key: loss / (count + 1e-8) for key, loss in loss_sum.items()}
+        log_str = 'validation [TF]'
+        for name, tokens in span_tokens.items():
+            metrics[name+'_loss'] = span_loss[name] / (tokens + 1e-8)
+            metrics[name+'_acc'] = 100 * span_correct[name] / (tokens + 1e-8)
+            log_str += '  %s loss: %.3f acc: %2.1f' % (name, metrics[name+'_loss'], metrics[name+'_acc'])
+        logging.info(log_str)
+        self.m.train()
+        return metrics
+
+    def validate(self, data='dev', do_test=False, epoch=None):
+        """
+        :param epoch: with cfg.full_valid_interval > 1 the decode-based metrics only run every that many epochs,
+            and the teacher-forced ones are logged every epoch to compare with them
+        :return: validation loss, None if the decode-based validation is skipped in this epoch
+        """
+        if cfg.valid_loss not in ['score', 'match', 'success', 'bleu']:
+            valid_loss = self.fast_validate(data)[cfg.valid_loss]
+            if do_test:
+                print('result preview...')
+                self.eval()
+            return valid_loss
+        if cfg.full_valid_interval > 1:
+            self.fast_validate(data)
+            if epoch is not None and (epoch+1) % cfg.full_valid_interval:
+                return None
+        if cfg.valid_subsample and data == 'dev':
+            data = 'dev_sample'
+
+        self.m.eval()
+        data_iterator = self.reader.get_batches(data)
+        result_collection = {}
+        with torch.no_grad():
+            for batch_num, dial_batch in enumerate(data_iterator):
+                hidden_states = {}
+                py_prev = {'pv_resp': None, 'pv_bspn': None, 'pv_aspn':None, 'pv_dspn': None, 'pv_bsdx': None}
+                for turn_num, turn_batch in enumerate(dial_batch):
+
+                    u_input, u_input_np, para_input, para_input_np, u_len, prev_act_input \
+                        = self._convert_batch_para(turn_batch, 'train')
+                    sparse_u_input_para = cuda_(torch.from_numpy(get_sparse_input_aug_idx(u_input_np)))
+                    para_dec_outs, _, loss_para = self.m_para(u_input=u_input,
+                                                              para_input=para_input,
+                                                              u_input_np=u_input_np,
+                                                              u_len=u_len, mode="train",
+                                                              prev_act_input=prev_act_input,
+                                                              sparse_u_input_para=sparse_u_input_para,
+                                                              decode=False)
+
+                    first_turn = (turn_num == 0)
+                    inputs = self.reader.convert_batch(turn_batch, py_prev, first_turn=first_turn)
+                    inputs = self.add_torch_input(inputs, first_turn=first_turn)
                     decoded = self.m(inputs, hidden_states, first_turn, mode='test', para_dec=para_dec_outs)
                     turn_batch['resp_gen'] = decoded['resp']
                     if cfg.bspn_mode == 'bspn' or cfg.enable_dst:
@@ -391,21 +562,15 @@ class Model(object):
                         py_prev['pv_aspn'] = turn_batch['aspn'] if cfg.use_true_prev_aspn else decoded['aspn']
                     if cfg.enable_dspn:
                         py_prev['pv_dspn'] = turn_batch['dspn'] if cfg.use_true_prev_dspn else decoded['dspn']
-                count += 1
-                torch.cuda.empty_cache()
+                    torch.cuda.empty_cache()
 
-            if cfg.valid_loss in ['score', 'match', 'success', 'bleu']:
                 result_collection.update(self.reader.inverse_transpose_batch(dial_batch))
 
-
-        if cfg.valid_loss not in ['score', 'match', 'success', 'bleu']:
-            valid_loss /= (count + 1e-8)
-        else:
-            results, _ = self.reader.wrap_result(result_collection)
-            bleu, success, match = self.evaluator.validation_metric(results)
-            score = 0.5 * (success + match) + bleu
-            valid_loss = 130 - score
-            logging.info('validation [CTR] match: %2.1f  success: %2.1f  bleu: %2.1f'%(match, success, bleu))
+        results, _ = self.reader.wrap_result(result_collection)
+        bleu, success, match = self.evaluator.validation_metric(results)
+        score = 0.5 * (success + match) + bleu
+        valid_loss = 130 - score
+        logging.info('validation [CTR] match: %2.1f  success: %2.1f  bleu: %2.1f'%(match, success, bleu))
         self.m.train()
         if do_test:
             print('result preview...')
@@ -416,67 +581,12 @@ class Model(object):
         self.m.eval()
         self.reader.result_file = None
         result_collection = {}
-        data_iterator = self.reader.get_batches(data)
-        for batch_num, dial_batch in tqdm.tqdm(enumerate(data_iterator)):
-            # quit()
-            # if batch_num > 0:
-            #     continue
-            hidden_states = {}
-            prev_act = None
-            py_prev = {'pv_resp': None, 'pv_bspn': None, 'pv_aspn':None, 'pv_dspn': None, 'pv_bsdx':None}
-            print('batch_size:', len(dial_batch[0]['resp']))
-            for turn_num, turn_batch in enumerate(dial_batch):
-                # print('turn %d'%turn_num)
-                # if turn_num!=0 and turn_num<4:
-                #     continue
-                u_input, u_input_np, para_input, para_input_np, u_len, prev_act_input \
-                    = self._convert_batch_para(turn_batch, 'test', prev_act)
-                sparse_u_input_para = Variable(get_sparse_input_aug(u_input_np), requires_grad=False)
-                para_dec_outs, _, prev_act_idx = self.m_para(u_input=u_input,
-                                                             para_input=para_input,
-                                                             u_input_np=u_input_np,
-                                                             u_len=u_len, mode='test',
-                                                             prev_act_input=prev_act_input,
-                                                             sparse_u_input_para=sparse_u_input_para)
-                first_turn = (turn_num == 0)
-                inputs = self.reader.convert_batch(turn_batch, py_prev, first_turn=first_turn)
-                inputs = self.add_torch_input(inputs, first_turn=first_turn)
-                decoded = self.m(inputs, hidden_states, first_turn, mode='test', para_dec=para_dec_outs)
-                turn_batch['resp_gen'] = decoded['resp']
-                if cfg.bspn_mode == 'bsdx':
-                    turn_batch['bsdx_gen'] = decoded['bsdx'] if cfg.enable_bspn else [[0]] * len(decoded['resp'])
-                if cfg.bspn_mode == 'bspn' or cfg.enable_dst:
-                    turn_batch['bspn_gen'] = decoded['bspn'] if cfg.enable_bspn else [[0]] * len(decoded['resp'])
-                turn_batch['aspn_gen'] = decoded['aspn'] if cfg.enable_aspn else [[0]] * len(decoded['resp'])
-                turn_batch['dspn_gen'] = decoded['dspn'] if cfg.enable_dspn else [[0]] * len(decoded['resp'])
-
-                if self.reader.multi_acts_record is not None:
-                    turn_batch['multi_act_gen'] = self.reader.multi_acts_record
-                if cfg.record_mode:
-                    turn_batch['multi_act'] = self.reader.aspn_collect
-                    turn_batch['multi_resp'] = self.reader.resp_collect
-                # print(turn_batch['user'])
-                # print('user:', self.reader.vocab.sentence_decode(turn_batch['user'][0] , eos='<eos_u>', indicate_oov=True))
-                # print('resp:', self.reader.vocab.sentence_decode(decoded['resp'][0] , eos='<eos_r>', indicate_oov=True))
-                # print('bspn:', self.reader.vocab.sentence_decode(decoded['bspn'][0] , eos='<eos_b>', indicate_oov=True))
-                # for b in range(len(decoded['resp'])):
-                #     for i in range(5):
-                #         print('aspn:', self.reader.vocab.sentence_decode(decoded['aspn'][i][b] , eos='<eos_a>', indicate_oov=True))
-
-                py_prev['pv_resp'] = turn_batch['resp'] if cfg.use_true_pv_resp else decoded['resp']
-                if cfg.enable_bspn:
-                    py_prev['pv_'+cfg.bspn_mode] = turn_batch[cfg.bspn_mode] if cfg.use_true_prev_bspn else decoded[cfg.bspn_mode]
-                    py_prev['pv_bspn'] = turn_batch['bspn'] if cfg.use_true_prev_bspn or 'bspn' not in decoded else decoded['bspn']
-                if cfg.enable_aspn:
-                    py_prev['pv_aspn'] = turn_batch['aspn'] if cfg.use_true_prev_aspn else decoded['aspn']
-                if cfg.enable_dspn:
-                    py_prev['pv_dspn'] = turn_batch['dspn'] if cfg.use_true_prev_dspn else decoded['dspn']
-                torch.cuda.empty_cache()
-
-                prev_act = prev_act_idx
-                # prev_z = turn_batch['bspan']
-            # print('test iter %d'%(batch_num+1))
-            result_collection.update(self.reader.inverse_transpose_batch(dial_batch))
+        if cfg.infer_workers > 1:
+            batch_results = self.parallel_decode(data)
+        else:
+            batch_results = self.decode_batches(data)
+        for batch_result in batch_results:
+            result_collection.update(batch_result)
 
         # self.reader.result_file.close()
         if cfg.record_mode:
@@ -501,9 +611,172 @@ class Model(object):
         self.reader.save_result_report(metric_results)
         # self.reader.metric_record(metric_results)
         self.m.train()
-        return None
+        return metric_results[0]
 
-    def save_model(self, epoch, path=None, path_para=None, critical=False):
+    def decode_batches(self, data='test', order=None):
+        """
+        :param order: batch order to decode, see reader.get_batches
+        :return: list of the decoded dialogues of each batch, in batch order
+        """
+        batch_results = []
+        data_iterator = self.reader.get_batches(data, order=order)
+        with torch.no_grad():
+            for batch_num, dial_batch in tqdm.tqdm(enumerate(data_iterator)):
+                # quit()
+                # if batch_num > 0:
+                #     continue
+                hidden_states = {}
+                prev_act = None
+                py_prev = {'pv_resp': None, 'pv_bspn': None, 'pv_aspn':None, 'pv_dspn': None, 'pv_bsdx':None}
+                print('batch_size:', len(dial_batch[0]['resp']))
+                for turn_num, turn_batch in enumerate(dial_batch):
+                    # print('turn %d'%turn_num)
+                    # if turn_num!=0 and turn_num<4:
+                    #     continue
+                    u_input, u_input_np, para_input, para_input_np, u_len, prev_act_input \
+                        = self._convert_batch_para(turn_batch, 'test', prev_act)
+                    sparse_u_input_para = cuda_(torch.from_numpy(get_sparse_input_aug_idx(u_input_np)))
+                    para_dec_outs, _, prev_act_idx = self.m_para(u_input=u_input,
+                                                                 para_input=para_input,
+                                                                 u_input_np=u_input_np,
+                                                                 u_len=u_len, mode='test',
+                                                                 prev_act_input=prev_act_input,
+                                                                 sparse_u_input_para=sparse_u_input_para)
+                    first_turn = (turn_num == 0)
+                    inputs = self.reader.convert_batch(turn_batch, py_prev, first_turn=first_turn)
+                    inputs = self.add_torch_input(inputs, first_turn=first_turn)
+                    decoded = self.m(inputs, hidden_states, first_turn, mode='test', para_dec=para_dec_outs)
+                    turn_batch['resp_gen'] = decoded['resp']
+                    if cfg.bspn_mode == 'bsdx':
+                        turn_batch['bsdx_gen'] = decoded['bsdx'] if cfg.enable_bspn else [[0]] * len(decoded['resp'])
+                    if cfg.bspn_mode == 'bspn' or cfg.enable_dst:
+                        turn_batch['bspn_gen'] = decoded['bspn'] if cfg.enable_bspn else [[0]] * len(decoded['resp'])
+                    turn_batch['aspn_gen'] = decoded['aspn'] if cfg.enable_aspn else [[0]] * len(decoded['resp'])
+                    turn_batch['dspn_gen'] = decoded['dspn'] if cfg.enable_dspn else [[0]] * len(decoded['resp'])
+
+                    if self.reader.multi_acts_record is not None:
+                        turn_batch['multi_act_gen'] = self.reader.multi_acts_record
+                    if cfg.record_mode:
+                        turn_batch['multi_act'] = self.reader.aspn_collect
+                        turn_batch['multi_resp'] = self.reader.resp_collect
+                    # print(turn_batch['user'])
+                    # print('user:', self.reader.vocab.sentence_decode(turn_batch['user'][0] , eos='<eos_u>', indicate_oov=True))
+                    # print('resp:', self.reader.vocab.sentence_decode(decoded['resp'][0] , eos='<eos_r>', indicate_oov=True))
+                    # print('bspn:', self.reader.vocab.sentence_decode(decoded['bspn'][0] , eos='<eos_b>', indicate_oov=True))
+                    # for b in range(len(decoded['resp'])):
+                    #     for i in range(5):
+                    #         print('aspn:', self.reader.vocab.sentence_decode(decoded['aspn'][i][b] , eos='<eos_a>', indicate_oov=True))
+
+                    py_prev['pv_resp'] = turn_batch['resp'] if cfg.use_true_pv_resp else decoded['resp']
+                    if cfg.enable_bspn:
+                        py_prev['pv_'+cfg.bspn_mode] = turn_batch[cfg.bspn_mode] if cfg.use_true_prev_bspn else decoded[cfg.bspn_mode]
+                        py_prev['pv_bspn'] = turn_batch['bspn'] if cfg.use_true_prev_bspn or 'bspn' not in decoded else decoded['bspn']
+                    if cfg.enable_aspn:
+                        py_prev['pv_aspn'] = turn_batch['aspn'] if cfg.use_true_prev_aspn else decoded['aspn']
+                    if cfg.enable_dspn:
+                        py_prev['pv_dspn'] = turn_batch['dspn'] if cfg.use_true_prev_dspn else decoded['dspn']
+                    torch.cuda.empty_cache()
+
+                    prev_act = prev_act_idx
+                    # prev_z = turn_batch['bspan']
+                # print('test iter %d'%(batch_num+1))
+                batch_results.append(self.reader.inverse_transpose_batch(dial_batch))
+        return batch_results
+
+    def parallel_decode(self, data='test', order=None):
+        """
+        decode with cfg.infer_workers single-threaded CPU processes, each one on a strided shard of the batches
+        :param order: batch order to decode, drawn as in a single-process run if None
+        :return: list of the decoded dialogues of each batch, in batch order
+        """
+        if order is None:
+            next(self.reader.get_batches(data), None)
+            order = self.reader.batch_order[data]
+        num = min(cfg.infer_workers, len(order))
+        # the workers decode with the weights of this process, not those saved at cfg.model_path
+        lstd = cpu_snapshot(unwrap_state_dict(self.m.state_dict()))
+        lstd_para = cpu_snapshot(unwrap_state_dict(self.m_para.state_dict()))
+        ctx = torch.multiprocessing.get_context('spawn')
+        results = ctx.Queue()
+        workers = [ctx.Process(target=decode_worker,
+                               args=(dict(cfg.__dict__), i, data, order[i::num], results, lstd, lstd_para,
+                                     self.quantized),
+                               daemon=True) for i in range(num)]
+        for w in workers:
+            w.start()
+        shards = {}
+        while len(shards) < num:
+            try:
+                i, shard = results.get(timeout=10)
+            except queue.Empty:
+                if not all(w.is_alive() or w.exitcode == 0 for w in workers):
+                    raise RuntimeError('decoding worker exited with code %s' % [w.exitcode for w in workers])
+                continue
+            if isinstance(shard, Exception):
+                raise shard
+            shards[i] = shard
+        for w in workers:
+            w.join()
+        return [shards[pos % num][pos // num] for pos in range(len(order))]
+
+    def benchmark_inference(self, data='test'):
+        """
+        time the decoding of cfg.infer_bench_batches batches (0 for all) under a grid of thread and worker numbers
+        """
+        cpus = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else (os.cpu_count() or 1)
+        next(self.reader.get_batches(data), None)
+        order = self.reader.batch_order[data]
+        if cfg.infer_bench_batches:
+            order = order[:cfg.infer_bench_batches]
+        candidates = sorted(set([1, 2, 4, cpus // 2, cpus]) - {0})
+        configs = [(t, 1) for t in candidates if t <= cpus] + [(1, w) for w in candidates if 1 < w <= cpus]
+        default = (cfg.infer_threads, cfg.infer_workers)
+        self.m.eval()
+        timing = []
+        for threads, workers in configs:
+            cfg.infer_threads, cfg.infer_workers = threads, workers
+            set_cpu_threads(threads, cfg.infer_interop_threads)
+            sw = time.time()
+            if workers > 1:
+                self.parallel_decode(data, order)
+            else:
+                self.decode_batches(data, order)
+            timing.append((time.time() - sw, threads, workers))
+            logging.info('threads: %d workers: %d  %.1fs  %.2f batch/s' % (threads, workers, timing[-1][0],
+                                                                        len(order) / timing[-1][0]))
+        cfg.infer_threads, cfg.infer_workers = default
+        best = min(timing)
+        logging.info('fastest: infer_threads=%d infer_workers=%d (%.1fs)' % (best[1], best[2], best[0]))
+        self.m.train()
+        return timing
+
+    def quantize(self):
+        if cfg.cuda:
+            logging.warning('dynamic quantization is for CPU inference, running in fp32')
+            return
+        self.m = quantize_dynamic(self.m)
+        self.m_para = quantize_dynamic(self.m_para)
+        self.quantized = True
+        logging.info('Model quantized to int8')
+
+    def quantize_guard(self, data='test'):
+        """
+        evaluate in fp32 and then with int8 dynamic quantization, and log the metric deltas and decoding times.
+        The result files are left with the int8 results
+        """
+        sw = time.time()
+        fp32 = self.eval(data)
+        fp32_time = time.time() - sw
+        self.quantize()
+        sw = time.time()
+        int8 = self.eval(data)
+        int8_time = time.time() - sw
+        for key in ['bleu', 'match', 'success']:
+            logging.info('%s fp32: %.3f int8: %.3f delta: %+.3f' % (key, fp32[key], int8[key], int8[key] - fp32[key]))
+        logging.info('decoding time fp32: %.1fs int8: %.1fs speedup: %.2fx' % (fp32_time, int8_time,
+                                                                             fp32_time / int8_time))
+
+    def save_model(self, epoch, path=None, path_para=None, critical=False, lstd=None, lstd_para=None):
         if not cfg.save_log:
             return
         if not path:
@@ -513,14 +786,15 @@ class Model(object):
         if critical:
             path += '.final'
             path_para += '.final'
-        all_state = {'lstd': self.m.state_dict(),
+        # saved without the DataParallel/DistributedDataParallel wrapper, so any run configuration can load them
+        all_state = {'lstd': unwrap_state_dict(self.m.state_dict() if lstd is None else lstd),
                      'config': cfg.__dict__,
                      'epoch': epoch}
-        all_state_para = {'lstd': self.m_para.state_dict(),
+        all_state_para = {'lstd': unwrap_state_dict(self.m_para.state_dict() if lstd_para is None else lstd_para),
                           'config': cfg.__dict__,
                           'epoch': epoch}
-        torch.save(all_state, path)
-        torch.save(all_state_para, path_para)
+        self.ckpt_writer.save(all_state, path)
+        self.ckpt_writer.save(all_state_para, path_para)
         logging.info('Model saved')
 
     def load_model(self, path=None, path_para=None):
@@ -528,13 +802,80 @@ class Model(object):
             path = cfg.model_path
         if not path_para:
             path_para = cfg.para_model_path
+        self.ckpt_writer.flush()
         all_state = torch.load(path, map_location='cpu')
-        self.m.load_state_dict(all_state['lstd'])
+        unwrap_model(self.m).load_state_dict(unwrap_state_dict(all_state['lstd']))
         all_state_para = torch.load(path_para, map_location='cpu')
-        self.m_para.load_state_dict(all_state_para['lstd'])
+        unwrap_model(self.m_para).load_state_dict(unwrap_state_dict(all_state_para['lstd']))
         self.base_epoch = all_state.get('epoch', 0)
         logging.info('Model loaded')
 
+    def optim_step(self, accum_tokens):
+        """
+        update with the gradients accumulated since the last one. With cfg.accum_token_budget they are gradients of
+        the losses summed over the real target tokens, so dividing by their number gives a per-token mean
+        """
+        if cfg.accum_token_budget:
+            for group in self.optim.param_groups:
+                for p in group['params']:
+                    if p.grad is not None:
+                        p.grad.div_(accum_tokens)
+        grad = torch.nn.utils.clip_grad_norm_(self.m.parameters(), 5.0)
+        torch.nn.utils.clip_grad_norm_(self.m_para.parameters(), 5.0)
+        self.optim.step()
+        self.scheduler.step()
+        torch.cuda.empty_cache()
+        return grad
+
+    def save_checkpoint(self, path=None):
+        """
+        resume checkpoint: models, optimizer, train_state (decay counters, epoch/batch cursor and batch order),
+        paraphrase cache and the python/numpy/torch RNG streams, those of every rank in a distributed run
+        """
+        rng = get_rng_state()
+        if cfg.dist_world_size > 1:
+            rng = all_gather_object(rng)
+        if not cfg.save_log:
+            return
+        if not path:
+            path = os.path.join(cfg.exp_path, 'resume.pkl')
+        all_state = {'lstd': unwrap_state_dict(self.m.state_dict()),
+                     'lstd_para': unwrap_state_dict(self.m_para.state_dict()),
+                     'optim': self.optim.state_dict(),
+                     'scheduler': self.scheduler.state_dict(),
+                     'train_state': self.train_state,
+                     'para_cache': (self.para_cache, self.para_cache_version),
+                     'rng': rng,
+                     'dist_rand': self.reader.dist_rand.getstate(),
+                     'config': cfg.__dict__}
+        self.ckpt_writer.save(all_state, path)
+
+    def load_checkpoint(self, path=None):
+        if not path:
+            path = os.path.join(cfg.exp_path, 'resume.pkl')
+        self.ckpt_writer.flush()
+        all_state = torch.load(path, map_location='cpu')
+        unwrap_model(self.m).load_state_dict(unwrap_state_dict(all_state['lstd']))
+        unwrap_model(self.m_para).load_state_dict(unwrap_state_dict(all_state['lstd_para']))
+        self.train_state = all_state['train_state']
+        self.optim.load_state_dict(all_state['optim'])
+        self.scheduler.load_state_dict(all_state['scheduler'])
+        self.para_cache, self.para_cache_version = all_state['para_cache']
+        self.reader.dist_rand.setstate(all_state['dist_rand'])
+        rng = all_state['rng']
+        if isinstance(rng, list):   # saved by a distributed run, one per rank
+            rng = rng[cfg.dist_rank] if cfg.dist_rank < len(rng) else None
+        elif cfg.dist_rank:
+            rng = None   # saved by a single process, the other ranks need streams of their own
+        if rng is not None:
+            set_rng_state(rng)
+        else:
+            torch.manual_seed(cfg.seed + cfg.dist_rank)
+            random.seed(cfg.seed + cfg.dist_rank)
+            np.random.seed(cfg.seed + cfg.dist_rank)
+        logging.info('Checkpoint loaded, resume from epoch %d batch %d' % (self.train_state['epoch']+1,
+                                                                         self.train_state['iter']))
+
     def training_adjust(self, epoch):
         return
 
@@ -586,6 +927,375 @@ def parse_arg_cfg(args):
     return
 
 
+class LRScheduler(object):
+    """
+    Sets the learning rate of every param group of the optimizer in place, so the Adam moments and both models
+    stay in optimization: linear warmup over the first warmup_steps updates, then decay by lr_decay whenever
+    validation has not improved for decay_count epochs.
+    """
+    def __init__(self, optimizer, lr, lr_decay, decay_count, warmup_steps=0):
+        self.optimizer = optimizer
+        self.lr_decay = lr_decay
+        self.decay_count = decay_count
+        self.warmup_steps = warmup_steps
+        self.lr = lr
+        self.countdown = decay_count
+        self.step_num = 0
+        self._apply()
+
+    def step(self):
+        """called after every optimizer update"""
+        self.step_num += 1
+        if self.step_num <= self.warmup_steps:
+            self._apply()
+
+    def epoch_step(self, improved):
+        """called after every validation"""
+        self.countdown = self.decay_count if improved else self.countdown - 1
+        if not self.countdown:
+            self.lr *= self.lr_decay
+            self.countdown = self.decay_count
+            self._apply()
+            logging.info('learning rate decay, learning rate: %f' % self.lr)
+
+    def _apply(self):
+        scale = min(1., (self.step_num + 1) / self.warmup_steps) if self.warmup_steps else 1.
+        for group in self.optimizer.param_groups:
+            group['lr'] = self.lr * scale
+
+    def state_dict(self):
+        return {'lr': self.lr, 'countdown': self.countdown, 'step_num': self.step_num}
+
+    def load_state_dict(self, state):
+        self.lr, self.countdown, self.step_num = state['lr'], state['countdown'], state['step_num']
+        self._apply()
+
+
+# kept identical to CamRest676/model.py by MultiWOZ/tests/test_shared_helpers.py
+def cpu_snapshot(obj):
+    """
+    copy of a (nested) checkpoint state with every tensor copied to CPU memory, so training can go on
+    updating the originals while the copy is written
+    """
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        snapshot = type(obj)((k, cpu_snapshot(v)) for k, v in obj.items())
+        if hasattr(obj, '_metadata'):
+            snapshot._metadata = copy.deepcopy(obj._metadata)   # state_dict versions used by load_state_dict
+        return snapshot
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(cpu_snapshot(v) for v in obj)
+    return copy.deepcopy(obj)
+
+
+class CheckpointWriter(object):
+    """
+    Writes checkpoints from a background thread. save() only snapshots the state to CPU memory; each file is
+    written to a temp file and renamed, so a checkpoint on disk is always complete. Only the last keep_num files
+    of a series are kept (0 keeps all), and pending writes are flushed before loading and on exit.
+    """
+    def __init__(self, keep_num=0, asynchronous=True):
+        self.keep_num = keep_num
+        self.asynchronous = asynchronous
+        self.series = {}
+        self.error = None
+        if asynchronous:
+            self.queue = queue.Queue()
+            self.worker = threading.Thread(target=self._work, daemon=True)
+            self.worker.start()
+            atexit.register(self.close)
+
+    def save(self, state, path, series=None):
+        sw = time.time()
+        state = cpu_snapshot(state)
+        if self.asynchronous:
+            self.queue.put((state, path, series))
+        else:
+            self._write(state, path, series)
+        logging.info('checkpoint %s, training stalled %.3fs' % (path, time.time() - sw))
+
+    def flush(self):
+        if self.asynchronous:
+            self.queue.join()
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def close(self):
+        if self.asynchronous and self.worker.is_alive():
+            self.queue.put(None)
+            self.worker.join()
+
+    def _work(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                self._write(*item)
+            except Exception as e:
+                logging.error('checkpoint writing failed: %s' % e)
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def _write(self, state, path, series):
+        tmp_path = path + '.tmp'
+        torch.save(state, tmp_path)
+        os.replace(tmp_path, path)
+        if series is None:
+            return
+        paths = self.series.setdefault(series, [])
+        if path in paths:
+            paths.remove(path)
+        paths.append(path)
+        while self.keep_num and len(paths) > self.keep_num:
+            old_path = paths.pop(0)
+            if os.path.exists(old_path):
+                os.remove(old_path)
+
+
+class BackgroundValidator(object):
+    """
+    Validates epoch-end snapshots of the models in a separate CPU process while training goes on. Results come
+    back in submission order, together with the snapshots so an improved epoch can still be saved.
+    """
+    def __init__(self):
+        ctx = torch.multiprocessing.get_context('spawn')
+        self.jobs, self.results = ctx.Queue(), ctx.Queue()
+        self.pending = deque()   # (epoch, lstd, lstd_para) of the submitted snapshots
+        self.process = ctx.Process(target=background_valid_worker, args=(dict(cfg.__dict__), self.jobs, self.results),
+                                   daemon=True)
+        self.process.start()
+        atexit.register(self.close)
+
+    def submit(self, epoch, m, m_para, do_test=False):
+        lstd, lstd_para = cpu_snapshot(m.state_dict()), cpu_snapshot(m_para.state_dict())
+        self.pending.append((epoch, lstd, lstd_para))
+        self.jobs.put((epoch, lstd, lstd_para, do_test))
+
+    def result(self):
+        """
+        wait for the oldest pending validation
+        :return: epoch, valid loss, lstd, lstd_para
+        """
+        epoch, lstd, lstd_para = self.pending.popleft()
+        while True:
+            try:
+                _, valid_loss = self.results.get(timeout=10)
+                break
+            except queue.Empty:
+                if not self.process.is_alive():
+                    raise RuntimeError('background validation process exited with code %s' % self.process.exitcode)
+        if isinstance(valid_loss, Exception):
+            raise valid_loss
+        return epoch, valid_loss, lstd, lstd_para
+
+    def close(self):
+        self.pending.clear()
+        if self.process.is_alive():
+            self.jobs.put(None)
+            self.process.join(timeout=60)
+            if self.process.is_alive():
+                self.process.terminate()
+
+
+def background_valid_worker(cfg_dict, jobs, results):
+    """
+    process of the BackgroundValidator: a CPU copy of the models that runs validate on each snapshot it gets
+    """
+    for k, v in cfg_dict.items():
+        setattr(cfg, k, v)
+    cfg.cuda, cfg.cuda_device, cfg.multi_gpu = False, cfg.cuda_device[:1], False
+    cfg.background_valid, cfg.dist_world_size = False, 1
+    cfg._init_logging_handler(cfg.mode)
+    model = Model()
+    while True:
+        job = jobs.get()
+        if job is None:
+            return
+        epoch, lstd, lstd_para, do_test = job
+        try:
+            model.m.load_state_dict(unwrap_state_dict(lstd))
+            model.m_para.load_state_dict(unwrap_state_dict(lstd_para))
+            logging.info('background validation of epoch %d' % (epoch+1))
+            valid_loss = model.validate(do_test=do_test, epoch=epoch)
+            if valid_loss is not None:
+                logging.info('epoch: %d, valid loss: %.3f' % (epoch+1, valid_loss))
+        except Exception as e:
+            valid_loss = e
+        results.put((epoch, valid_loss))
+
+
+def unwrap_model(m):
+    """
+    module wrapped by DataParallel/DistributedDataParallel, or m itself
+    """
+    return m.module if isinstance(m, (torch.nn.DataParallel, torch.nn.parallel.DistributedDataParallel)) else m
+
+
+def unwrap_state_dict(lstd):
+    """
+    state dict of a DataParallel/DistributedDataParallel model with the keys of the wrapped module
+    """
+    return {(k[len('module.'):] if k.startswith('module.') else k): v for k, v in lstd.items()}
+
+
+def all_reduce_sum(value):
+    t = torch.tensor([float(value)])
+    torch.distributed.all_reduce(t)
+    return float(t)
+
+
+def all_gather_object(obj):
+    """
+    :return: the picklable obj of every rank of a distributed run, in rank order
+    """
+    data = torch.from_numpy(np.frombuffer(pickle.dumps(obj), dtype=np.uint8).copy())
+    sizes = [torch.zeros(1).long() for _ in range(cfg.dist_world_size)]
+    torch.distributed.all_gather(sizes, torch.tensor([data.numel()]).long())
+    max_size = int(max(sizes))
+    data = torch.cat([data, data.new_zeros(max_size - data.numel())])
+    gathered = [data.new_zeros(max_size) for _ in range(cfg.dist_world_size)]
+    torch.distributed.all_gather(gathered, data)
+    return [pickle.loads(t[:int(size)].numpy().tobytes()) for t, size in zip(gathered, sizes)]
+
+
+def sync_valid_result(result):
+    """
+    share the validation result of rank 0 with the other ranks, so they take the same lr decay and early stopping
+    decisions; the model snapshots stay on rank 0
+    :param result: (epoch, valid loss, ...) on rank 0 or None if there is none this epoch
+    """
+    t = torch.tensor([-1., 0.])
+    if result is not None:
+        t[0] = result[0]
+        t[1] = float('nan') if result[1] is None else result[1]
+    torch.distributed.broadcast(t, 0)
+    if t[0] < 0:
+        return None
+    if cfg.dist_rank == 0:
+        return result
+    valid_loss = float(t[1])
+    return int(t[0]), None if valid_loss != valid_loss else valid_loss
+
+
+def dist_train(rank, cfg_dict):
+    """
+    one process of a cfg.dist_world_size training run: a DistributedDataParallel CPU replica on the gloo backend
+    that trains on its shard of every dialogue batch. Rank 0 validates, logs and saves
+    """
+    for k, v in cfg_dict.items():
+        setattr(cfg, k, v)
+    cfg.dist_rank = rank
+    cfg.cuda, cfg.cuda_device, cfg.multi_gpu = False, cfg.cuda_device[:1], False
+    cfg.save_log = cfg.save_log and rank == 0
+    cfg._init_logging_handler(cfg.mode)
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // cfg.dist_world_size))
+    torch.distributed.init_process_group('gloo', init_method=cfg.dist_url, rank=rank,
+                                         world_size=cfg.dist_world_size)
+
+    # data splits and initial weights are the same on all ranks, dropout and sampling are not
+    torch.manual_seed(cfg.seed)
+    random.seed(cfg.seed)
+    np.random.seed(cfg.seed)
+    m = Model()
+    torch.manual_seed(cfg.seed + rank)
+    random.seed(cfg.seed + rank)
+    np.random.seed(cfg.seed + rank)
+    cfg.model_parameters = m.count_params()
+    if cfg.save_log:
+        logging.info(str(cfg))
+        m.reader.vocab.save_vocab(cfg.vocab_path_eval)
+        with open(os.path.join(cfg.exp_path, 'config.json'), 'w') as f:
+            json.dump(cfg.__dict__, f, indent=2)
+    if cfg.resume and os.path.exists(os.path.join(cfg.exp_path, 'resume.pkl')):
+        m.load_checkpoint()
+    m.train()
+    torch.distributed.destroy_process_group()
+
+
+# kept identical to CamRest676/model.py by MultiWOZ/tests/test_shared_helpers.py
+def set_cpu_threads(num_threads=0, interop_threads=0, cpus=None):
+    """
+    :param num_threads: intra-op threads of torch, 0 keeps the default
+    :param interop_threads: inter-op threads, 0 keeps the default (only settable in torch>=1.2, before any parallel work)
+    :param cpus: cpu ids to pin this process to
+    """
+    if num_threads:
+        torch.set_num_threads(num_threads)
+    if interop_threads and hasattr(torch, 'set_num_interop_threads'):
+        try:
+            torch.set_num_interop_threads(interop_threads)
+        except RuntimeError as e:
+            logging.warning('inter-op threads not set: %s' % e)
+    if cpus and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cpus)
+
+
+def decode_worker(cfg_dict, worker_id, data, order, results, lstd, lstd_para, quantized=False):
+    """
+    process of Model.parallel_decode: a single-threaded CPU copy of the models that decodes the batches of order
+    :param lstd, lstd_para: CPU snapshots of the model states of the parent process
+    :param quantized: whether the models of the parent process are int8 quantized, and so their states
+    """
+    for k, v in cfg_dict.items():
+        setattr(cfg, k, v)
+    cfg.cuda, cfg.cuda_device, cfg.multi_gpu = False, cfg.cuda_device[:1], False
+    cfg.infer_workers, cfg.background_valid, cfg.dist_world_size = 1, False, 1
+    cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else []
+    set_cpu_threads(1, 1, [cpus[worker_id % len(cpus)]] if cfg.infer_pin_cpus and cpus else None)
+    # the same data splits as the parent process
+    torch.manual_seed(cfg.seed)
+    random.seed(cfg.seed)
+    np.random.seed(cfg.seed)
+    try:
+        model = Model()
+        if quantized:
+            model.quantize()
+        model.m.load_state_dict(lstd)
+        model.m_para.load_state_dict(lstd_para)
+        model.m.eval()
+        shard = model.decode_batches(data, order)
+    except Exception as e:
+        shard = e
+    results.put((worker_id, shard))
+
+
+def quantize_dynamic(module):
+    """
+    int8 dynamic quantization of the nn.GRU and nn.Linear layers (encoders, decoders, output and copy projections)
+    for CPU inference. Layers this torch cannot quantize stay in fp32
+    """
+    quantization = getattr(torch, 'quantization', None)
+    if quantization is None or not hasattr(quantization, 'quantize_dynamic'):
+        logging.warning('dynamic quantization needs torch>=1.3, running in fp32')
+        return module
+    layers = {torch.nn.Linear}
+    if hasattr(torch.nn.quantized.dynamic, 'GRU'):
+        layers.add(torch.nn.GRU)
+    else:
+        logging.warning('this torch has no dynamic quantized GRU, GRUs stay in fp32')
+    return quantization.quantize_dynamic(module, layers, dtype=torch.qint8)
+
+
+# kept identical to CamRest676/model.py by MultiWOZ/tests/test_shared_helpers.py
+def get_rng_state():
+    return {'python': random.getstate(),
+            'numpy': np.random.get_state(),
+            'torch': torch.get_rng_state(),
+            'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else []}
+
+
+def set_rng_state(rng):
+    random.setstate(rng['python'])
+    np.random.set_state(rng['numpy'])
+    torch.set_rng_state(rng['torch'])
+    if rng['cuda'] and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(rng['cuda'])
+
+
 def main():
     if not os.path.exists('./experiments'):
         os.mkdir('./experiments')
@@ -596,7 +1306,7 @@ def main():
     args = parser.parse_args()
 
     cfg.mode = args.mode
-    if args.mode == 'test' or args.mode=='adjust':
+    if args.mode == 'test' or args.mode=='adjust' or args.mode == 'bench':
         parse_arg_cfg(args)
         cfg_load = json.loads(open(os.path.join(cfg.eval_load_path, 'config.json'), 'r').read())
         for k, v in cfg_load.items():
@@ -607,7 +1317,9 @@ def main():
                         'limit_bspn_vocab', 'limit_aspn_vocab', 'same_eval_as_cambridge', 'beam_width',
                         'use_true_domain_for_ctr_eval', 'use_true_prev_dspn', 'aspn_decode_mode',
                         'beam_diverse_param', 'same_eval_act_f1_as_hdsa', 'topk_num', 'nucleur_p',
-                        'act_selection_scheme', 'beam_penalty_type', 'record_mode']:
+                        'act_selection_scheme', 'beam_penalty_type', 'record_mode', 'infer_threads',
+                        'infer_interop_threads', 'infer_workers', 'infer_pin_cpus', 'infer_bench_batches',
+                        'quantize', 'quantize_guard', 'dist_world_size', 'dist_rank']:
                 continue
             setattr(cfg, k, v)
             cfg.model_path = os.path.join(cfg.eval_load_path, 'model.pkl')
@@ -619,7 +1331,7 @@ def main():
             cfg.exp_path = 'experiments/{}_{}_sd{}_lr{}_bs{}_sp{}_dc{}/'.format('-'.join(cfg.exp_domains),
                                                                                             cfg.exp_no, cfg.seed, cfg.lr, cfg.batch_size,
                                                                                             cfg.early_stop_count, cfg.weight_decay_count)
-            if cfg.save_log:
+            if cfg.save_log and not (cfg.resume and os.path.exists(cfg.exp_path)):
                 os.mkdir(cfg.exp_path)
             cfg.model_path = os.path.join(cfg.exp_path, 'model.pkl')
             cfg.result_path = os.path.join(cfg.exp_path, 'result.csv')
@@ -628,6 +1340,9 @@ def main():
             cfg.eval_load_path = cfg.exp_path
 
     cfg._init_logging_handler(args.mode)
+    if args.mode == 'train' and cfg.dist_world_size > 1:
+        torch.multiprocessing.spawn(dist_train, args=(dict(cfg.__dict__),), nprocs=cfg.dist_world_size)
+        return
     if cfg.cuda:
         if len(cfg.cuda_device)==1:
             cfg.multi_gpu = False
@@ -639,6 +1354,9 @@ def main():
         logging.info('Device: {}'.format(torch.cuda.current_device()))
 
 
+    if args.mode in ['test', 'bench'] and not cfg.cuda:
+        set_cpu_threads(cfg.infer_threads, cfg.infer_interop_threads)
+
     torch.manual_seed(cfg.seed)
     torch.cuda.manual_seed(cfg.seed)
     random.seed(cfg.seed)
@@ -654,6 +1372,8 @@ def main():
             with open(os.path.join(cfg.exp_path, 'config.json'), 'w') as f:
                 json.dump(cfg.__dict__, f, indent=2)
         # m.load_glove_embedding()
+        if cfg.resume and os.path.exists(os.path.join(cfg.exp_path, 'resume.pkl')):
+            m.load_checkpoint()
         m.train()
     elif args.mode == 'adjust':
         m.load_model(cfg.model_path)
@@ -661,7 +1381,15 @@ def main():
     elif args.mode == 'test':
         m.load_model(cfg.model_path)
         # m.train()
-        m.eval(data='test')
+        if cfg.quantize and cfg.quantize_guard:
+            m.quantize_guard(data='test')
+        else:
+            if cfg.quantize:
+                m.quantize()
+            m.eval(data='test')
+    elif args.mode == 'bench':
+        m.load_model(cfg.model_path)
+        m.benchmark_inference(data='test')
 
 
 
@@ -14,6 +14,9 @@ class _ReaderBase(object):
         self.train, self.dev, self.test = [], [], []
         self.vocab = None
         self.db = None
+        self.batch_order = {}
+        self.dev_sample = []
+        self.dist_rand = random.Random(cfg.seed)   # training batch order shared by the ranks of a distributed run
 
     def _bucket_by_turn(self, encoded_data):
         turn_bucket = {}
@@ -99,18 +102,28 @@ class _ReaderBase(object):
         return dialogs
 
 
-    def get_batches(self, set_name):
+    def get_batches(self, set_name, order=None, start=0):
+        """
+        :param order: batch order to replay, shuffled if None; the order used is kept in self.batch_order[set_name]
+        :param start: index of the first batch to yield
+        in a distributed run every training batch is split over the ranks, each one yields its own shard
+        """
         global dia_count
         log_str = ''
-        name_to_set = {'train': self.train, 'test': self.test, 'dev': self.dev}
+        name_to_set = {'train': self.train, 'test': self.test, 'dev': self.dev, 'dev_sample': self.dev_sample}
         dial = name_to_set[set_name]
         turn_bucket = self._bucket_by_turn(dial)
+        shard = cfg.dist_world_size > 1 and set_name == 'train'
         # self._shuffle_turn_bucket(turn_bucket)
         all_batches = []
         for k in turn_bucket:
             if set_name != 'test' and k==1 or k>=17:
                 continue
             batches = self._construct_mini_batch(turn_bucket[k])
+            if shard:
+                batches = [batch for batch in batches if len(batch) >= cfg.dist_world_size]
+                if not batches:
+                    continue
             log_str += "turn num:%d, dial num: %d, batch num: %d last batch len: %d\n"%(
                     k, len(turn_bucket[k]), len(batches), len(batches[-1]))
             # print("turn num:%d, dial num:v%d, batch num: %d, "%(k, len(turn_bucket[k]), len(batches)))
@@ -119,11 +132,29 @@ class _ReaderBase(object):
         # print('total batch num: %d'%len(all_batches))
         # print('dialog count: %d'%dia_count)
         # return all_batches
-        random.shuffle(all_batches)
-        for i, batch in enumerate(all_batches):
+        if order is None:
+            order = list(range(len(all_batches)))
+            (self.dist_rand if shard else random).shuffle(order)
+        self.batch_order[set_name] = order
+        for i in order[start:]:
+            batch = all_batches[i]
+            if shard:
+                batch = batch[cfg.dist_rank::cfg.dist_world_size]
             yield self.transpose_batch(batch)
 
 
+    def build_dev_sample(self, num):
+        """
+        fixed subsample of about num dev dialogues, drawn from each turn number in proportion to its size
+        """
+        rand = random.Random(cfg.seed)
+        turn_bucket = self._bucket_by_turn(self.dev)
+        ratio = min(1., num / max(1, len(self.dev)))
+        self.dev_sample = []
+        for k in sorted(turn_bucket):
+            dials = turn_bucket[k]
+            self.dev_sample += rand.sample(dials, max(1, int(round(len(dials) * ratio))))
+
     def save_result(self, write_mode, results, field, write_title=False):
         with open(cfg.result_path, write_mode) as rf:
             if write_title:
@@ -441,6 +472,49 @@ class MultiWozReader(_ReaderBase):
 
         return acts
 
+    def aspan_to_act_ids(self, aspans):
+        """
+        batched aspan_to_act_list over token ids, equal act ids for equal act strings
+        :param aspans: [N,T] act span token ids
+        :return: row index [K] and act id [K] of every act
+        """
+        if getattr(self, '_act_token_vocab', None) != len(self.vocab._idx2word):
+            # 0: value, 1: domain, 2: act, 3: other bracket token
+            kind = np.zeros(max(self.vocab._idx2word) + 1, dtype=np.int64)
+            for idx, w in self.vocab._idx2word.items():
+                if '[' in w:
+                    kind[idx] = 1 if w[1:-1] in ontology.dialog_acts else 2 if w[1:-1] in ontology.dialog_act_params else 3
+            self._act_token_kind, self._act_token_vocab = kind, len(self.vocab._idx2word)
+        kind = self._act_token_kind
+        eos, none = self.vocab.encode('<eos_a>'), self.vocab._word2idx.get('none', -1)
+        N, T = aspans.shape
+        pos = np.arange(T).reshape(1, -1)
+        valid = np.cumsum(aspans == eos, axis=1) == 0
+        k = kind[aspans]
+        stop = (k > 0) | (valid == 0)
+        last_dom = np.maximum.accumulate(np.where((k == 1) & valid, pos, -1), axis=1)
+        last_stop = np.maximum.accumulate(np.where(stop, pos, -1), axis=1)
+        act_ok = (k == 2) & valid & (last_dom >= 0)
+        rows = np.arange(N).reshape(-1, 1).repeat(T, axis=1)
+
+        # acts with values: value tokens whose closest bracket token before them is an act of a domain
+        val_ok = (k == 0) & valid & (last_stop >= 0)
+        val_ok[val_ok] = act_ok[rows[val_ok], last_stop[val_ok]]
+        val_r, val_t = np.nonzero(val_ok)
+        act_t = last_stop[val_r, val_t]
+        val = aspans[val_r, val_t]
+        # acts without values are recorded as '-none'
+        next_stop = np.concatenate([stop[:, 1:], np.ones((N, 1), dtype=bool)], axis=1)
+        none_r, none_t = np.nonzero(act_ok & next_stop)
+
+        act_r = np.concatenate([val_r, none_r])
+        act_t = np.concatenate([act_t, none_t])
+        val = np.concatenate([np.where(val == none, 0, val + 1), np.zeros(len(none_r), dtype=val.dtype)])
+        size = len(kind) + 1
+        dom = aspans[act_r, last_dom[act_r, act_t]].astype(np.int64)
+        act = aspans[act_r, act_t].astype(np.int64)
+        return act_r, (dom * size + act) * size + val.astype(np.int64)
+
     def dspan_to_domain(self, dspan):
         domains = {}
         dspan = dspan.split() if isinstance(dspan, str) else dspan
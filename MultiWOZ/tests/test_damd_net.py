@@ -0,0 +1,198 @@
+import types
+
+import numpy as np
+import pytest
+
+torch = pytest.importorskip('torch')
+import torch.nn.functional as F
+from torch.autograd import Variable
+
+from config import global_config as cfg
+cfg.cuda = False
+
+import damd_net
+
+
+def get_sparse_input_aug_loop(x_input_np):
+    """
+    dense sparse input of the original implementation
+    """
+    ignore_index = [0]
+    result = np.zeros((x_input_np.shape[0], x_input_np.shape[1], cfg.vocab_size + x_input_np.shape[0]),
+                      dtype=np.float32)
+    result.fill(1e-10)
+    for t in range(x_input_np.shape[0]):
+        for b in range(x_input_np.shape[1]):
+            w = x_input_np[t][b]
+            if w not in ignore_index:
+                if w < cfg.vocab_size:
+                    result[t][b][x_input_np[t][b]] = 1.0
+                else:
+                    result[t][b][cfg.vocab_size + t] = 1.0
+    result_np = result.transpose((1, 0, 2))
+    return torch.from_numpy(result_np).float()
+
+
+def random_padded_input(rng, T, B):
+    """
+    [T,B] token ids with oov words and trailing pads
+    """
+    x = rng.randint(1, cfg.vocab_size + 50, size=(T, B))
+    lengths = rng.randint(1, T + 1, size=B)
+    x[np.arange(T).reshape(-1, 1) >= lengths.reshape(1, -1)] = 0
+    return x
+
+
+def test_sparse_input_aug_matches_loop():
+    rng = np.random.RandomState(0)
+    for _ in range(10):
+        x = random_padded_input(rng, rng.randint(1, 20), rng.randint(1, 8))
+        assert torch.equal(damd_net.get_sparse_input_aug(x), get_sparse_input_aug_loop(x))
+
+
+def test_aug_copy_score_index_matches_dense():
+    rng = np.random.RandomState(1)
+    torch.manual_seed(1)
+    for _ in range(10):
+        T, B = rng.randint(1, 20), rng.randint(1, 8)
+        x = random_padded_input(rng, T, B)
+        copy_score = torch.rand(B, T)
+        dense = damd_net.aug_copy_score(copy_score, damd_net.get_sparse_input_aug(x))
+        index = damd_net.aug_copy_score(copy_score, torch.from_numpy(damd_net.get_sparse_input_aug_idx(x)))
+        assert torch.allclose(dense, index, rtol=1e-5, atol=1e-12)
+
+
+class ScriptedDecoder:
+    """
+    decoder stub predicting a fixed id sequence and recording the inputs it is fed
+    """
+    def __init__(self, predictions, vocab_size):
+        self.predictions = predictions   # [T,B]
+        self.vocab_size = vocab_size
+        self.inputs = []
+
+    def forward(self, p_tm1, last_hidden, **kwargs):
+        self.inputs.append(p_tm1.clone())
+        pred = self.predictions[len(self.inputs) - 1]
+        proba = torch.zeros(pred.size(0), self.vocab_size + 10).scatter_(1, pred.view(-1, 1), 1.)
+        return None, last_hidden, proba
+
+
+def test_para_decode_feeds_back_clamped_predictions(monkeypatch):
+    monkeypatch.setattr(cfg, 'max_para_len', 6, raising=False)
+    torch.manual_seed(0)
+    predictions = torch.randint(0, cfg.vocab_size + 10, (cfg.max_para_len, 4)).long()
+    decoder = ScriptedDecoder(predictions, cfg.vocab_size)
+    model = types.SimpleNamespace(p_decoder=decoder)
+    go = torch.ones(1, 4).long()
+    decoded = damd_net.Paraphrase.para_decode(model, None, go, None, None, None, None, None)
+
+    assert [[int(w) for w in row] for row in decoded] == predictions.t().tolist()
+    unk_clamped = predictions.masked_fill(predictions >= cfg.vocab_size, 2)
+    assert torch.equal(torch.cat(decoder.inputs, 0), torch.cat([go, unk_clamped[:-1]], 0))
+
+
+def random_padded_states(B, T, H):
+    """
+    encoder outputs [B,T,H] with token ids [B,T] padded after a random length per row
+    """
+    lengths = torch.randint(1, T + 1, (B,)).long()
+    tokens = torch.randint(3, 50, (B, T)).long()
+    tokens = tokens.masked_fill(torch.arange(T).long().view(1, -1) >= lengths.view(-1, 1), 0)
+    return torch.randn(B, T, H), tokens, lengths
+
+
+def test_attn_gives_pads_zero_weight():
+    torch.manual_seed(0)
+    attn = damd_net.Attn(8)
+    enc_out, tokens, lengths = random_padded_states(5, 7, 8)
+    hidden = torch.randn(1, 5, 8)
+    mask = (tokens == 0).unsqueeze(1)   # [B,1,T]
+    weights = damd_net.masked_softmax(attn.score(hidden, enc_out), mask, dim=2)
+    assert float(weights.masked_select(mask).abs().sum()) == 0.
+    context = attn(hidden, enc_out, mask)
+    for b in range(5):
+        n = int(lengths[b])
+        unpadded = attn(hidden[:, b:b + 1], enc_out[b:b + 1, :n])
+        assert torch.allclose(context[b:b + 1], unpadded, atol=1e-6)
+
+
+def test_attn_para_gives_pads_and_stop_zero_weight():
+    torch.manual_seed(1)
+    attn = damd_net.Attn_Para(8)
+    enc_out, tokens, lengths = random_padded_states(5, 7, 8)
+    tokens[0, 2] = 60   # stop token, it and every later position are ignored
+    lengths[0] = min(int(lengths[0]), 2)
+    hidden = torch.randn(1, 5, 8)
+    context = attn(hidden, enc_out.transpose(0, 1), mask=True, inp_seqs=tokens.t().numpy(), stop_tok=[60])
+    for b in range(5):
+        n = int(lengths[b])
+        unpadded = attn(hidden[:, b:b + 1], enc_out[b:b + 1, :n].transpose(0, 1))
+        assert torch.allclose(context[:, b:b + 1], unpadded, atol=1e-6)
+
+
+def test_copy_scores_give_pads_zero_weight():
+    torch.manual_seed(2)
+    copy = damd_net.Copy(8)
+    enc_out, tokens, _ = random_padded_states(5, 7, 8)
+    mask = (tokens == 0).unsqueeze(1)   # [B,1,T]
+    scores = copy(enc_out, torch.randn(5, 3, 8), mask)   # [B,Tdec,T]
+    weights = F.softmax(scores, dim=2)
+    assert float(weights.masked_select(mask.expand_as(weights)).abs().sum()) == 0.
+
+
+def test_encode_pv_reuses_rows_without_changing_outputs():
+    torch.manual_seed(3)
+    encoder = damd_net.biGRUencoder(torch.nn.Embedding(50, cfg.embed_size)).eval()
+    model = types.SimpleNamespace(training=False)
+    hidden_states = {}
+    ids = torch.randint(1, 50, (6, 5)).long()
+    with torch.no_grad():
+        for turn in range(6):
+            if turn:
+                rows = torch.randint(0, 6, (2,)).long()
+                ids = ids.clone()
+                ids[rows, torch.randint(0, 5, (1,)).long()] = torch.randint(1, 50, (1,)).long()
+            if turn == 4:
+                ids = torch.cat([ids, torch.zeros(6, 1).long()], 1)   # new padded length, nothing reused
+            enc, last_h = damd_net.DAMD.encode_pv(model, 'pv_aspn', encoder, {'pv_aspn': ids}, hidden_states)
+            ref_enc, ref_last_h = encoder(ids)
+            assert torch.allclose(enc, ref_enc, atol=1e-6)
+            assert torch.allclose(last_h, ref_last_h, atol=1e-6)
+
+
+def label_smoothing_dense(labels, smoothing_rate, vocab_size_oov):
+    """
+    dense smoothed one-hot labels of the original implementation
+    """
+    with torch.no_grad():
+        confidence = 1.0 - smoothing_rate
+        low_confidence = (1.0 - confidence) / labels.new_tensor(vocab_size_oov - 1)
+        y_tensor = labels.data if isinstance(labels, Variable) else labels
+        y_tensor = y_tensor.type(torch.LongTensor).contiguous().view(-1, 1)
+        n_dims = vocab_size_oov
+        y_one_hot = torch.zeros(y_tensor.size()[0], n_dims).fill_(low_confidence).scatter_(1, y_tensor, confidence)
+        y_one_hot = y_one_hot.view(*labels.shape, -1)
+    return y_one_hot
+
+
+def test_label_smoothing_nll_matches_dense_labels():
+    torch.manual_seed(4)
+    for smoothing_rate in [0.1, 0.3]:
+        logprob = torch.log_softmax(torch.randn(4, 6, 30), dim=2)
+        labels = torch.randint(0, 30, (4, 6)).long()
+        dense = -(label_smoothing_dense(labels, smoothing_rate, 30) * logprob).sum((1, 2)).mean()
+        assert torch.allclose(damd_net.label_smoothing_nll(logprob, labels, smoothing_rate), dense, atol=1e-5)
+
+
+def test_token_accuracy_counts_non_pad_argmax_hits():
+    torch.manual_seed(5)
+    probs = {'resp': torch.rand(3, 5, 12), 'aspn': torch.rand(3, 4, 12), 'aspn_aug': [torch.rand(1, 4, 12)]}
+    inputs = {'resp_4loss': torch.randint(0, 12, (3, 5)).long(), 'aspn_4loss': torch.randint(0, 12, (3, 4)).long()}
+    counts = damd_net.DAMD.token_accuracy(None, inputs, probs)
+    assert sorted(counts) == ['aspn_correct', 'aspn_tokens', 'resp_correct', 'resp_tokens']
+    for name in ['resp', 'aspn']:
+        label, pred = inputs[name+'_4loss'].tolist(), probs[name].argmax(2).tolist()
+        pairs = [(w, p) for row, prow in zip(label, pred) for w, p in zip(row, prow) if w != 0]
+        assert int(counts[name+'_tokens']) == len(pairs)
+        assert int(counts[name+'_correct']) == sum(w == p for w, p in pairs)
@@ -0,0 +1,377 @@
+import logging
+import random
+import re
+import types
+
+import numpy as np
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from config import global_config as cfg
+cfg.cuda = False
+
+import model
+from model import Model, LRScheduler, CheckpointWriter, get_rng_state
+from reader import _ReaderBase
+
+
+def index_for_loss_loop(raw_labels, copy_sources, vocab_size):
+    """
+    oov label replacement of the original implementation
+    """
+    new_labels = np.copy(raw_labels)
+    bidx, tidx = np.where(raw_labels>=vocab_size)
+    copy_sources = np.concatenate(copy_sources, axis=1)
+    for b in bidx:
+        for t in tidx:
+            oov_idx = raw_labels[b, t]
+            if len(np.where(copy_sources[b, :] == oov_idx)[0])==0:
+                new_labels[b, t] = 2
+    return torch.from_numpy(new_labels).long()
+
+
+def test_index_for_loss_matches_loop():
+    vocab_size = 20
+    model = types.SimpleNamespace(reader=types.SimpleNamespace(vocab_size=vocab_size))
+    rng = np.random.RandomState(0)
+    for _ in range(50):
+        B, T = rng.randint(1, 6), rng.randint(1, 10)
+        inputs = {}
+        for name in ['bspn', 'user', 'pv_resp', 'pv_bspn']:
+            x = rng.randint(1, vocab_size + 6, size=(B, rng.randint(1, 10) if name != 'bspn' else T))
+            x[:, rng.randint(1, x.shape[1] + 1):] = 0   # <pad>
+            inputs[name+'_np'] = x
+        sources = [inputs['user_np'], inputs['pv_resp_np'], inputs['pv_bspn_np']]
+        assert torch.equal(Model.index_for_loss(model, 'bspn', inputs),
+                           index_for_loss_loop(inputs['bspn_np'], sources, vocab_size))
+
+
+def make_trainer(seed):
+    """
+    stand-in for Model with small models and the optimizer, scheduler and checkpoint writer of training
+    """
+    torch.manual_seed(seed)
+    m, m_para = torch.nn.Linear(4, 1), torch.nn.Linear(4, 1)
+    optim = torch.optim.Adam(list(m.parameters()) + list(m_para.parameters()), lr=cfg.lr)
+    return types.SimpleNamespace(m=m, m_para=m_para, optim=optim, scheduler=LRScheduler(optim, cfg.lr, 0.5, 2, 3),
+                                 train_state={'epoch': 0, 'iter': 0}, para_cache={}, para_cache_version={},
+                                 ckpt_writer=CheckpointWriter(asynchronous=False),
+                                 reader=types.SimpleNamespace(dist_rand=random.Random(cfg.seed)))
+
+
+def train_step(trainer):
+    """
+    one update drawing from the python, numpy and torch random streams
+    """
+    x = torch.randn(8, 4) * float(np.random.rand()) + random.random()
+    loss = (trainer.m(torch.nn.functional.dropout(x, 0.5, True)) - trainer.m_para(x)).pow(2).mean()
+    trainer.optim.zero_grad()
+    loss.backward()
+    trainer.optim.step()
+    trainer.scheduler.step()
+    trainer.train_state['iter'] += 1
+    if trainer.train_state['iter'] % 2 == 0:
+        trainer.scheduler.epoch_step(improved=False)
+    return float(loss)
+
+
+def test_resume_reproduces_uninterrupted_losses(tmp_path, monkeypatch):
+    monkeypatch.setattr(cfg, 'save_log', True)
+    path = str(tmp_path / 'resume.pkl')
+    random.seed(0)
+    np.random.seed(0)
+    trainer = make_trainer(0)
+    uninterrupted = [train_step(trainer) for _ in range(8)]
+
+    random.seed(0)
+    np.random.seed(0)
+    trainer = make_trainer(0)
+    losses = [train_step(trainer) for _ in range(3)]
+    Model.save_checkpoint(trainer, path)
+    for _ in range(2):
+        train_step(trainer)   # progress lost to the interruption
+    resumed = make_trainer(1)
+    Model.load_checkpoint(resumed, path)
+    losses += [train_step(resumed) for _ in range(5)]
+    assert losses == uninterrupted
+
+
+def test_distributed_resume_restores_each_rank_streams_and_batch_order(tmp_path, monkeypatch):
+    monkeypatch.setattr(cfg, 'save_log', True)
+    monkeypatch.setattr(cfg, 'dist_world_size', 2)
+    path = str(tmp_path / 'resume.pkl')
+    trainer = make_trainer(0)
+    trainer.reader.dist_rand.shuffle(list(range(10)))   # batch order of the epochs before the interruption
+    rank_rng = []
+    for rank in range(2):
+        random.seed(100 + rank)
+        np.random.seed(100 + rank)
+        torch.manual_seed(100 + rank)
+        rank_rng.append(get_rng_state())
+    monkeypatch.setattr(model, 'all_gather_object', lambda obj: rank_rng)
+    Model.save_checkpoint(trainer, path)
+    next_order = list(range(10))
+    trainer.reader.dist_rand.shuffle(next_order)
+
+    for rank in range(2):
+        monkeypatch.setattr(cfg, 'dist_rank', rank)
+        resumed = make_trainer(1)
+        Model.load_checkpoint(resumed, path)
+        order = list(range(10))
+        resumed.reader.dist_rand.shuffle(order)
+        assert order == next_order
+        draws = random.random(), float(np.random.rand()), float(torch.rand(1))
+        random.seed(100 + rank)
+        np.random.seed(100 + rank)
+        torch.manual_seed(100 + rank)
+        assert draws == (random.random(), float(np.random.rand()), float(torch.rand(1)))
+
+
+class Interrupted(Exception):
+    pass
+
+
+class StubReader(_ReaderBase):
+    """
+    12 dialogues of two or three turns, batched and ordered by the real get_batches. A generated paraphrase is a
+    draw from the python random stream
+    """
+    def __init__(self):
+        super(StubReader, self).__init__()
+        for dial_id in range(12):
+            self.train.append([{'dial_id': dial_id, 'x': dial_id + 0.1 * turn_num, 'resp': [], 'bspn': [], 'bsdx': [],
+                                'aspn': []} for turn_num in range(2 + dial_id % 3 // 2)])
+
+    def get_para_result(self, turn_batch, gen_p):
+        return ['%.6f' % random.random() for _ in turn_batch['dial_id']]
+
+    def convert_batch(self, turn_batch, py_prev, first_turn=False):
+        return {'x': torch.tensor(turn_batch['x']),
+                'para': torch.tensor([float(para or 0) for para in turn_batch['final_user']]),
+                'tokens': torch.tensor([1 + dial_id % 3 for dial_id in turn_batch['dial_id']])}
+
+
+class StubDialogLoss(torch.nn.Module):
+    def __init__(self):
+        super(StubDialogLoss, self).__init__()
+        self.linear = torch.nn.Linear(2, 1)
+        self.losses = []
+
+    def forward(self, inputs, hidden_states, first_turn, mode='train', para_dec=None, token_sum=False):
+        x = torch.stack([inputs['x'] + float(np.random.rand()), inputs['para'] + para_dec], dim=1)
+        loss = self.linear(torch.nn.functional.dropout(x, 0.5, True)).pow(2).view(-1)
+        self.losses.append(float(loss.sum()))
+        return loss, {'resp': loss}
+
+
+class StubParaLoss(torch.nn.Module):
+    def __init__(self):
+        super(StubParaLoss, self).__init__()
+        self.linear = torch.nn.Linear(1, 1)
+
+    def forward(self, u_input, mode='train', **kwargs):
+        para_dec = self.linear(u_input.view(-1, 1)).view(-1)
+        return para_dec, None, para_dec.pow(2).mean()
+
+
+class StubModel(Model):
+    """
+    Model.train and its checkpoints over the stub reader and models, the turn losses drawing from the python, numpy
+    and torch random streams. Training raises Interrupted right after the checkpoint numbered interrupt_at
+    """
+    dialog_loss, para_loss = StubDialogLoss, StubParaLoss
+
+    def __init__(self, seed, interrupt_at=0):
+        torch.manual_seed(seed)
+        self.reader = StubReader()
+        self.m, self.m_para = self.dialog_loss(), self.para_loss()
+        self.optim = torch.optim.Adam([{'params': self.m.parameters()}, {'params': self.m_para.parameters()}],
+                                      lr=cfg.lr)
+        self.scheduler = LRScheduler(self.optim, cfg.lr, cfg.lr_decay, cfg.weight_decay_count, cfg.warmup_steps)
+        self.base_epoch = -1
+        self.para_cache, self.para_cache_version = {}, None
+        self.ckpt_writer = CheckpointWriter(asynchronous=False)
+        self.train_state = {'epoch': 0, 'iter': 0, 'batch_order': None, 'sup_loss': 0, 'sup_cnt': 0,
+                            'prev_min_loss': 1 << 30, 'early_stop_count': cfg.early_stop_count}
+        self.saves, self.interrupt_at = 0, interrupt_at
+
+    def _convert_batch_para(self, py_batch, mode, prev_a_py=None):
+        u_input = torch.tensor(py_batch['x'])
+        return u_input, u_input.numpy(), None, None, None, None
+
+    def _get_final_input(self, py_batch, para_results, epoch):
+        py_batch['final_user'] = para_results
+        return py_batch, 1.0
+
+    def add_torch_input(self, inputs, mode='train', first_turn=False):
+        inputs['resp_4loss'] = torch.ones(len(inputs['x']))
+        return inputs
+
+    def validate(self, data='dev', do_test=False, epoch=0):
+        # grows with the epochs, so the learning rate decays
+        return float(sum(p.pow(2).sum() for p in self.m.parameters())) + self.train_state['epoch']
+
+    def save_model(self, *args, **kwargs):
+        pass
+
+    def load_model(self, *args, **kwargs):
+        pass
+
+    def eval(self, *args, **kwargs):
+        pass
+
+    def save_checkpoint(self, path=None):
+        Model.save_checkpoint(self, path)
+        self.saves += 1
+        if self.saves == self.interrupt_at:
+            raise Interrupted()
+
+
+def test_train_resume_continues_like_an_uninterrupted_run(tmp_path, monkeypatch, caplog):
+    for name, value in [('save_log', True), ('exp_path', str(tmp_path)), ('batch_size', 2), ('epoch_num', 4),
+                        ('resume_interval', 1), ('para_cache_interval', 2), ('report_interval', 1000),
+                        ('accum_token_budget', 0), ('background_valid', False), ('early_stop_count', 5)]:
+        monkeypatch.setattr(cfg, name, value)
+    monkeypatch.setattr(model, 'get_sparse_input_aug_idx', lambda u_input_np: u_input_np)
+    handler = logging.NullHandler()
+    monkeypatch.setattr(logging, 'FileHandler', lambda path: handler)   # eval log of the end of training
+    caplog.set_level(logging.INFO)
+
+    def epoch_logs():
+        logs = [re.match(r'epoch: \d+, train loss: [\d.]+, valid loss: [\d.]+', record.getMessage())
+                for record in caplog.records]
+        caplog.clear()
+        return [log.group(0) for log in logs if log]
+
+    random.seed(0)
+    np.random.seed(0)
+    full = StubModel(0)
+    full.train()
+    full_logs = epoch_logs()
+
+    random.seed(0)
+    np.random.seed(0)
+    # 6 batches and an epoch-end checkpoint per epoch: interrupted in epoch 1, the first with paraphrases
+    interrupted = StubModel(0, interrupt_at=10)
+    with pytest.raises(Interrupted):
+        interrupted.train()
+    resumed = StubModel(1)
+    resumed.load_checkpoint()
+    assert (resumed.train_state['epoch'], resumed.train_state['iter']) == (1, 3)
+    assert resumed.train_state['sup_cnt'] == interrupted.train_state['sup_cnt'] > 0
+    assert resumed.para_cache == interrupted.para_cache != {}
+    resumed.train()
+    logging.getLogger('').removeHandler(handler)
+    # epoch 0 is skipped, epoch 1 goes on from its fourth batch, and epoch 3 reuses the paraphrases of epoch 1
+    assert interrupted.m.losses + resumed.m.losses == full.m.losses
+    assert epoch_logs() == full_logs
+    assert len(full_logs) == 4
+
+
+class TokenDialogLoss(torch.nn.Module):
+    """
+    dialog losses summed over 1 to 3 target tokens per example, each token with a loss of its own
+    """
+    def __init__(self):
+        super(TokenDialogLoss, self).__init__()
+        self.linear = torch.nn.Linear(2, 1)
+        self.window = []   # turn inputs since the last update
+
+    def token_loss(self, x, para_dec, tokens):
+        steps = torch.arange(3)
+        mask = (steps.view(1, -1) < tokens.view(-1, 1)).float()   # [B,3]
+        out = self.linear(torch.stack([x, para_dec], dim=1))   # [B,1]
+        return ((out + steps.float().view(1, -1)).pow(2) * mask).sum(1)
+
+    def forward(self, inputs, hidden_states, first_turn, mode='train', para_dec=None, token_sum=False):
+        assert token_sum
+        self.window.append((inputs['x'], inputs['tokens']))
+        loss = self.token_loss(inputs['x'], para_dec, inputs['tokens'])
+        return loss, {'resp': loss, 'tokens': inputs['tokens']}
+
+
+class TokenParaLoss(torch.nn.Module):
+    """
+    paraphrase losses summed over one target token per example, large enough for their gradients to be clipped
+    """
+    def __init__(self):
+        super(TokenParaLoss, self).__init__()
+        self.linear = torch.nn.Linear(1, 1)
+
+    def forward(self, u_input, mode='train', token_sum=False, **kwargs):
+        assert token_sum
+        para_dec = self.linear(u_input.view(-1, 1)).view(-1)
+        return para_dec, None, ((para_dec + 10).pow(2).sum() * 10, len(para_dec))
+
+
+class TokenStubModel(StubModel):
+    dialog_loss, para_loss = TokenDialogLoss, TokenParaLoss
+
+
+def clipped(grads, max_norm=5.0):
+    norm = float(sum(g.pow(2).sum() for g in grads)) ** 0.5
+    coef = max_norm / (norm + 1e-6)
+    return [g * coef for g in grads] if coef < 1 else grads, norm
+
+
+def test_token_budget_update_is_per_token_mean_over_the_window(tmp_path, monkeypatch):
+    for name, value in [('save_log', False), ('exp_path', str(tmp_path)), ('batch_size', 2), ('epoch_num', 1),
+                        ('resume_interval', 0), ('para_cache_interval', 0), ('report_interval', 1000),
+                        ('accum_token_budget', 10), ('background_valid', False)]:
+        monkeypatch.setattr(cfg, name, value)
+    monkeypatch.setattr(model, 'get_sparse_input_aug_idx', lambda u_input_np: u_input_np)
+    handler = logging.NullHandler()
+    monkeypatch.setattr(logging, 'FileHandler', lambda path: handler)
+    trainer = TokenStubModel(0)
+    m_params, para_params = list(trainer.m.parameters()), list(trainer.m_para.parameters())
+    optim_step = trainer.optim.step
+    windows, para_norms = [], []
+
+    def checked_step(*args, **kwargs):
+        # gradient of the token losses summed over the window, divided by its tokens, then clipped per model
+        loss, tokens = 0, 0
+        for x, n in trainer.m.window:
+            para_dec, _, (para_loss, para_tokens) = trainer.m_para(u_input=x, token_sum=True)
+            loss = loss + para_loss + trainer.m.token_loss(x, para_dec, n).sum()
+            tokens += para_tokens + int(n.sum())
+        grads = torch.autograd.grad(loss / tokens, m_params + para_params)
+        m_grads, _ = clipped(grads[:len(m_params)])
+        para_grads, para_norm = clipped(grads[len(m_params):])
+        for p, g in zip(m_params + para_params, m_grads + para_grads):
+            assert torch.allclose(p.grad, g, rtol=1e-4, atol=1e-6)
+        windows.append(len(trainer.m.window))
+        para_norms.append(para_norm)
+        trainer.m.window = []
+        return optim_step(*args, **kwargs)
+
+    trainer.optim.step = checked_step
+    trainer.train()
+    logging.getLogger('').removeHandler(handler)
+    assert trainer.m.window == []
+    assert max(windows) > 1 and max(para_norms) > 5
+
+
+def test_lr_scheduler_matches_plateau_decay_and_keeps_adam_state():
+    rng = random.Random(0)
+    m = torch.nn.Linear(4, 1)
+    optim = torch.optim.Adam(m.parameters(), lr=cfg.lr)
+    scheduler = LRScheduler(optim, cfg.lr, cfg.lr_decay, cfg.weight_decay_count)
+    lr, weight_decay_count = cfg.lr, cfg.weight_decay_count
+    for epoch in range(40):
+        m(torch.randn(2, 4)).sum().backward()
+        optim.step()
+        scheduler.step()
+        improved = rng.random() < 0.3
+        # counters of the original training loop, which rebuilt Adam on decay
+        if improved:
+            weight_decay_count = cfg.weight_decay_count
+        else:
+            weight_decay_count -= 1
+            if not weight_decay_count:
+                lr *= cfg.lr_decay
+                weight_decay_count = cfg.weight_decay_count
+        scheduler.epoch_step(improved)
+        assert scheduler.lr == lr
+        assert all(group['lr'] == lr for group in optim.param_groups)
+        assert all(optim.state[p]['step'] == epoch + 1 for p in m.parameters())
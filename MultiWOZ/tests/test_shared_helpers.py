@@ -0,0 +1,40 @@
+import ast
+import os
+
+import pytest
+
+# helpers copied in both codebases, which are run separately and do not import each other
+SHARED = [
+    ('model.py', 'model.py', ['cpu_snapshot', 'CheckpointWriter', 'set_cpu_threads', 'quantize_dynamic',
+                              'get_rng_state', 'set_rng_state']),
+    ('damd_net.py', 'tsd_net.py', ['_bf16_supported', 'bf16_enabled', 'autocast', 'bf16_autocast', 'fp32']),
+]
+
+MULTIWOZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CAMREST = os.path.join(os.path.dirname(MULTIWOZ), 'CamRest676')
+
+
+def top_level_defs(path):
+    """
+    ast dump of every top level function, class and assigned name of a module
+    """
+    with open(path) as f:
+        tree = ast.parse(f.read())
+    defs = {}
+    for node in tree.body:
+        if isinstance(node, (ast.FunctionDef, ast.ClassDef)):
+            defs[node.name] = ast.dump(node)
+        elif isinstance(node, ast.Assign):
+            for target in node.targets:
+                if isinstance(target, ast.Name):
+                    defs[target.id] = ast.dump(node)
+    return defs
+
+
+@pytest.mark.parametrize('multiwoz_file,camrest_file,names', SHARED)
+def test_shared_helpers_are_identical(multiwoz_file, camrest_file, names):
+    multiwoz = top_level_defs(os.path.join(MULTIWOZ, multiwoz_file))
+    camrest = top_level_defs(os.path.join(CAMREST, camrest_file))
+    for name in names:
+        assert multiwoz[name] == camrest[name], '%s differs between %s and CamRest676/%s' % (
+            name, multiwoz_file, camrest_file)
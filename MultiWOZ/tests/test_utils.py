@@ -0,0 +1,101 @@
+import random
+import warnings
+
+import numpy as np
+import pytest
+from nltk.translate.bleu_score import sentence_bleu
+
+import utils
+
+
+def nltk_bleu(list_of_references, hypotheses):
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')   # nltk warns on n-gram orders without a match
+        return np.array([sentence_bleu(refs, hyp) for refs, hyp in zip(list_of_references, hypotheses)])
+
+
+def random_sentence(rng, words, max_len):
+    return [rng.choice(words) for _ in range(rng.randint(0, max_len))]
+
+
+def test_batch_sentence_bleu_matches_nltk():
+    rng = random.Random(0)
+    for _ in range(50):
+        # few words, so that the sentences share n-grams of every order
+        words = ['w%d' % i for i in range(rng.randint(2, 8))]
+        batch_size, ref_num = rng.randint(1, 8), rng.randint(1, 3)
+        hypotheses = [random_sentence(rng, words, 14) for _ in range(batch_size)]
+        list_of_references = [[random_sentence(rng, words, 14) for _ in range(ref_num)] for _ in range(batch_size)]
+        list_of_references[0][0] = list(hypotheses[0])   # a perfect match
+        assert np.allclose(utils.batch_sentence_bleu(list_of_references, hypotheses),
+                           nltk_bleu(list_of_references, hypotheses), rtol=1e-6, atol=1e-9)
+
+
+def test_batch_sentence_bleu_ids_matches_nltk():
+    rng = np.random.RandomState(0)
+    for vocab_size in [5, 10 ** 6]:   # the large ids can not be hashed into one int64 per 4-gram
+        for _ in range(20):
+            batch_size = rng.randint(1, 8)
+            tokens = rng.choice(vocab_size, 6)
+            hyp_ids, hyp_lens = tokens[rng.randint(6, size=(batch_size, 12))], rng.randint(0, 13, batch_size)
+            ref_ids, ref_lens = [], []
+            for _ in range(2):
+                # the hypothesis with some tokens changed and a random length, so that they share n-grams
+                ids = np.where(rng.rand(batch_size, 12) < 0.15, tokens[rng.randint(6, size=(batch_size, 12))],
+                               hyp_ids)[:, :rng.randint(1, 13)]
+                ref_ids.append(ids)
+                ref_lens.append(rng.randint(0, ids.shape[1] + 1, batch_size))
+            hypotheses = [list(ids[:n]) for ids, n in zip(hyp_ids, hyp_lens)]
+            list_of_references = [[list(ids[b, :lens[b]]) for ids, lens in zip(ref_ids, ref_lens)]
+                                  for b in range(batch_size)]
+            assert np.allclose(utils.batch_sentence_bleu_ids(hyp_ids, hyp_lens, ref_ids, ref_lens),
+                               nltk_bleu(list_of_references, hypotheses), rtol=1e-6, atol=1e-9)
+
+
+def test_batch_act_f1_selection_matches_act_lists():
+    pytest.importorskip('spacy')
+    from reader import MultiWozReader
+    vocab = utils.Vocab(200)
+    for w in ['name', 'area', 'food', 'price', 'none', '[value_food]']:
+        vocab.add_word(w)
+    vocab.construct()
+    reader = MultiWozReader.__new__(MultiWozReader)   # only the vocab is needed
+    reader.vocab = vocab
+    domains = ['[restaurant]', '[hotel]', '[general]']
+    acts = ['[inform]', '[request]', '[nooffer]', '[bye]']
+    values = ['name', 'area', 'food', 'none', '[value_food]']
+    rng = np.random.RandomState(0)
+
+    def spans(num):
+        """
+        [num,12] act spans of up to three [domain] [act] value.. groups, some without acts, values or <eos_a>
+        """
+        ids = np.zeros((num, 12), dtype=np.int64)
+        for row in ids:
+            words = []
+            for _ in range(rng.randint(0, 4)):
+                words += [domains[rng.randint(3)]] if rng.rand() < 0.8 else []
+                words += [acts[rng.randint(4)]] + [values[k] for k in rng.randint(5, size=rng.randint(0, 3))]
+            words = words[:rng.randint(8, 12)] + ['<eos_a>'] if rng.rand() < 0.8 else words[:12]
+            row[:len(words)] = [vocab.encode(w) for w in words]
+        return ids
+
+    for _ in range(50):
+        batch_size, nbest = rng.randint(1, 6), rng.randint(1, 5)
+        ref = spans(batch_size)
+        # candidates are their reference with a share of the tokens replaced, from none to all of them
+        cand, noise = ref.repeat(nbest, axis=0), spans(batch_size * nbest)
+        replace = rng.rand(*cand.shape) < rng.rand(len(cand), 1) ** 2
+        cand[replace] = noise[replace]
+        ref_rows, ref_acts = reader.aspan_to_act_ids(ref)
+        cand_rows, cand_acts = reader.aspan_to_act_ids(cand)
+        scores = utils.batch_f1_score(ref_rows, ref_acts, cand_rows, cand_acts, batch_size, nbest)
+        # selection of the original implementation, over decoded act strings
+        expected = np.zeros((batch_size, nbest))
+        for b in range(batch_size):
+            ref_list = reader.aspan_to_act_list(vocab.sentence_decode(ref[b], eos='<eos_a>'))
+            for i in range(nbest):
+                cand_list = reader.aspan_to_act_list(vocab.sentence_decode(cand[b * nbest + i], eos='<eos_a>'))
+                expected[b, i] = utils.f1_score(ref_list, cand_list)
+        assert np.allclose(scores, expected)
+        assert np.allclose(expected[np.arange(batch_size), scores.argmax(1)], expected.max(1))
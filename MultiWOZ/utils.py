@@ -21,6 +21,109 @@ def f1_score(label_list, pred_list):
     f1 = 2 * precision * recall / (precision + recall + 1e-10)
     return f1
 
+def batch_f1_score(label_rows, label_acts, pred_rows, pred_acts, batch_size, nbest):
+    """
+    f1_score of each label list against its nbest pred lists, with acts counted over the act vocabulary
+    :param label_rows: [K] batch index of each label act
+    :param pred_rows: [K'] batch index * nbest + candidate index of each pred act
+    :return: [B,nbest]
+    """
+    _, act_idx = np.unique(np.concatenate([label_acts, pred_acts]), return_inverse=True)
+    act_num = act_idx.max() + 1 if len(act_idx) else 1
+    label_count = np.zeros((batch_size, act_num))
+    np.add.at(label_count, (label_rows, act_idx[:len(label_acts)]), 1)
+    pred_count = np.zeros((batch_size * nbest, act_num))
+    np.add.at(pred_count, (pred_rows, act_idx[len(label_acts):]), 1)
+    pred_count = pred_count.reshape(batch_size, nbest, act_num)
+    tp = np.matmul(pred_count, (label_count > 0)[:, :, None].astype(pred_count.dtype))[:, :, 0]   # [B,nbest]
+    precision = tp / (pred_count.sum(2) + 1e-10)
+    recall = tp / (np.maximum(label_count.sum(1, keepdims=True), tp) + 1e-10)
+    return 2 * precision * recall / (precision + recall + 1e-10)
+
+def batch_ngrams(ids, lens, n):
+    """
+    :param ids: [B,T] token ids
+    :param lens: [B]
+    :return: batch index [N] and ids [N,n] of every n-gram within the sequence lengths
+    """
+    T = ids.shape[1]
+    if T < n:
+        return np.zeros(0, dtype=np.int64), np.zeros((0, n), dtype=ids.dtype)
+    grams = np.stack([ids[:, k:T-n+1+k] for k in range(n)], axis=2)   # [B,T-n+1,n]
+    valid = np.arange(T-n+1).reshape(1, -1) <= (lens.reshape(-1, 1) - n)
+    return np.where(valid)[0], grams[valid]
+
+
+def batch_sentence_bleu_ids(hyp_ids, hyp_lens, ref_ids, ref_lens, max_order=4):
+    """
+    sentence level bleu of every example in a batch, as nltk sentence_bleu with uniform weights and no smoothing
+    :param hyp_ids: [B,T] hypothesis token ids
+    :param hyp_lens: [B]
+    :param ref_ids: list of [B,T_r] reference token ids, one array per reference
+    :param ref_lens: list of [B]
+    :return: [B] bleu, 0 when some n-gram order has no match
+    """
+    batch_size = hyp_ids.shape[0]
+    log_precision = np.zeros(batch_size)
+    no_match = np.zeros(batch_size, dtype=bool)
+    for n in range(1, max_order+1):
+        hyp_b, hyp_grams = batch_ngrams(hyp_ids, hyp_lens, n)
+        refs = [batch_ngrams(ids, lens, n) for ids, lens in zip(ref_ids, ref_lens)]
+        # n-grams are keyed by (example, token ids), so counts are kept apart per example
+        rows = np.concatenate([np.concatenate([b.reshape(-1, 1), g], axis=1).astype(np.int64)
+                               for b, g in [(hyp_b, hyp_grams)] + refs], axis=0)
+        if len(rows) == 0:
+            no_match[:] = True
+            continue
+        base = int(rows[:, 1:].max()) + 1
+        if batch_size * base ** n < 2 ** 62:
+            # hash every row into one int64, much faster than np.unique over rows
+            hashed = rows[:, 0]
+            for k in range(1, n+1):
+                hashed = hashed * base + rows[:, k]
+            _, first, inverse = np.unique(hashed, return_index=True, return_inverse=True)
+            keys = rows[first]
+        else:
+            keys, inverse = np.unique(rows, axis=0, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        hyp_count = np.bincount(inverse[:len(hyp_b)], minlength=len(keys))
+        ref_count, offset = np.zeros(len(keys)), len(hyp_b)
+        for b, _ in refs:
+            ref_count = np.maximum(ref_count, np.bincount(inverse[offset:offset+len(b)], minlength=len(keys)))
+            offset += len(b)
+        numerator = np.bincount(keys[:, 0], weights=np.minimum(hyp_count, ref_count), minlength=batch_size)
+        denominator = np.maximum(np.bincount(hyp_b, minlength=batch_size), 1)
+        no_match |= numerator == 0
+        log_precision += np.log(np.maximum(numerator, 1)) - np.log(denominator)
+
+    # brevity penalty against the closest reference length, the shorter one on ties
+    ref_lens = np.stack(ref_lens, axis=1)   # [B,R]
+    dist = np.abs(ref_lens - hyp_lens.reshape(-1, 1)) * (ref_lens.max() + 1) + ref_lens
+    closest = ref_lens[np.arange(batch_size), dist.argmin(axis=1)]
+    bp = np.exp(1 - closest / np.maximum(hyp_lens, 1))
+    bp[hyp_lens > closest] = 1.
+    bleu = bp * np.exp(log_precision / max_order)
+    bleu[no_match | (hyp_lens == 0)] = 0.
+    return bleu
+
+
+def batch_sentence_bleu(list_of_references, hypotheses, max_order=4):
+    """
+    word level wrapper of batch_sentence_bleu_ids, tokens get ids local to the batch
+    :param list_of_references: [B] lists of references, each a list of tokens, same number of references per example
+    :param hypotheses: [B] lists of tokens
+    :return: [B] bleu
+    """
+    token_ids = {}
+    def encode(sentences):
+        ids = [[token_ids.setdefault(w, len(token_ids)) for w in s] for s in sentences]
+        lens = np.array([len(s) for s in ids])
+        return padSeqs([s or [0] for s in ids], pad_method='post', dtype='int64'), lens
+    hyp_ids, hyp_lens = encode(hypotheses)
+    refs = [encode(refs) for refs in zip(*list_of_references)]
+    return batch_sentence_bleu_ids(hyp_ids, hyp_lens, [r[0] for r in refs], [r[1] for r in refs], max_order)
+
+
 class Vocab(object):
     def __init__(self, vocab_size=0):
         self.vocab_size = vocab_size